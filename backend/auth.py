@@ -4,10 +4,152 @@
 from fastapi import HTTPException, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from supabase_client import get_supabase_client
+from config import settings
+from utils.concurrency import run_blocking
+from collections import OrderedDict
+from typing import Optional, Tuple
+import hashlib
+import threading
+import time
+import jwt
 
 
 security = HTTPBearer()
 
+# 非対称鍵（RS256/ES256）で署名されたトークン用
+ASYMMETRIC_ALGORITHMS = ["RS256", "ES256"]
+
+
+class TokenCache:
+    """
+    検証済みトークンのLRUキャッシュ
+
+    キーはトークンのSHA-256ハッシュで、トークンのexpを過ぎたエントリは返さない
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, Tuple[dict, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(token: str) -> str:
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def get(self, token: str) -> Optional[dict]:
+        key = self.key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            user, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return user
+
+    def set(self, token: str, user: dict, expires_at: float) -> None:
+        if self.max_size <= 0:
+            return
+        key = self.key(token)
+        with self._lock:
+            self._entries[key] = (user, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+_token_cache = TokenCache(settings.auth_cache_size)
+_jwks_client: Optional[jwt.PyJWKClient] = None
+_jwks_lock = threading.Lock()
+
+
+def get_jwks_client() -> jwt.PyJWKClient:
+    """SupabaseのJWKSクライアントを取得（公開鍵はキャッシュされる）"""
+    global _jwks_client
+    if _jwks_client is None:
+        with _jwks_lock:
+            if _jwks_client is None:
+                _jwks_client = jwt.PyJWKClient(
+                    f"{settings.supabase_url.rstrip('/')}/auth/v1/.well-known/jwks.json",
+                    cache_keys=True,
+                    lifespan=settings.auth_jwks_cache_seconds
+                )
+    return _jwks_client
+
+
+def decode_token_locally(token: str) -> Optional[dict]:
+    """
+    Supabaseのアクセストークンをローカルで検証
+
+    署名（HS256はJWTシークレット、RS256/ES256はJWKS）と exp / aud を検証する
+    公開鍵がキャッシュにない場合はJWKSをHTTPで取得してブロックするため、非同期の処理からは run_blocking で呼ぶ
+
+    Args:
+        token: アクセストークン
+
+    Returns:
+        検証済みのクレーム（ローカル検証に必要な設定がない場合はNone）
+
+    Raises:
+        jwt.InvalidTokenError: トークンが無効な場合
+    """
+    algorithm = jwt.get_unverified_header(token).get("alg")
+
+    if algorithm == "HS256":
+        if not settings.supabase_jwt_secret:
+            return None
+        key = settings.supabase_jwt_secret
+        algorithms = ["HS256"]
+    elif algorithm in ASYMMETRIC_ALGORITHMS:
+        if not settings.supabase_url:
+            return None
+        key = get_jwks_client().get_signing_key_from_jwt(token).key
+        algorithms = ASYMMETRIC_ALGORITHMS
+    else:
+        raise jwt.InvalidAlgorithmError(f"サポートされていない署名アルゴリズム: {algorithm}")
+
+    return jwt.decode(
+        token,
+        key,
+        algorithms=algorithms,
+        audience=settings.supabase_jwt_audience,
+        options={"require": ["exp", "sub"]}
+    )
+
+
+def verify_token_remotely(token: str) -> dict:
+    """
+    Supabase Authに問い合わせてトークンを検証
+
+    Args:
+        token: アクセストークン
+
+    Returns:
+        ユーザー情報（id, email, role）
+    """
+    supabase = get_supabase_client()
+
+    # SupabaseのJWTトークンはaccess_tokenとして使用
+    response = supabase.auth.get_user(token)
+
+    if not response or not response.user:
+        raise HTTPException(
+            status_code=401,
+            detail="認証に失敗しました"
+        )
+
+    # ユーザーメタデータからロールを取得
+    user_metadata = response.user.user_metadata or {}
+    role = user_metadata.get("role", "user")
+
+    return {
+        "id": response.user.id,
+        "email": response.user.email,
+        "role": role
+    }
+
 
 async def verify_token(
     credentials: HTTPAuthorizationCredentials = Depends(security)
@@ -15,6 +157,10 @@ async def verify_token(
     """
     JWTトークンを検証し、ユーザー情報を返す
     
+    通常はローカルで署名・有効期限を検証し、結果をトークンの有効期限までキャッシュする。
+    AUTH_VERIFY_REMOTE=true、またはローカル検証に必要な設定がない場合は
+    Supabase Authに問い合わせる。
+    
     Args:
         credentials: Bearerトークン
         
@@ -27,31 +173,34 @@ async def verify_token(
     token = credentials.credentials
     
     try:
-        # Supabaseクライアントを取得
-        supabase = get_supabase_client()
+        if settings.auth_verify_remote:
+            return await run_blocking(verify_token_remotely, token)
         
-        # トークンでセッションを設定してユーザー情報を取得
-        # SupabaseのJWTトークンはaccess_tokenとして使用
-        response = supabase.auth.get_user(token)
+        cached = _token_cache.get(token)
+        if cached is not None:
+            return cached
         
-        if not response or not response.user:
-            raise HTTPException(
-                status_code=401,
-                detail="認証に失敗しました"
-            )
+        claims = await run_blocking(decode_token_locally, token)
+        if claims is None:
+            return await run_blocking(verify_token_remotely, token)
         
         # ユーザーメタデータからロールを取得
-        user_metadata = response.user.user_metadata or {}
-        role = user_metadata.get("role", "user")
-            
-        return {
-            "id": response.user.id,
-            "email": response.user.email,
-            "role": role
+        user_metadata = claims.get("user_metadata") or {}
+        user = {
+            "id": claims["sub"],
+            "email": claims.get("email"),
+            "role": user_metadata.get("role", "user")
         }
+        _token_cache.set(token, user, float(claims["exp"]))
+        return user
         
     except HTTPException:
         raise
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(
+            status_code=401,
+            detail="認証に失敗しました: トークンの有効期限が切れています"
+        )
     except Exception as e:
         raise HTTPException(
             status_code=401,
@@ -0,0 +1,128 @@
+"""
+/chat 同時実行ベンチマーク
+
+OpenAIとSupabaseを一定の遅延を持つスタブに置き換え、N件の /chat を同時に送る。
+イベントループがブロックされていなければ、全体の所要時間は
+N × LLM遅延 ではなく、ほぼ 1 回分の（Embedding + LLM）遅延に収まる。
+
+使い方（backendディレクトリで実行）:
+    python -m benchmarks.bench_chat_concurrency --requests 20 --llm-latency 1.0
+"""
+from types import SimpleNamespace
+from openai.types import CompletionUsage
+import argparse
+import asyncio
+import json
+import time
+import httpx
+import numpy as np
+
+import main
+import openai_client
+from config import settings
+from utils.corpus import current_version
+from utils.store import require_store
+from utils.vector_index import get_vector_index
+
+
+class StubEmbeddings:
+    def __init__(self, latency: float, dim: int):
+        self.latency = latency
+        self.dim = dim
+
+    async def create(self, model: str, input):
+        await asyncio.sleep(self.latency)
+        texts = input if isinstance(input, list) else [input]
+        rng = np.random.default_rng(len(texts))
+        return SimpleNamespace(data=[
+            SimpleNamespace(index=i, embedding=rng.normal(size=self.dim).astype(np.float32).tolist())
+            for i in range(len(texts))
+        ], usage=SimpleNamespace(prompt_tokens=len(texts), total_tokens=len(texts)))
+
+
+class StubCompletions:
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    async def create(self, **kwargs):
+        await asyncio.sleep(self.latency)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content="スタブ回答"))],
+            usage=CompletionUsage(prompt_tokens=0, completion_tokens=0, total_tokens=0)
+        )
+
+
+class StubOpenAI:
+    """AsyncOpenAIの代わりに使うスタブ（使用するメソッドのみ）"""
+
+    def __init__(self, embedding_latency: float, llm_latency: float, dim: int):
+        self.embeddings = StubEmbeddings(embedding_latency, dim)
+        self.chat = SimpleNamespace(completions=StubCompletions(llm_latency))
+
+    def with_options(self, **kwargs):
+        return self
+
+    async def close(self):
+        pass
+
+
+def install_stubs(embedding_latency: float, llm_latency: float, chunks: int) -> None:
+    """OpenAIクライアントとインメモリインデックスをスタブに差し替える"""
+    dim = settings.embedding_dimensions
+    openai_client._async_client = StubOpenAI(embedding_latency, llm_latency, dim)
+    main.app.dependency_overrides[require_store] = lambda: None
+
+    rng = np.random.default_rng(0)
+    index = get_vector_index()
+    index.load_arrays(
+        chunk_ids=[f"chunk-{i}" for i in range(chunks)],
+        file_ids=[f"file-{i % 10}" for i in range(chunks)],
+        contents=[f"チャンク {i}" for i in range(chunks)],
+        embeddings=rng.normal(size=(chunks, dim)).astype(np.float32),
+        filenames={f"file-{i}": f"doc-{i}.txt" for i in range(10)},
+        version=current_version()
+    )
+
+
+async def run(requests: int) -> dict:
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def one() -> float:
+            started = time.perf_counter()
+            response = await client.post("/chat", json={"question": "ベンチマーク", "retrieval_mode": "memory"})
+            response.raise_for_status()
+            return time.perf_counter() - started
+
+        started = time.perf_counter()
+        latencies = await asyncio.gather(*[one() for _ in range(requests)])
+        wall = time.perf_counter() - started
+
+    return {
+        "requests": requests,
+        "wall_seconds": round(wall, 4),
+        "mean_latency_seconds": round(float(np.mean(latencies)), 4),
+        "max_latency_seconds": round(float(np.max(latencies)), 4),
+    }
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=20, help="同時リクエスト数")
+    parser.add_argument("--embedding-latency", type=float, default=0.1, help="Embedding APIの遅延（秒）")
+    parser.add_argument("--llm-latency", type=float, default=1.0, help="Chat APIの遅延（秒）")
+    parser.add_argument("--chunks", type=int, default=10000, help="インデックスのチャンク数")
+    args = parser.parse_args()
+
+    install_stubs(args.embedding_latency, args.llm_latency, args.chunks)
+    result = asyncio.run(run(args.requests))
+    single = args.embedding_latency + args.llm_latency
+    result.update({
+        "single_request_latency_seconds": single,
+        "serialized_estimate_seconds": round(single * args.requests, 4),
+        "speedup_vs_serialized": round(single * args.requests / result["wall_seconds"], 2),
+    })
+    print(json.dumps(result, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,84 @@
+"""
+量子化インデックスのベンチマーク
+
+同じEmbedding（クラスタを持つ乱数）から none / float16 / int8 のインデックスを作り、
+検索用行列のメモリ、検索レイテンシ、float32の全件走査に対する再現率を比べる。
+
+使い方（backendディレクトリで実行）:
+    python -m benchmarks.bench_quantized_search --chunks 200000 --queries 200
+"""
+import argparse
+import json
+import time
+import numpy as np
+
+from config import settings
+from utils.vector_index import QUANTIZATION_DTYPES, VectorIndex
+
+
+def make_embeddings(chunks: int, dim: int, clusters: int, seed: int = 0) -> np.ndarray:
+    """話題ごとのまとまりを持つEmbeddingを作る（実データに近い類似度の分布にする）"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, clusters, size=chunks)
+    embeddings = centers[labels]
+    embeddings += rng.normal(scale=0.8, size=(chunks, dim)).astype(np.float32)
+    return embeddings
+
+
+def run(chunks: int, queries: int, top_k: int, candidates: int, clusters: int) -> list:
+    dim = settings.embedding_dimensions
+    embeddings = make_embeddings(chunks, dim, clusters)
+    rng = np.random.default_rng(1)
+    query_rows = embeddings[rng.choice(chunks, size=queries, replace=False)]
+    query_matrix = query_rows + rng.normal(scale=0.8, size=query_rows.shape).astype(np.float32)
+
+    results = []
+    for quantization in QUANTIZATION_DTYPES:
+        index = VectorIndex(dim, quantization=quantization, rescore_candidates=candidates)
+        index.load_arrays(
+            chunk_ids=[f"chunk-{i}" for i in range(chunks)],
+            file_ids=["file-0"] * chunks,
+            contents=[""] * chunks,
+            embeddings=embeddings,
+            filenames={"file-0": "bench.txt"},
+            version=0
+        )
+        index.search(query_matrix[0], top_k=top_k)
+
+        latencies = []
+        for query in query_matrix:
+            started = time.perf_counter()
+            index.search(query, top_k=top_k)
+            latencies.append(time.perf_counter() - started)
+
+        stats = index.memory_stats()
+        recall = index.measure_recall(queries=query_matrix, top_k=top_k)
+        results.append({
+            "quantization": quantization,
+            "chunks": chunks,
+            "matrix_mb": round(stats["matrix_bytes"] / (1024 * 1024), 2),
+            "bytes_per_chunk": stats["bytes_per_chunk"],
+            "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 3),
+            "p95_ms": round(float(np.percentile(latencies, 95)) * 1000, 3),
+            f"recall_at_{top_k}": recall["recall"],
+            "rescore_candidates": recall["candidates"],
+        })
+    return results
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=100000, help="インデックスのチャンク数")
+    parser.add_argument("--queries", type=int, default=200, help="質問数")
+    parser.add_argument("--top-k", type=int, default=3, help="取得件数")
+    parser.add_argument("--candidates", type=int, default=settings.vector_rescore_candidates, help="再スコアリングする候補数")
+    parser.add_argument("--clusters", type=int, default=500, help="話題（クラスタ）の数")
+    args = parser.parse_args()
+
+    for result in run(args.chunks, args.queries, args.top_k, args.candidates, args.clusters):
+        print(json.dumps(result, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main_cli()
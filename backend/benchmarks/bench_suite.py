@@ -0,0 +1,503 @@
+"""
+オフラインの負荷・レイテンシベンチマーク
+
+Supabase（REST・Storage・Auth）とOpenAI（Embedding・Chat）をローカルのスタブサーバー
+（benchmarks.stub_services）に置き換え、実際のクライアントを通して次を測定する。
+
+    chat: 合成チャンク数（既定 1k / 100k / 1M）ごとの /chat の p50 / p95 / p99 と スループット
+          （Server-Timing ヘッダーから段階ごとの p50 も集計する）
+    ingestion: /admin/upload から取り込みジョブの完了までの docs/s と chunks/s
+
+--storage-backend local ではファイル情報・チャンクをローカルの保存先（utils.local_store）に置き、
+スタブはAuth・OpenAIにだけ使う（rpc は合成データを保存先に書き込んでから測定する）。
+結果はJSONで出力する（--output でファイルにも保存）。--baseline に以前の結果を渡すと
+同じ条件の結果との比を付け、--max-regression を超えて悪化した場合は終了コード1で終わる。
+失敗したリクエスト・取り込みが1件でもあれば結果に "valid": false を付けて終了コード2で終わる
+（壊れた状態の測定値を baseline にしないため。無効な結果は --baseline にも使えない）。
+
+使い方（backendディレクトリで実行）:
+    python -m benchmarks.bench_suite --output bench.json
+    python -m benchmarks.bench_suite --scales 1000,100000 --modes memory,hybrid --baseline bench.json
+    python -m benchmarks.bench_suite --storage-backend local --scales 1000,100000 --modes memory,rpc
+
+1M チャンク × 1536 次元では合成データとインデックスで約12GBのメモリを使う。
+足りない場合は --dim で次元を下げるか、--scales から外すこと。
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+import httpx
+import jwt
+import numpy as np
+
+from config import settings
+from benchmarks.stub_services import StubServer, StubState, SyntheticCorpus
+
+
+RESULT_FORMAT = "smallbase-bench/1"
+# 結果が無効（失敗したリクエスト・取り込みがある）な場合の終了コード
+EXIT_INVALID = 2
+JWT_SECRET = "bench-secret-bench-secret-bench-secret"
+
+
+def make_token(role: str, subject: str = "00000000-0000-0000-0000-000000000001") -> str:
+    """スタブ用のHS256トークン（SUPABASE_JWT_SECRET をベンチマーク用の値にしてローカル検証させる）"""
+    claims = {
+        "sub": subject,
+        "role": role,
+        "aud": "authenticated",
+        "email": "bench@example.com",
+        "user_metadata": {"role": "admin"},
+        "exp": int(time.time()) + 86400
+    }
+    return jwt.encode(claims, JWT_SECRET, algorithm="HS256")
+
+
+def configure(args: argparse.Namespace, stub_url: str, state_dir: str) -> None:
+    """アプリの設定をスタブ向けに書き換える（main の読み込み前に呼ぶ）"""
+    settings.supabase_url = stub_url
+    settings.supabase_key = make_token("anon")
+    settings.supabase_service_key = make_token("service_role")
+    settings.supabase_jwt_secret = JWT_SECRET
+    settings.auth_verify_remote = False
+    settings.openai_api_key = "sk-bench"
+    settings.openai_base_url = f"{stub_url}/v1"
+    settings.storage_backend = args.storage_backend
+    settings.embedding_dimensions = args.dim
+    settings.vector_quantization = args.quantization
+    settings.lexical_index_enabled = "hybrid" in args.modes
+    # 測定中にインデックスを読み直さない
+    settings.vector_index_refresh_seconds = 10 ** 9
+    settings.local_state_dir = state_dir
+    settings.embedding_cache_persistent = False
+    settings.answer_cache_enabled = args.with_caches
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    """p50 / p95 / p99 / 平均（ミリ秒）"""
+    if not values:
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None, "mean_ms": None}
+    p50, p95, p99 = np.percentile(np.asarray(values) * 1000, [50, 95, 99])
+    return {
+        "p50_ms": round(float(p50), 3),
+        "p95_ms": round(float(p95), 3),
+        "p99_ms": round(float(p99), 3),
+        "mean_ms": round(float(np.mean(values)) * 1000, 3)
+    }
+
+
+def parse_server_timing(header: Optional[str]) -> Dict[str, float]:
+    """Server-Timing ヘッダーを {段階: ミリ秒} にする"""
+    timings: Dict[str, float] = {}
+    for entry in (header or "").split(","):
+        name, _, rest = entry.strip().partition(";")
+        if name and rest.startswith("dur="):
+            timings[name] = float(rest[4:])
+    return timings
+
+
+async def run_requests(count: int, concurrency: int, send) -> Dict[str, object]:
+    """
+    count 件のリクエストを concurrency 件ずつ並行に送り、レイテンシを集計する
+
+    Args:
+        count: リクエスト数
+        concurrency: 同時実行数
+        send: 番号を受け取りレスポンスを返すコルーチン関数
+
+    失敗は種類（例外のクラス名・HTTPステータス）ごとに数え、種類ごとに最初の1件の内容を標準エラーに出す
+    """
+    latencies: List[float] = []
+    stages: Dict[str, List[float]] = {}
+    error_types: Dict[str, int] = {}
+    next_index = 0
+
+    def record_error(kind: str, detail: str) -> None:
+        if kind not in error_types:
+            print(f"エラー（{kind}）:\n{detail}", file=sys.stderr)
+        error_types[kind] = error_types.get(kind, 0) + 1
+
+    async def worker() -> None:
+        nonlocal next_index
+        while next_index < count:
+            i = next_index
+            next_index += 1
+            started = time.perf_counter()
+            try:
+                response = await send(i)
+            except Exception as e:
+                record_error(type(e).__name__, traceback.format_exc())
+                continue
+            elapsed = time.perf_counter() - started
+            if response.status_code >= 400:
+                record_error(f"HTTP {response.status_code}", response.text[:2000])
+                continue
+            latencies.append(elapsed)
+            for stage, ms in parse_server_timing(response.headers.get("server-timing")).items():
+                stages.setdefault(stage, []).append(ms)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(max(1, concurrency))])
+    wall = time.perf_counter() - started
+
+    return {
+        "requests": count,
+        "errors": sum(error_types.values()),
+        "error_types": dict(sorted(error_types.items())),
+        "wall_seconds": round(wall, 4),
+        "throughput_rps": round(len(latencies) / wall, 3) if wall > 0 else None,
+        **percentiles(latencies),
+        "stages_p50_ms": {stage: round(float(np.median(values)), 3) for stage, values in sorted(stages.items())}
+    }
+
+
+def store_corpus(corpus: SyntheticCorpus) -> None:
+    """合成データをローカルの保存先に書き込む"""
+    from utils.store import get_store
+
+    store = get_store()
+    for file_id, filename in corpus.filenames.items():
+        store.insert_file({"id": file_id, "filename": filename})
+    for start in range(0, len(corpus), SyntheticCorpus.BLOCK_ROWS):
+        end = min(start + SyntheticCorpus.BLOCK_ROWS, len(corpus))
+        store.insert_chunks([
+            {
+                "id": corpus.chunk_ids[i],
+                "file_id": corpus.chunk_file_ids[i],
+                "content": corpus.contents[i],
+                "embedding": corpus.embeddings[i]
+            }
+            for i in range(start, end)
+        ])
+
+
+def clear_corpus(corpus: SyntheticCorpus) -> None:
+    """ローカルの保存先から合成データを削除"""
+    from utils.store import get_store
+
+    store = get_store()
+    for file_id in corpus.file_ids:
+        store.delete_file(file_id)
+
+
+def make_document(i: int, kilobytes: int) -> bytes:
+    """取り込み用の文書（文書ごと・段落ごとに内容を変え、Embeddingの再利用が起きないようにする）"""
+    paragraphs = []
+    size = 0
+    p = 0
+    while size < kilobytes * 1024:
+        paragraph = f"文書{i}の第{p}段落。" + f"項目{i}-{p}について説明します。" * 8
+        paragraphs.append(paragraph)
+        size += len(paragraph.encode("utf-8")) + 2
+        p += 1
+    return "\n\n".join(paragraphs).encode("utf-8")
+
+
+async def bench_ingestion(client: httpx.AsyncClient, args: argparse.Namespace, token: str) -> Dict[str, object]:
+    """/admin/upload から全ジョブの完了までを測定"""
+    from utils.vector_index import get_vector_index
+    from utils.corpus import current_version
+
+    get_vector_index().load_arrays([], [], [], np.empty((0, args.dim), dtype=np.float32), {}, current_version())
+    headers = {"Authorization": f"Bearer {token}"}
+    run_id = int(time.time() * 1000)
+    job_ids: List[str] = []
+
+    async def upload(i: int) -> httpx.Response:
+        response = await client.post(
+            "/admin/upload",
+            headers=headers,
+            files={"file": (f"bench-{run_id}-{i}.txt", make_document(i, args.doc_kb), "text/plain")}
+        )
+        if response.status_code == 202:
+            job_ids.append(response.json()["job_id"])
+        return response
+
+    started = time.perf_counter()
+    uploads = await run_requests(args.upload_docs, args.upload_concurrency, upload)
+
+    # 全ジョブの完了を待つ
+    pending = set(job_ids)
+    completed = failed = chunks = 0
+    failure_reasons: Dict[str, int] = {}
+    while pending:
+        for job_id in list(pending):
+            job = (await client.get(f"/admin/jobs/{job_id}", headers=headers)).json()
+            if job["stage"] in ("completed", "failed"):
+                pending.discard(job_id)
+                if job["stage"] == "completed":
+                    completed += 1
+                    chunks += job["chunks_total"]
+                else:
+                    failed += 1
+                    reason = job.get("error") or "不明"
+                    if reason not in failure_reasons:
+                        print(f"取り込み失敗: {reason}", file=sys.stderr)
+                    failure_reasons[reason] = failure_reasons.get(reason, 0) + 1
+        if pending:
+            await asyncio.sleep(0.02)
+    wall = time.perf_counter() - started
+
+    return {
+        "docs": args.upload_docs,
+        "doc_kb": args.doc_kb,
+        "docs_completed": completed,
+        "docs_failed": failed + uploads["errors"],
+        "upload_error_types": uploads["error_types"],
+        "failure_reasons": failure_reasons,
+        "chunks": chunks,
+        "wall_seconds": round(wall, 4),
+        "docs_per_second": round(completed / wall, 3),
+        "chunks_per_second": round(chunks / wall, 3),
+        "upload_latency": {key: uploads[key] for key in ("p50_ms", "p95_ms", "p99_ms", "mean_ms", "stages_p50_ms")}
+    }
+
+
+async def bench_chat(
+    client: httpx.AsyncClient,
+    args: argparse.Namespace,
+    state: StubState,
+    chunks: int
+) -> List[Dict[str, object]]:
+    """合成チャンク数 chunks のインデックスで、検索方式ごとに /chat を測定"""
+    from utils.vector_index import get_vector_index
+    from utils.corpus import current_version
+
+    started = time.perf_counter()
+    corpus = SyntheticCorpus(chunks, args.dim, seed=chunks)
+    generate_seconds = time.perf_counter() - started
+
+    index = get_vector_index()
+    started = time.perf_counter()
+    index.load_arrays(
+        corpus.chunk_ids, corpus.chunk_file_ids, corpus.contents, corpus.embeddings, corpus.filenames, current_version()
+    )
+    build_seconds = time.perf_counter() - started
+    memory = index.memory_stats()
+    # rpc はスタブが同じ合成データから match_chunks を返す（ローカルの保存先では保存先に書き込む）
+    stored = "rpc" in args.modes and args.storage_backend == "local"
+    if stored:
+        await asyncio.to_thread(store_corpus, corpus)
+    state.corpus = corpus if "rpc" in args.modes and not stored else None
+    if state.corpus is None:
+        corpus.embeddings = None
+
+    results = []
+    for mode in args.modes:
+        async def ask(i: int, mode: str = mode) -> httpx.Response:
+            return await client.post("/chat", json={
+                "question": f"製品K{i % 997}の在庫はどこにありますか？（{mode}-{chunks}-{i}）",
+                "retrieval_mode": mode
+            })
+
+        await run_requests(args.warmup, 1, ask)
+        measured = await run_requests(args.requests, args.concurrency, ask)
+        results.append({
+            "chunks": chunks,
+            "mode": mode,
+            "concurrency": args.concurrency,
+            **measured,
+            "corpus_generate_seconds": round(generate_seconds, 3),
+            "index_build_seconds": round(build_seconds, 3),
+            "index_matrix_bytes": memory.get("matrix_bytes")
+        })
+        print(
+            f"chat chunks={chunks} mode={mode}: p50={measured['p50_ms']}ms p95={measured['p95_ms']}ms "
+            f"p99={measured['p99_ms']}ms {measured['throughput_rps']} req/s errors={measured['errors']}",
+            file=sys.stderr
+        )
+
+    # 次の規模のためにメモリを空ける
+    state.corpus = None
+    if stored:
+        await asyncio.to_thread(clear_corpus, corpus)
+    index.load_arrays([], [], [], np.empty((0, args.dim), dtype=np.float32), {}, current_version())
+    del corpus
+    gc.collect()
+    return results
+
+
+def invalid_reasons(result: dict) -> List[str]:
+    """結果を無効にする理由（失敗したリクエスト・取り込み）"""
+    reasons = []
+    ingestion = result.get("ingestion")
+    if ingestion and ingestion["docs_failed"] > 0:
+        reasons.append(f"ingestion: {ingestion['docs_failed']}/{ingestion['docs']} 件の取り込みに失敗")
+    for row in result.get("chat", []):
+        if row["errors"] > 0:
+            reasons.append(f"chat/{row['mode']}/{row['chunks']}: {row['errors']}/{row['requests']} 件が失敗 {row['error_types']}")
+    return reasons
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def compare(result: dict, baseline: dict) -> List[dict]:
+    """同じ条件（チャンク数・検索方式・同時実行数）の結果との比（>1 は悪化。スループットは baseline / 今回）"""
+    comparisons = []
+    previous = {(row["chunks"], row["mode"], row["concurrency"]): row for row in baseline.get("chat", [])}
+    for row in result.get("chat", []):
+        base = previous.get((row["chunks"], row["mode"], row["concurrency"]))
+        if base is None:
+            continue
+        entry = {"scenario": f"chat/{row['mode']}/{row['chunks']}"}
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            if base.get(key) and row.get(key) is not None:
+                entry[key.replace("_ms", "_ratio")] = round(row[key] / base[key], 3)
+        if base.get("throughput_rps") and row.get("throughput_rps"):
+            entry["throughput_ratio"] = round(base["throughput_rps"] / row["throughput_rps"], 3)
+        comparisons.append(entry)
+
+    ingestion, base = result.get("ingestion"), baseline.get("ingestion")
+    if ingestion and base and base.get("docs_per_second") and ingestion.get("docs_per_second"):
+        comparisons.append({
+            "scenario": "ingestion",
+            "throughput_ratio": round(base["docs_per_second"] / ingestion["docs_per_second"], 3)
+        })
+    return comparisons
+
+
+async def run_suite(args: argparse.Namespace, state: StubState) -> dict:
+    import main
+
+    result = {
+        "format": RESULT_FORMAT,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": {
+            "dim": args.dim,
+            "quantization": args.quantization,
+            "modes": args.modes,
+            "scales": args.scales,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "with_caches": args.with_caches,
+            "storage_backend": args.storage_backend,
+            "supabase_latency": args.supabase_latency,
+            "embedding_latency": args.embedding_latency,
+            "llm_latency": args.llm_latency
+        },
+        "chat": []
+    }
+
+    async with main.lifespan(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=300) as client:
+            if args.upload_docs > 0:
+                result["ingestion"] = await bench_ingestion(client, args, make_token("authenticated"))
+                print(
+                    f"ingestion: {result['ingestion']['docs_per_second']} docs/s "
+                    f"{result['ingestion']['chunks_per_second']} chunks/s",
+                    file=sys.stderr
+                )
+            for chunks in args.scales:
+                result["chat"].extend(await bench_chat(client, args, state, chunks))
+
+    result["stub_requests"] = dict(sorted(state.requests.items()))
+    return result
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", default="1000,100000,1000000", help="合成チャンク数（カンマ区切り）")
+    parser.add_argument("--modes", default="memory", help="検索方式（memory / rpc / hybrid をカンマ区切り）")
+    parser.add_argument("--requests", type=int, default=200, help="規模・検索方式ごとの /chat の件数")
+    parser.add_argument("--concurrency", type=int, default=8, help="/chat の同時実行数")
+    parser.add_argument("--warmup", type=int, default=5, help="測定前に送る /chat の件数")
+    parser.add_argument("--dim", type=int, default=settings.embedding_dimensions, help="Embeddingの次元数")
+    parser.add_argument("--quantization", default=settings.vector_quantization, help="none / float16 / int8")
+    parser.add_argument("--storage-backend", choices=("supabase", "local"), default="supabase",
+                        help="ファイル情報・チャンクの保存先")
+    parser.add_argument("--upload-docs", type=int, default=50, help="取り込む文書数（0の場合は測定しない）")
+    parser.add_argument("--upload-concurrency", type=int, default=4, help="/admin/upload の同時実行数")
+    parser.add_argument("--doc-kb", type=int, default=20, help="1文書のサイズ（KB）")
+    parser.add_argument("--supabase-latency", type=float, default=0.005, help="Supabaseスタブの遅延（秒）")
+    parser.add_argument("--embedding-latency", type=float, default=0.02, help="Embeddingスタブの遅延（秒）")
+    parser.add_argument("--llm-latency", type=float, default=0.1, help="Chatスタブの遅延（秒）")
+    parser.add_argument("--with-caches", action="store_true", help="Embedding・回答キャッシュを有効のまま測定する")
+    parser.add_argument("--output", help="結果のJSONの保存先")
+    parser.add_argument("--baseline", help="比較する以前の結果のJSON")
+    parser.add_argument("--max-regression", type=float, default=None,
+                        help="baseline に対する p95・スループットの比がこれを超えたら終了コード1（例: 1.2）")
+    args = parser.parse_args(argv)
+    args.scales = [int(value) for value in args.scales.split(",") if value.strip()]
+    args.modes = [value.strip() for value in args.modes.split(",") if value.strip()]
+    unknown = [mode for mode in args.modes if mode not in ("memory", "rpc", "hybrid")]
+    if unknown:
+        parser.error(f"未対応の検索方式: {', '.join(unknown)}")
+    return args
+
+
+def main_cli(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        # 測定の前に確認する
+        if baseline.get("valid") is False:
+            print(f"エラー: {args.baseline} は無効な結果のため比較に使えません", file=sys.stderr)
+            return EXIT_INVALID
+    state = StubState(
+        dim=args.dim,
+        supabase_latency=args.supabase_latency,
+        embedding_latency=args.embedding_latency,
+        llm_latency=args.llm_latency
+    )
+    state_dir = tempfile.mkdtemp(prefix="smallbase-bench-")
+    try:
+        with StubServer(state) as server:
+            configure(args, server.url, state_dir)
+            result = asyncio.run(run_suite(args, state))
+    finally:
+        shutil.rmtree(state_dir, ignore_errors=True)
+
+    reasons = invalid_reasons(result)
+    result["valid"] = not reasons
+    if reasons:
+        result["invalid_reasons"] = reasons
+        for reason in reasons:
+            print(f"無効: {reason}", file=sys.stderr)
+
+    exit_code = 0 if result["valid"] else EXIT_INVALID
+    if baseline is not None:
+        result["comparison"] = compare(result, baseline)
+        if result["valid"] and args.max_regression is not None:
+            for entry in result["comparison"]:
+                worst = max(entry.get("p95_ratio", 0), entry.get("throughput_ratio", 0))
+                if worst > args.max_regression:
+                    print(f"悪化: {entry['scenario']} {entry}", file=sys.stderr)
+                    exit_code = 1
+
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    print(output)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
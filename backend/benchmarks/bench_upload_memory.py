@@ -0,0 +1,218 @@
+"""
+アップロードのメモリ使用量ベンチマーク
+
+指定サイズのTXTを /admin/upload に同時に送り、アップロード（Storageへの送信まで）と
+取り込み（テキスト抽出・チャンク分割まで）の間のピークRSSの増分を測る。
+SupabaseはStorageへの送信を読み捨てるスタブに置き換え、Embedding生成・保存は行わない。
+
+使い方（backendディレクトリで実行）:
+    python -m benchmarks.bench_upload_memory --size-mb 50 --uploads 4
+"""
+from types import SimpleNamespace
+import argparse
+import asyncio
+import json
+import os
+import resource
+import tempfile
+import threading
+import time
+import uuid
+import httpx
+
+import main
+from auth import verify_admin
+from config import settings
+from routers import admin
+from utils.concurrency import run_blocking
+from utils.ingestion import STAGE_COMPLETED, get_ingestion_queue, start_ingestion_queue, stop_ingestion_queue
+from utils.store import SupabaseStore, require_store
+from utils.text_extractor import iter_chunks, iter_text
+from utils.uploads import remove_spooled
+
+MB = 1024 * 1024
+
+
+class StubQuery:
+    """filesテーブル操作のスタブ（重複なし・挿入は常に成功）"""
+
+    def __init__(self):
+        self.inserting = False
+
+    def select(self, *args, **kwargs):
+        return self
+
+    def eq(self, *args, **kwargs):
+        return self
+
+    def limit(self, *args, **kwargs):
+        return self
+
+    def delete(self):
+        return self
+
+    def insert(self, row, **kwargs):
+        self.inserting = True
+        return self
+
+    def execute(self):
+        data = [{"id": str(uuid.uuid4())}] if self.inserting else []
+        return SimpleNamespace(data=data)
+
+
+class StubBucket:
+    """Storageのスタブ（送信内容を少しずつ読み捨てる）"""
+
+    def upload(self, path, file, file_options=None):
+        for _ in iter(lambda: file.read(64 * 1024), b""):
+            pass
+        return SimpleNamespace(path=path)
+
+    update = upload
+
+    def remove(self, paths):
+        pass
+
+
+class StubSupabase:
+    def __init__(self):
+        self.storage = SimpleNamespace(from_=lambda bucket: StubBucket())
+
+    def table(self, name):
+        return StubQuery()
+
+
+class RssSampler:
+    """RSSを一定間隔で読み、ピークを記録する（/proc がない環境ではプロセス全体のピーク）"""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def current() -> int:
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except OSError:
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.current())
+            time.sleep(self.interval)
+
+    def __enter__(self) -> "RssSampler":
+        self.baseline = self.current()
+        self.peak = self.baseline
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.current())
+
+    @property
+    def delta_mb(self) -> float:
+        return round((self.peak - self.baseline) / MB, 2)
+
+
+async def extract_only(job, store, source_path: str, storage_path: str) -> None:
+    """取り込みジョブの代わりに、抽出とチャンク分割だけを行う"""
+    try:
+        job.chunks_total = await run_blocking(
+            lambda: sum(1 for _ in iter_chunks(iter_text(source_path, job.filename)))
+        )
+        job.stage = STAGE_COMPLETED
+        job.progress = 1.0
+    finally:
+        remove_spooled(source_path)
+
+
+def write_sample(path: str, size_mb: int) -> None:
+    """指定サイズのTXTを少しずつ書き出す"""
+    line = ("これはアップロードのベンチマーク用の文です。" * 4 + "\n").encode("utf-8")
+    block = line * (MB // len(line))
+    with open(path, "wb") as f:
+        for _ in range(size_mb):
+            f.write(block)
+
+
+async def run(path: str, uploads: int) -> dict:
+    queue = get_ingestion_queue()
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        async def upload(i: int) -> str:
+            with open(path, "rb") as f:
+                response = await client.post(
+                    "/admin/upload",
+                    files={"file": (f"bench-{i}.txt", f, "text/plain")}
+                )
+            response.raise_for_status()
+            return response.json()["job_id"]
+
+        started = time.perf_counter()
+        with RssSampler() as upload_rss:
+            job_ids = await asyncio.gather(*[upload(i) for i in range(uploads)])
+        upload_seconds = time.perf_counter() - started
+
+        with RssSampler() as ingest_rss:
+            while True:
+                jobs = [await queue.get_job(job_id) for job_id in job_ids]
+                if all(job.finished for job in jobs):
+                    break
+                await asyncio.sleep(0.05)
+        total_seconds = time.perf_counter() - started
+
+    failed = [job.error for job in jobs if job.error]
+    if failed:
+        raise RuntimeError(f"取り込みに失敗しました: {failed[0]}")
+
+    return {
+        "uploads": uploads,
+        "upload_seconds": round(upload_seconds, 3),
+        "total_seconds": round(total_seconds, 3),
+        "upload_peak_rss_delta_mb": upload_rss.delta_mb,
+        "upload_peak_rss_delta_mb_per_upload": round(upload_rss.delta_mb / uploads, 2),
+        "ingest_peak_rss_delta_mb": ingest_rss.delta_mb,
+        "chunks_per_upload": jobs[0].chunks_total,
+    }
+
+
+async def run_with_queue(path: str, uploads: int) -> dict:
+    await start_ingestion_queue()
+    try:
+        return await run(path, uploads)
+    finally:
+        await stop_ingestion_queue()
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=20, help="アップロードするファイルのサイズ（MB）")
+    parser.add_argument("--uploads", type=int, default=4, help="同時アップロード数")
+    args = parser.parse_args()
+
+    settings.supabase_service_key = settings.supabase_service_key or "benchmark"
+    settings.max_upload_bytes = max(settings.max_upload_bytes, (args.size_mb + 1) * MB)
+    settings.ingestion_workers = max(settings.ingestion_workers, args.uploads)
+    main.app.dependency_overrides[require_store] = lambda: SupabaseStore(StubSupabase())
+    main.app.dependency_overrides[verify_admin] = lambda: {"id": "benchmark"}
+    admin.ingest_file = extract_only
+
+    fd, path = tempfile.mkstemp(suffix=".txt")
+    os.close(fd)
+    try:
+        write_sample(path, args.size_mb)
+        result = asyncio.run(run_with_queue(path, args.uploads))
+    finally:
+        os.remove(path)
+    result["file_size_mb"] = args.size_mb
+    print(json.dumps(result, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main_cli()
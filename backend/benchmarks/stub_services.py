@@ -0,0 +1,455 @@
+"""
+ベンチマーク用のSupabase・OpenAIのスタブサーバー
+
+Supabase（REST・Storage・Auth）とOpenAI（Embedding・Chat）のAPIを、
+遅延を設定できるローカルのHTTPサーバーで置き換える。
+アプリからは実際のクライアント（supabase-py・openai）でHTTP通信するため、
+シリアライズ・コネクションプール・スレッドプールの負荷も含めて測定できる。
+
+REST はベンチマークで使う範囲だけを実装している
+（eq / neq / in / lt / select / order / limit / offset と、match_chunks・replace_file_chunks のRPC）。
+"""
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+import asyncio
+import base64
+import json
+import socket
+import threading
+import time
+import uuid
+import zlib
+import numpy as np
+import uvicorn
+
+
+class SyntheticCorpus:
+    """
+    合成チャンク（正規化済みのランダムなEmbeddingと短い本文）
+
+    Embeddingはブロックごとに生成し、float64の一時配列を作らない
+    """
+
+    BLOCK_ROWS = 65536
+
+    def __init__(self, chunks: int, dim: int, files: int = 100, seed: int = 0):
+        self.dim = dim
+        self.file_ids = [str(uuid.UUID(int=i + 1)) for i in range(files)]
+        self.filenames = {file_id: f"doc-{i}.txt" for i, file_id in enumerate(self.file_ids)}
+        self.chunk_ids = [str(uuid.UUID(int=(1 << 64) + i)) for i in range(chunks)]
+        self.chunk_file_ids = [self.file_ids[i % files] for i in range(chunks)]
+        self.contents = [
+            f"文書{i % files}の第{i}節。製品K{i % 997}の在庫は倉庫{i % 13}にあります。エラーコードE{i % 5003:04d}。"
+            for i in range(chunks)
+        ]
+        rng = np.random.default_rng(seed)
+        self.embeddings = np.empty((chunks, dim), dtype=np.float32)
+        for start in range(0, chunks, self.BLOCK_ROWS):
+            block = rng.standard_normal((min(self.BLOCK_ROWS, chunks - start), dim), dtype=np.float32)
+            block /= np.linalg.norm(block, axis=1, keepdims=True)
+            self.embeddings[start:start + len(block)] = block
+
+    def __len__(self) -> int:
+        return len(self.chunk_ids)
+
+    def match(self, query: List[float], count: int, min_similarity: Optional[float]) -> List[dict]:
+        """match_chunks と同じ形式の上位k件"""
+        if not len(self):
+            return []
+        query = np.asarray(query, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        scores = self.embeddings @ query
+        count = min(count, len(scores))
+        top = np.argpartition(-scores, count - 1)[:count]
+        top = top[np.argsort(-scores[top])]
+        rows = []
+        for i in top.tolist():
+            similarity = float(scores[i])
+            if min_similarity is not None and similarity < min_similarity:
+                break
+            rows.append({
+                "id": self.chunk_ids[i],
+                "file_id": self.chunk_file_ids[i],
+                "filename": self.filenames[self.chunk_file_ids[i]],
+                "content": self.contents[i],
+                "similarity": similarity
+            })
+        return rows
+
+
+def stub_embedding(text: str, dim: int) -> np.ndarray:
+    """テキストごとに決まるランダムなEmbedding（同じテキストは同じベクトル）"""
+    rng = np.random.default_rng(zlib.crc32(text.encode("utf-8")))
+    vector = rng.standard_normal(dim, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def parse_list(value: str) -> List[str]:
+    """PostgRESTの in.(a,"b,c") の中身を分解"""
+    items, current, quoted = [], "", False
+    for char in value.strip("()"):
+        if char == '"':
+            quoted = not quoted
+        elif char == "," and not quoted:
+            items.append(current)
+            current = ""
+        else:
+            current += char
+    if current or items:
+        items.append(current)
+    return items
+
+
+def matches(row: dict, column: str, expression: str) -> bool:
+    operator, _, value = expression.partition(".")
+    actual = row.get(column)
+    text = None if actual is None else str(actual).lower() if isinstance(actual, bool) else str(actual)
+    if operator == "eq":
+        return text == value
+    if operator == "neq":
+        return text != value
+    if operator == "in":
+        return text in parse_list(value)
+    if operator == "lt":
+        return text is not None and text < value.strip('"')
+    if operator == "is":
+        return actual is None if value == "null" else text == value
+    # 未対応の演算子は絞り込まない
+    return True
+
+
+class StubState:
+    """スタブのデータと遅延の設定"""
+
+    # PostgRESTの予約パラメータ（列のフィルターではない）
+    RESERVED_PARAMS = {"select", "order", "limit", "offset", "or", "on_conflict", "columns"}
+
+    def __init__(
+        self,
+        dim: int,
+        supabase_latency: float = 0.0,
+        embedding_latency: float = 0.0,
+        llm_latency: float = 0.0,
+        answer: str = "スタブの回答です。"
+    ):
+        self.dim = dim
+        self.supabase_latency = supabase_latency
+        self.embedding_latency = embedding_latency
+        self.llm_latency = llm_latency
+        self.answer = answer
+        self.tables: Dict[str, List[dict]] = {"catalog_state": [{"id": True, "version": 0}]}
+        self.storage: Dict[str, int] = {}
+        self.corpus: Optional[SyntheticCorpus] = None
+        self.lock = threading.Lock()
+        self.requests: Dict[str, int] = {}
+
+    def count(self, name: str) -> None:
+        with self.lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+
+    def select(self, table: str, params) -> List[dict]:
+        rows = self.tables.get(table, [])
+        for column, expression in params.multi_items():
+            if column in self.RESERVED_PARAMS or "." in column:
+                continue
+            rows = [row for row in rows if matches(row, column, expression)]
+        order = params.get("order")
+        if order:
+            for term in reversed(order.split(",")):
+                column, _, direction = term.partition(".")
+                rows = sorted(rows, key=lambda row: str(row.get(column)), reverse=direction.startswith("desc"))
+        offset = int(params.get("offset", 0))
+        limit = params.get("limit")
+        rows = rows[offset:offset + int(limit)] if limit is not None else rows[offset:]
+        columns = [column.strip() for column in params.get("select", "*").split(",")]
+        if "*" in columns or any("(" in column for column in columns):
+            return [dict(row) for row in rows]
+        return [{column: row.get(column) for column in columns} for row in rows]
+
+    def file_collection(self, file_id: str) -> str:
+        # chunks のコレクションをファイルから設定するトリガー（chunks_collection）の代わり
+        for row in self.tables.get("files", []):
+            if row["id"] == file_id:
+                return row.get("collection") or "default"
+        return "default"
+
+    def bump_catalog(self, table: str) -> None:
+        # catalog_state を進めるトリガーの代わり
+        if table == "files":
+            self.tables["catalog_state"][0]["version"] += 1
+
+
+def build_app(state: StubState) -> Starlette:
+    """スタブのASGIアプリ"""
+
+    async def supabase_delay() -> None:
+        if state.supabase_latency:
+            await asyncio.sleep(state.supabase_latency)
+
+    def prefers_minimal(request: Request) -> bool:
+        return "return=minimal" in request.headers.get("prefer", "")
+
+    async def rest_table(request: Request) -> Response:
+        await supabase_delay()
+        table = request.path_params["table"]
+        state.count(f"rest.{request.method.lower()}.{table}")
+        params = request.query_params
+        # 本文はロックの外で読む（ロック中に await しない）
+        body = await request.body()
+        with state.lock:
+            if request.method == "GET":
+                return JSONResponse(state.select(table, params))
+
+            if request.method == "POST":
+                payload = json.loads(body)
+                inserted = []
+                for row in payload if isinstance(payload, list) else [payload]:
+                    row = dict(row)
+                    row.setdefault("id", str(uuid.uuid4()))
+                    row.setdefault("created_at", now_iso())
+                    if table == "files":
+                        row.setdefault("collection", "default")
+                    elif table == "chunks":
+                        row["collection"] = state.file_collection(row.get("file_id"))
+                    state.tables.setdefault(table, []).append(row)
+                    inserted.append(row)
+                state.bump_catalog(table)
+                if prefers_minimal(request):
+                    return Response(status_code=201)
+                return JSONResponse(inserted, status_code=201)
+
+            target_ids = {row["id"] for row in state.select(table, params)}
+            rows = state.tables.get(table, [])
+            if request.method == "PATCH":
+                changes = json.loads(body)
+                updated = []
+                for row in rows:
+                    if row["id"] in target_ids:
+                        row.update(changes)
+                        updated.append(dict(row))
+                state.bump_catalog(table)
+                return Response(status_code=204) if prefers_minimal(request) else JSONResponse(updated)
+
+            if request.method == "DELETE":
+                deleted = [row for row in rows if row["id"] in target_ids]
+                state.tables[table] = [row for row in rows if row["id"] not in target_ids]
+                if table == "files":
+                    # ON DELETE CASCADE の代わり
+                    state.tables["chunks"] = [
+                        row for row in state.tables.get("chunks", []) if row.get("file_id") not in target_ids
+                    ]
+                state.bump_catalog(table)
+                return Response(status_code=204) if prefers_minimal(request) else JSONResponse(deleted)
+
+        return JSONResponse({"message": "method not allowed"}, status_code=405)
+
+    async def rest_rpc(request: Request) -> Response:
+        await supabase_delay()
+        name = request.path_params["name"]
+        state.count(f"rpc.{name}")
+        params = json.loads(await request.body() or b"{}")
+
+        if name in ("match_chunks", "match_chunks_halfvec"):
+            corpus = state.corpus
+            if corpus is None:
+                return JSONResponse([])
+            rows = await asyncio.to_thread(
+                corpus.match, params["query_embedding"], params.get("match_count", 3), params.get("min_similarity")
+            )
+            return JSONResponse(rows)
+
+        if name == "find_chunk_embeddings":
+            hashes = set(params.get("hashes") or [])
+            with state.lock:
+                found = {}
+                for row in state.tables.get("chunks", []):
+                    if row.get("content_hash") in hashes and row.get("embedding") is not None:
+                        found.setdefault(row["content_hash"], {"content_hash": row["content_hash"], "embedding": row["embedding"]})
+            return JSONResponse(list(found.values()))
+
+        if name == "replace_file_chunks":
+            with state.lock:
+                removed = set(params.get("removed_ids") or [])
+                chunks = state.tables.setdefault("chunks", [])
+                state.tables["chunks"] = chunks = [row for row in chunks if row["id"] not in removed]
+                added = []
+                for item in params.get("added") or []:
+                    row = {"id": str(uuid.uuid4()), "file_id": params["target_file_id"], **item}
+                    row["collection"] = state.file_collection(row["file_id"])
+                    chunks.append(row)
+                    added.append({"id": row["id"], "content_hash": row.get("content_hash")})
+                for row in state.tables.get("files", []):
+                    if row["id"] == params["target_file_id"]:
+                        row["chunk_count"] = sum(1 for chunk in chunks if chunk["file_id"] == row["id"])
+                        for column in ("content_hash", "storage_path", "byte_size"):
+                            if params.get(f"new_{column}") is not None:
+                                row[column] = params[f"new_{column}"]
+                state.bump_catalog("files")
+            return JSONResponse(added)
+
+        return JSONResponse({"message": f"function {name} not found"}, status_code=404)
+
+    async def storage_object(request: Request) -> Response:
+        await supabase_delay()
+        bucket = request.path_params["bucket"]
+        path = request.path_params.get("path", "")
+        state.count(f"storage.{request.method.lower()}")
+        if request.method == "DELETE":
+            prefixes = json.loads(await request.body() or b"{}").get("prefixes", [])
+            with state.lock:
+                removed = [{"name": prefix} for prefix in prefixes if state.storage.pop(f"{bucket}/{prefix}", None) is not None]
+            return JSONResponse(removed)
+        # 内容は保持せずサイズだけ記録する
+        size = 0
+        async for data in request.stream():
+            size += len(data)
+        with state.lock:
+            state.storage[f"{bucket}/{path}"] = size
+        return JSONResponse({"Key": f"{bucket}/{path}", "Id": str(uuid.uuid4())})
+
+    async def auth_user(request: Request) -> Response:
+        await supabase_delay()
+        state.count("auth.user")
+        return JSONResponse({
+            "id": "00000000-0000-0000-0000-000000000001",
+            "aud": "authenticated",
+            "role": "authenticated",
+            "email": "bench@example.com",
+            "app_metadata": {},
+            "user_metadata": {"role": "admin"},
+            "created_at": now_iso()
+        })
+
+    async def embeddings(request: Request) -> Response:
+        body = json.loads(await request.body())
+        if state.embedding_latency:
+            await asyncio.sleep(state.embedding_latency)
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        state.count("openai.embeddings")
+        data = []
+        for i, text in enumerate(texts):
+            vector = stub_embedding(text, state.dim)
+            if body.get("encoding_format") == "base64":
+                embedding = base64.b64encode(vector.astype("<f4").tobytes()).decode("ascii")
+            else:
+                embedding = vector.tolist()
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+        tokens = sum(max(1, len(text) // 2) for text in texts)
+        return JSONResponse({
+            "object": "list",
+            "data": data,
+            "model": body.get("model", ""),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens}
+        })
+
+    async def chat_completions(request: Request) -> Response:
+        body = json.loads(await request.body())
+        state.count("openai.chat")
+        prompt_tokens = sum(len(message.get("content") or "") // 2 for message in body.get("messages", []))
+        completion_tokens = len(state.answer) // 2
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        }
+        base = {"id": f"chatcmpl-{uuid.uuid4().hex}", "created": int(time.time()), "model": body.get("model", "")}
+
+        if not body.get("stream"):
+            if state.llm_latency:
+                await asyncio.sleep(state.llm_latency)
+            return JSONResponse({
+                **base,
+                "object": "chat.completion",
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": state.answer},
+                    "finish_reason": "stop"
+                }],
+                "usage": usage
+            })
+
+        # 遅延を最初のトークンまでと残りに半分ずつ割り当てる
+        parts = [state.answer[i:i + 8] for i in range(0, len(state.answer), 8)]
+
+        async def events():
+            await asyncio.sleep(state.llm_latency / 2)
+            for part in parts:
+                chunk = {**base, "object": "chat.completion.chunk", "choices": [
+                    {"index": 0, "delta": {"content": part}, "finish_reason": None}
+                ]}
+                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+                await asyncio.sleep(state.llm_latency / 2 / len(parts))
+            yield f"data: {json.dumps({**base, 'object': 'chat.completion.chunk', 'choices': [], 'usage': usage})}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return Starlette(routes=[
+        Route("/rest/v1/rpc/{name}", rest_rpc, methods=["POST"]),
+        Route("/rest/v1/{table}", rest_table, methods=["GET", "POST", "PATCH", "DELETE"]),
+        Route("/storage/v1/object/{bucket}/{path:path}", storage_object, methods=["POST", "PUT"]),
+        Route("/storage/v1/object/{bucket}", storage_object, methods=["DELETE"]),
+        Route("/auth/v1/user", auth_user, methods=["GET"]),
+        Route("/v1/embeddings", embeddings, methods=["POST"]),
+        Route("/v1/chat/completions", chat_completions, methods=["POST"]),
+    ])
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class StubServer:
+    """
+    スタブを別スレッドのイベントループで起動する（アプリのイベントループと負荷を分ける）
+
+    例:
+        with StubServer(StubState(dim=1536, llm_latency=0.5)) as server:
+            settings.supabase_url = server.url
+            settings.openai_base_url = f"{server.url}/v1"
+    """
+
+    def __init__(self, state: StubState, port: Optional[int] = None):
+        self.state = state
+        self.port = port or free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self._server = uvicorn.Server(uvicorn.Config(
+            build_app(state),
+            host="127.0.0.1",
+            port=self.port,
+            log_level="warning",
+            access_log=False,
+            lifespan="off"
+        ))
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> "StubServer":
+        self._thread = threading.Thread(target=self._server.run, name="stub-server", daemon=True)
+        self._thread.start()
+        deadline = time.monotonic() + 10
+        while not self._server.started:
+            if time.monotonic() > deadline or not self._thread.is_alive():
+                raise RuntimeError("スタブサーバーを起動できませんでした")
+            time.sleep(0.01)
+        return self
+
+    def stop(self) -> None:
+        self._server.should_exit = True
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+
+    def __enter__(self) -> "StubServer":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
@@ -1,12 +1,23 @@
 """
 Smallbase MVP - FastAPI アプリケーション
 """
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, PlainTextResponse
 from dotenv import load_dotenv
+from contextlib import asynccontextmanager
 from routers import auth, admin, chat
+from config import settings
+from supabase_client import init_supabase_clients, close_supabase_clients
+from openai_client import init_openai_client, close_openai_client
+from utils.ingestion import start_ingestion_queue, stop_ingestion_queue
+from utils.text_extractor import shutdown_extraction_pool
+from utils.chunk_store import close_postgres_connections
+from utils.store import close_store
+from utils.uploads import UploadSizeLimitMiddleware
+from utils.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, TimingMiddleware, render_metrics
+import hmac
 import os
 
 # 環境変数の読み込み
@@ -20,10 +31,26 @@ else:
     # デフォルト値（開発環境用）
     cors_origins = ["http://localhost:3000", "http://localhost:8080", "http://localhost:8001"]
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """外部APIクライアントと取り込みワーカーを起動時に生成し、終了時に停止する（抽出用プロセスプールは初回使用時に起動）"""
+    init_supabase_clients()
+    init_openai_client()
+    await start_ingestion_queue()
+    yield
+    await stop_ingestion_queue()
+    shutdown_extraction_pool()
+    close_postgres_connections()
+    close_store()
+    await close_openai_client()
+    close_supabase_clients()
+
+
 app = FastAPI(
     title="Smallbase MVP API",
     description="管理者画面付き・最小RAG構成のAPI",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # CORS設定
@@ -33,8 +60,20 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # ファイル一覧のページング・キャッシュ用
+    expose_headers=["ETag", "X-Next-Cursor", "Link", "Server-Timing"],
 )
 
+# 処理段階ごとの所要時間（Server-Timing ヘッダーと /metrics）
+app.add_middleware(TimingMiddleware)
+
+# 上限を超えるアップロードは本文を読む前に拒否
+app.add_middleware(UploadSizeLimitMiddleware, limits={
+    "/admin/upload": settings.max_upload_bytes,
+    "/admin/files/": settings.max_upload_bytes,
+    "/admin/upload/bulk": settings.max_bulk_upload_bytes,
+})
+
 # 静的ファイル配信（フロントエンド）
 frontend_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "frontend")
 if os.path.exists(frontend_path):
@@ -52,6 +91,18 @@ async def health():
     return {"status": "healthy"}
 
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics(request: Request):
+    """段階ごとの所要時間・トークン使用量・走査チャンク数・バッチ件数（Prometheus形式）"""
+    if not settings.metrics_enabled:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if settings.metrics_token:
+        authorization = request.headers.get("authorization", "")
+        if not hmac.compare_digest(authorization, f"Bearer {settings.metrics_token}"):
+            raise HTTPException(status_code=401, detail="認証が必要です")
+    return PlainTextResponse(render_metrics(), media_type=METRICS_CONTENT_TYPE)
+
+
 # フロントエンドルート
 @app.get("/")
 async def root_page():
@@ -0,0 +1,73 @@
+"""
+OpenAIクライアント設定
+
+クライアントはプロセスで1つだけ生成し、HTTPコネクションプールを再利用する。
+生成と破棄は main.py の lifespan で行う。
+
+openai はバージョンによって内部のHTTPライブラリが異なる（httpx / httpx2）ため、
+コネクションプールの上限とタイムアウトは openai 側の型で作る
+（supabase_client の httpx の型を渡すと、リクエスト時に型エラーになる）。
+"""
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, Timeout
+from openai._constants import DEFAULT_CONNECTION_LIMITS
+from config import settings
+from typing import Any, Optional
+import threading
+
+
+_async_client: Optional[AsyncOpenAI] = None
+_lock = threading.Lock()
+
+
+def build_openai_limits() -> Any:
+    """設定からコネクションプールの上限を作成（openai の既定値と同じHTTPライブラリの Limits）"""
+    return type(DEFAULT_CONNECTION_LIMITS)(
+        max_connections=settings.http_pool_size,
+        max_keepalive_connections=settings.http_keepalive_connections,
+        keepalive_expiry=settings.http_keepalive_seconds
+    )
+
+
+def build_openai_timeout() -> Timeout:
+    """設定からタイムアウトを作成"""
+    return Timeout(
+        settings.http_timeout_seconds,
+        connect=settings.http_connect_timeout_seconds
+    )
+
+
+def get_async_openai_client() -> AsyncOpenAI:
+    """
+    OpenAIクライアントを取得（プロセス共通・非同期版）
+
+    呼び出しを await するため、応答待ちの間もイベントループをブロックしない
+    """
+    global _async_client
+    if _async_client is None:
+        with _lock:
+            if _async_client is None:
+                _async_client = AsyncOpenAI(
+                    api_key=settings.openai_api_key,
+                    base_url=settings.openai_base_url or None,
+                    http_client=DefaultAsyncHttpxClient(
+                        limits=build_openai_limits(),
+                        timeout=build_openai_timeout()
+                    )
+                )
+    return _async_client
+
+
+def init_openai_client() -> None:
+    """起動時にクライアントを生成"""
+    if settings.openai_api_key:
+        get_async_openai_client()
+
+
+async def close_openai_client() -> None:
+    """終了時にコネクションプールを閉じる"""
+    global _async_client
+    with _lock:
+        async_client = _async_client
+        _async_client = None
+    if async_client is not None:
+        await async_client.close()
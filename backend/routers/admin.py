@@ -1,15 +1,36 @@
 """
 管理者APIルーター
 """
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, UploadFile, File
+from typing import List, Optional, Tuple
 from pydantic import BaseModel
-from datetime import datetime
+from datetime import datetime, timezone
 from auth import verify_admin
-from supabase_client import get_supabase_client, get_supabase_service_client
-from utils.text_extractor import extract_text, split_into_chunks
-from utils.embedding import generate_embeddings_batch
+from utils.store import Store, require_store
+from utils.embedding_cache import get_embedding_cache
+from utils.answer_cache import get_answer_cache
+from utils.collection import DEFAULT_COLLECTION, UnknownCollectionError, collection_query
+from utils.vector_index import get_vector_index
+from utils.concurrency import run_blocking
+from utils.metrics import span
+from utils.bulk_ingestion import BulkIngestionJob, ingest_bulk, is_zip
+from utils.uploads import SpooledUpload, UploadTooLargeError, remove_spooled, spool_upload
+from utils.ingestion import (
+    FILE_STATUS_FAILED,
+    FILE_STATUS_PROCESSING,
+    FILE_STATUS_READY,
+    FILE_STATUS_UPDATING,
+    IngestionJob,
+    QueueFullError,
+    finish_update,
+    get_ingestion_queue,
+    ingest_file,
+    reingest_file,
+)
 import asyncio
+import base64
+import hashlib
+import json
 import uuid
 import os
 
@@ -18,17 +39,82 @@ router = APIRouter(prefix="/admin", tags=["管理者"])
 
 
 class FileResponse(BaseModel):
-    """ファイル情報レスポンス"""
+    """ファイル情報レスポンス（fields で列を絞った場合、選ばなかった項目は含まない）"""
     id: str
-    filename: str
+    filename: Optional[str] = None
     created_at: datetime
+    # 取り込み状態（processing: 取り込み中, ready: 検索対象, updating: 差分取り込み中（旧版が検索対象）,
+    # failed: サーバーの停止で取り込みが中断された）
+    status: str = "ready"
+    # チャンク数・ファイルサイズ（取り込み時に記録。記録前の行はNone）
+    chunk_count: Optional[int] = None
+    byte_size: Optional[int] = None
 
 
 class UploadResponse(BaseModel):
-    """アップロードレスポンス"""
+    """アップロード・更新レスポンス（取り込みはバックグラウンドで実行）"""
     id: str
     filename: str
     status: str
+    # 内容が変わらず取り込み不要だった場合はNone
+    job_id: Optional[str] = None
+
+
+class JobResponse(BaseModel):
+    """取り込みジョブの状態"""
+    id: str
+    file_id: str
+    filename: str
+    stage: str
+    progress: float
+    chunks_total: int
+    chunks_done: int
+    chunks_reused: int = 0
+    chunks_removed: int = 0
+    collection: str = DEFAULT_COLLECTION
+    error: Optional[str] = None
+    created_at: datetime
+    updated_at: datetime
+
+
+class BulkUploadResponse(BaseModel):
+    """一括アップロードレスポンス（取り込みはバックグラウンドで実行）"""
+    job_id: str
+    # 受け付けたアップロード数（ZIPは1件として数える）
+    uploads: int
+    status: str
+
+
+class BulkFileResponse(BaseModel):
+    """一括取り込みのファイルごとの結果"""
+    filename: str
+    file_id: Optional[str] = None
+    # queued / registering / extracting / embedding / storing / completed / failed / skipped
+    stage: str
+    chunks: int = 0
+    chunks_reused: int = 0
+    error: Optional[str] = None
+
+
+class BulkJobResponse(BaseModel):
+    """一括取り込みジョブの状態"""
+    id: str
+    stage: str
+    progress: float
+    files: List[BulkFileResponse]
+    docs_total: int
+    docs_done: int
+    docs_failed: int
+    docs_skipped: int
+    chunks_done: int
+    # 取り込み開始からの経過時間と平均スループット（完了時に確定）
+    elapsed_seconds: Optional[float] = None
+    docs_per_second: float = 0.0
+    chunks_per_second: float = 0.0
+    collection: str = DEFAULT_COLLECTION
+    error: Optional[str] = None
+    created_at: datetime
+    updated_at: datetime
 
 
 class DeleteResponse(BaseModel):
@@ -37,36 +123,149 @@ class DeleteResponse(BaseModel):
     id: str
 
 
-@router.get("/files", response_model=List[FileResponse])
+class CollectionResponse(BaseModel):
+    """コレクション（ファイルが1件以上あるもの）"""
+    collection: str
+    file_count: int
+    # 取り込み済みのファイルのチャンク数の合計
+    chunk_count: int
+
+
+# ファイル一覧で選べる列（id と created_at はカーソルに使うため常に含める）
+FILE_LIST_FIELDS = ("id", "filename", "created_at", "status", "chunk_count", "byte_size")
+FILE_LIST_REQUIRED_FIELDS = ("id", "created_at")
+
+
+def encode_file_cursor(row: dict) -> str:
+    """一覧の最後の行から次ページのカーソルを作る"""
+    raw = json.dumps([row["created_at"], row["id"]], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_file_cursor(cursor: str) -> Tuple[str, str]:
+    """
+    カーソルを (created_at, id) に戻す
+
+    Raises:
+        HTTPException: カーソルが不正な場合（400）
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, file_id = json.loads(raw)
+        datetime.fromisoformat(created_at.replace("Z", "+00:00"))
+        return created_at, str(uuid.UUID(file_id))
+    except Exception:
+        raise HTTPException(
+            status_code=400,
+            detail="cursorが不正です"
+        )
+
+
+def parse_file_fields(fields: Optional[str]) -> List[str]:
+    """
+    fields（カンマ区切り）を取得する列のリストにする
+
+    Raises:
+        HTTPException: 選べない列を含む場合（400）
+    """
+    if not fields:
+        return list(FILE_LIST_FIELDS)
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in requested if field not in FILE_LIST_FIELDS]
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"指定できない項目です: {', '.join(unknown)}（指定可能: {', '.join(FILE_LIST_FIELDS)}）"
+        )
+    return [field for field in FILE_LIST_FIELDS if field in FILE_LIST_REQUIRED_FIELDS or field in requested]
+
+
+async def fetch_catalog_version(store: Store) -> Optional[int]:
+    """ファイル一覧のバージョンを取得（catalog_state がない場合はNone）"""
+    try:
+        return await run_blocking(store.catalog_version)
+    except Exception as e:
+        print(f"警告: ファイル一覧のバージョンを取得できませんでした: {str(e)}")
+        return None
+
+
+def file_list_etag(version: int, collection: str, limit: int, cursor: Optional[str], columns: List[str]) -> str:
+    """一覧のバージョンと取得条件からETagを作る"""
+    key = f"{version}|{collection}|{limit}|{cursor or ''}|{','.join(columns)}"
+    return '"' + hashlib.sha256(key.encode("utf-8")).hexdigest()[:32] + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+@router.get("/files", response_model=List[FileResponse], response_model_exclude_unset=True)
 async def get_files(
-    user: dict = Depends(verify_admin)
+    request: Request,
+    response: Response,
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    collection: str = Depends(collection_query),
+    user: dict = Depends(verify_admin),
+    store: Store = Depends(require_store)
 ):
     """
-    ファイル一覧取得
-    
+    コレクションのファイル一覧取得（新しい順、カーソルでページング）
+
+    次のページがある場合は X-Next-Cursor ヘッダー（と Link: rel="next"）にカーソルを返す。
+    ETag は一覧のバージョン（filesの追加・更新・削除で進む）から作るため、
+    変更がなければ If-None-Match に 304 を返し、一覧は取得しない。
+
     Args:
+        request: リクエスト
+        response: レスポンス（ヘッダーの設定に使用）
+        limit: 1ページの件数（1〜500）
+        cursor: 前のページの X-Next-Cursor（未指定時は先頭から）
+        fields: 取得する項目（カンマ区切り。id, filename, created_at, status, chunk_count, byte_size）
+        collection: コレクション（未指定時は default）
         user: 認証済みユーザー情報（管理者のみ）
+        store: 保存先
         
     Returns:
         ファイル一覧
     """
+    columns = parse_file_fields(fields)
+    after = decode_file_cursor(cursor) if cursor else None
+
     try:
-        # サービスロールキーを使用してRLSをバイパス
-        supabase = get_supabase_service_client()
-        
-        # filesテーブルから全件取得
-        response = supabase.table("files").select("*").order("created_at", desc=True).execute()
-        
+        version = await fetch_catalog_version(store)
+        etag = file_list_etag(version, collection, limit, cursor, columns) if version is not None else None
+        if etag is not None:
+            headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+            if etag_matches(request.headers.get("if-none-match"), etag):
+                return Response(status_code=304, headers=headers)
+            response.headers.update(headers)
+
+        # (created_at, id) の降順。次のページの有無を知るため1件多く取得する
+        rows = await run_blocking(store.list_files, columns, limit + 1, after, collection)
+
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_file_cursor(rows[-1])
+            response.headers["X-Next-Cursor"] = next_cursor
+            response.headers["Link"] = f'<{request.url.include_query_params(cursor=next_cursor)}>; rel="next"'
+
         files = []
-        for row in response.data:
-            files.append(FileResponse(
-                id=row["id"],
-                filename=row["filename"],
-                created_at=datetime.fromisoformat(row["created_at"].replace("Z", "+00:00"))
-            ))
+        for row in rows:
+            values = {column: row.get(column) for column in columns}
+            values["created_at"] = datetime.fromisoformat(row["created_at"].replace("Z", "+00:00"))
+            if "status" in values:
+                values["status"] = values["status"] or "ready"
+            files.append(FileResponse(**values))
         
         return files
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=500,
@@ -74,20 +273,132 @@ async def get_files(
         )
 
 
-@router.post("/upload", response_model=UploadResponse)
+@router.get("/collections", response_model=List[CollectionResponse])
+async def get_collections(
+    user: dict = Depends(verify_admin),
+    store: Store = Depends(require_store)
+):
+    """
+    コレクション一覧取得（ファイルが1件以上あるコレクション。名前の昇順）
+
+    Args:
+        user: 認証済みユーザー情報（管理者のみ）
+        store: 保存先
+
+    Returns:
+        コレクションごとのファイル数・チャンク数
+    """
+    try:
+        rows = await run_blocking(store.list_collections)
+        return [
+            CollectionResponse(
+                collection=row["collection"],
+                file_count=int(row.get("file_count") or 0),
+                chunk_count=int(row.get("chunk_count") or 0)
+            )
+            for row in rows
+        ]
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"コレクション一覧の取得に失敗しました: {str(e)}"
+        )
+
+
+def file_in_collection(row: Optional[dict], collection: str) -> bool:
+    """ファイルが存在し、指定したコレクションに属するか（collection 列のない古い行は default）"""
+    return row is not None and (row.get("collection") or DEFAULT_COLLECTION) == collection
+
+
+def stored_path(row: dict) -> str:
+    """ファイル情報からStorage上のパスを取得（storage_path がない古い行は files/{filename}）"""
+    return row.get("storage_path") or f"files/{row['filename']}"
+
+
+async def spool_or_reject(file: UploadFile, max_bytes: Optional[int] = None) -> SpooledUpload:
+    """アップロードを一時ファイルに書き出す（上限超過は413）"""
+    try:
+        return await spool_upload(file, max_bytes=max_bytes)
+    except UploadTooLargeError as e:
+        raise HTTPException(
+            status_code=413,
+            detail=str(e)
+        )
+
+
+async def reject_duplicate_content(
+    store: Store,
+    spooled: SpooledUpload,
+    collection: str,
+    exclude_file_id: Optional[str] = None
+) -> None:
+    """
+    同じコレクションに同じ内容のファイルが既にあれば400
+
+    Args:
+        store: 保存先
+        spooled: 一時ファイルの情報
+        collection: コレクション
+        exclude_file_id: 比較対象から除くファイルID（更新時の自分自身）
+    """
+    same_content = await run_blocking(
+        store.find_file,
+        content_hash=spooled.content_hash,
+        exclude_id=exclude_file_id,
+        collection=collection
+    )
+    if same_content:
+        raise HTTPException(
+            status_code=400,
+            detail=f"同じ内容のファイル「{same_content['filename']}」が既にアップロードされています。"
+        )
+
+
+async def store_spooled(store: Store, spooled: SpooledUpload, filename: str) -> str:
+    """
+    一時ファイルを保存先（Supabase Storageまたはローカルのファイル）にアップロード
+
+    Args:
+        store: 保存先
+        spooled: 一時ファイルの情報
+        filename: 元のファイル名（拡張子を保持する）
+
+    Returns:
+        Storage上のパス
+    """
+    # ファイル名をUUIDベースの安全な名前に変換（拡張子は保持）
+    file_ext = os.path.splitext(filename)[1]  # 拡張子を取得
+    safe_filename = f"{uuid.uuid4()}{file_ext}"  # UUID + 拡張子
+    storage_path = f"files/{safe_filename}"
+    try:
+        # 既に存在する場合は上書きされる
+        await run_blocking(store.upload_object, storage_path, spooled)
+    except Exception as storage_error:
+        raise HTTPException(
+            status_code=500,
+            detail=f"ファイルのアップロードに失敗しました: {str(storage_error)}"
+        )
+    return storage_path
+
+
+@router.post("/upload", response_model=UploadResponse, status_code=202)
 async def upload_file(
     file: UploadFile = File(...),
-    user: dict = Depends(verify_admin)
+    collection: str = Depends(collection_query),
+    user: dict = Depends(verify_admin),
+    store: Store = Depends(require_store)
 ):
     """
     ファイルアップロード
     
     Args:
         file: アップロードファイル
+        collection: 登録先のコレクション（未指定時は default。初めての名前なら新しく作られる）
         user: 認証済みユーザー情報（管理者のみ）
+        store: 保存先
         
     Returns:
-        アップロード結果
+        アップロード結果（202: 取り込みジョブを登録済み。進捗は /admin/jobs/{job_id} で確認）
     """
     # ファイル形式チェック
     allowed_extensions = {".pdf", ".txt", ".docx"}
@@ -100,147 +411,96 @@ async def upload_file(
         )
     
     try:
-        supabase_service = get_supabase_service_client()
-        
-        # デバッグ: サービスロールキーが設定されているか確認
+        # サービスロールキーが設定されているか確認
         from config import settings
-        if not settings.supabase_service_key:
+        if store.name == "supabase" and not settings.supabase_service_key:
             raise HTTPException(
                 status_code=500,
                 detail="SUPABASE_SERVICE_KEYが設定されていません。.envファイルを確認してください。"
             )
         
-        # ファイル内容を読み込み
-        file_content = await file.read()
-        
-        # 重複チェック: 同じファイル名が既に存在するか確認
-        existing_files = supabase_service.table("files").select("id, filename").eq("filename", file.filename).execute()
-        if existing_files.data:
+        # 重複チェック: 同じコレクションに同じファイル名が既に存在するか確認
+        with span("filename_check"):
+            existing_file = await run_blocking(store.find_file, filename=file.filename, collection=collection)
+        if existing_file:
             raise HTTPException(
                 status_code=400,
                 detail=f"同じファイル名「{file.filename}」が既にアップロードされています。"
             )
         
-        # Supabase Storageにアップロード
-        # ファイル名をUUIDベースの安全な名前に変換（拡張子は保持）
-        file_ext = os.path.splitext(file.filename)[1]  # 拡張子を取得
-        safe_filename = f"{uuid.uuid4()}{file_ext}"  # UUID + 拡張子
-        storage_path = f"files/{safe_filename}"
-        try:
-            storage_response = supabase_service.storage.from_("files").upload(
-                storage_path,
-                file_content,
-                file_options={"content-type": file.content_type or "application/octet-stream"}
-            )
-            # レスポンスの確認（エラーがある場合は例外が発生する）
-        except Exception as storage_error:
-            # Storageアップロードエラーをキャッチ
-            error_msg = str(storage_error)
-            # 既に存在する場合は上書きを試みる
-            if "duplicate" in error_msg.lower() or "already exists" in error_msg.lower():
-                try:
-                    supabase_service.storage.from_("files").update(
-                        storage_path,
-                        file_content,
-                        file_options={"content-type": file.content_type or "application/octet-stream"}
-                    )
-                except Exception as update_error:
-                    raise HTTPException(
-                        status_code=500,
-                        detail=f"ファイルのアップロードに失敗しました: {str(update_error)}"
-                    )
-            else:
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"ファイルのアップロードに失敗しました: {error_msg}"
-                )
+        # ファイル内容を一定サイズずつ一時ファイルに書き出す（全体をメモリに載せない）
+        with span("spool"):
+            spooled = await spool_or_reject(file)
         
-        # テキスト抽出
+        # 重複チェック: 名前が違っても内容が同じファイルは取り込まない
+        # 保存先にアップロード（一時ファイルから少しずつ送信）
         try:
-            text = extract_text(file_content, file.filename)
-            if not text:
-                raise HTTPException(
-                    status_code=400,
-                    detail="ファイルからテキストを抽出できませんでした"
-                )
-        except ValueError as e:
-            raise HTTPException(
-                status_code=400,
-                detail=str(e)
-            )
-        
-        # チャンク分割
-        chunks = split_into_chunks(text, chunk_size=500, overlap=100)
-        if not chunks:
-            raise HTTPException(
-                status_code=400,
-                detail="チャンク分割に失敗しました"
-            )
+            with span("content_check"):
+                await reject_duplicate_content(store, spooled, collection)
+            with span("storage_upload"):
+                storage_path = await store_spooled(store, spooled, file.filename)
+        except BaseException:
+            remove_spooled(spooled.path)
+            raise
         
         # データベースにファイル情報を保存（サービスロールキーを使用してRLSをバイパス）
+        # 取り込みが完了するまでは status=processing として検索対象から外す
         try:
-            db_response = supabase_service.table("files").insert({
-                "filename": file.filename
-            }).execute()
+            with span("db_insert"):
+                file_row = await run_blocking(store.insert_file, {
+                    "filename": file.filename,
+                    "status": FILE_STATUS_PROCESSING,
+                    "content_hash": spooled.content_hash,
+                    "storage_path": storage_path,
+                    "byte_size": spooled.size,
+                    "collection": collection
+                })
         except Exception as e:
-            # エラーの詳細をログ出力
-            print(f"DEBUG - ファイル挿入エラー: {str(e)}")
-            print(f"DEBUG - エラータイプ: {type(e)}")
-            raise HTTPException(
-                status_code=500,
-                detail=f"ファイル情報の保存に失敗しました: {str(e)}"
-            )
+            file_row = None
+            insert_error = f"ファイル情報の保存に失敗しました: {str(e)}"
+        else:
+            insert_error = "ファイル情報の保存に失敗しました"
         
-        if not db_response.data:
+        if not file_row:
             # データベース保存に失敗した場合、Storageからも削除
             try:
-                supabase_service.storage.from_("files").remove([storage_path])
+                await run_blocking(store.remove_objects, [storage_path])
             except:
                 pass
+            remove_spooled(spooled.path)
             raise HTTPException(
                 status_code=500,
-                detail="ファイル情報の保存に失敗しました"
+                detail=insert_error
             )
         
-        file_id = db_response.data[0]["id"]
+        file_id = file_row["id"]
         
-        # Embedding生成と保存（非同期で実行）
+        # 抽出・チャンク分割・Embedding生成・保存はバックグラウンドで実行
+        # （一時ファイルはジョブの終了時に削除される）
+        job = IngestionJob(file_id=file_id, filename=file.filename, collection=collection)
         try:
-            # Embeddingを一括生成
-            embeddings = generate_embeddings_batch(chunks)
-            
-            # チャンクとEmbeddingをデータベースに保存
-            chunks_data = []
-            for i, (chunk, embedding) in enumerate(zip(chunks, embeddings)):
-                chunks_data.append({
-                    "file_id": file_id,
-                    "content": chunk,
-                    "embedding": embedding
-                })
-            
-            # バッチで挿入（Supabaseの制限を考慮して100件ずつ）
-            # サービスロールキーを使用してRLSをバイパス
-            batch_size = 100
-            for i in range(0, len(chunks_data), batch_size):
-                batch = chunks_data[i:i + batch_size]
-                supabase_service.table("chunks").insert(batch).execute()
-            
-        except Exception as e:
-            # Embedding生成に失敗した場合、ファイルとチャンクを削除
+            with span("enqueue"):
+                await get_ingestion_queue().submit(
+                    job,
+                    lambda queued: ingest_file(queued, store, spooled.path, storage_path)
+                )
+        except QueueFullError as e:
             try:
-                supabase_service.table("files").delete().eq("id", file_id).execute()
-                supabase_service.storage.from_("files").remove([storage_path])
+                await run_blocking(store.delete_file, file_id)
+                await run_blocking(store.remove_objects, [storage_path])
             except:
                 pass
+            remove_spooled(spooled.path)
             raise HTTPException(
-                status_code=500,
-                detail=f"Embedding生成・保存に失敗しました: {str(e)}"
+                status_code=503,
+                detail=str(e)
             )
         
         return UploadResponse(
             id=file_id,
             filename=file.filename,
-            status="success"
+            status=job.stage,
+            job_id=job.id
         )
         
     except HTTPException:
@@ -252,43 +512,230 @@ async def upload_file(
         )
 
 
+@router.post("/upload/bulk", response_model=BulkUploadResponse, status_code=202)
+async def upload_files_bulk(
+    files: List[UploadFile] = File(...),
+    collection: str = Depends(collection_query),
+    user: dict = Depends(verify_admin),
+    store: Store = Depends(require_store)
+):
+    """
+    複数ファイル・ZIPの一括アップロード
+
+    ZIPは展開して中の PDF / TXT / DOCX を取り込む（その他の形式は skipped として結果に残す）。
+    ファイルごとの重複チェック・取り込みはバックグラウンドのジョブで行い、
+    失敗したファイルがあっても残りのファイルの取り込みは続ける。
+
+    Args:
+        files: アップロードファイル（ZIPを含めてよい）
+        collection: 登録先のコレクション（未指定時は default）
+        user: 認証済みユーザー情報（管理者のみ）
+        store: 保存先
+
+    Returns:
+        202: 取り込みジョブを登録済み。ファイルごとの結果とスループットは /admin/bulk-jobs/{job_id} で確認
+    """
+    from config import settings
+    if store.name == "supabase" and not settings.supabase_service_key:
+        raise HTTPException(
+            status_code=500,
+            detail="SUPABASE_SERVICE_KEYが設定されていません。.envファイルを確認してください。"
+        )
+
+    # 各ファイルを一時ファイルに書き出す（ZIPは MAX_BULK_UPLOAD_BYTES まで）
+    uploads = []
+    try:
+        for file in files:
+            max_bytes = settings.max_bulk_upload_bytes if is_zip(file.filename) else None
+            uploads.append((file.filename, await spool_or_reject(file, max_bytes)))
+    except BaseException:
+        for _, spooled in uploads:
+            remove_spooled(spooled.path)
+        raise
+
+    # 一時ファイルはジョブの終了時に削除される
+    job = BulkIngestionJob(collection=collection)
+    try:
+        await get_ingestion_queue().submit(
+            job,
+            lambda queued: ingest_bulk(queued, store, uploads)
+        )
+    except QueueFullError as e:
+        for _, spooled in uploads:
+            remove_spooled(spooled.path)
+        raise HTTPException(
+            status_code=503,
+            detail=str(e)
+        )
+
+    return BulkUploadResponse(
+        job_id=job.id,
+        uploads=len(uploads),
+        status=job.stage
+    )
+
+
+@router.put("/files/{file_id}", response_model=UploadResponse, status_code=202)
+async def update_file(
+    file_id: str,
+    file: UploadFile = File(...),
+    collection: str = Depends(collection_query),
+    user: dict = Depends(verify_admin),
+    store: Store = Depends(require_store)
+):
+    """
+    ファイル更新（差分取り込み）
+
+    新しい版をチャンク分割し、変更のあったチャンクだけEmbeddingを生成して差し替える。
+    差し替えが完了するまでは旧版が検索対象のまま残る。
+    内容が変わっていない場合はジョブを登録せず status=unchanged を返す。
+
+    Args:
+        file_id: ファイルID
+        file: 新しい版のファイル（拡張子は元のファイルと同じであること）
+        collection: ファイルの属するコレクション（他のコレクションのファイルは404）
+        user: 認証済みユーザー情報（管理者のみ）
+        store: 保存先
+
+    Returns:
+        更新結果（202: 取り込みジョブを登録済み。進捗は /admin/jobs/{job_id} で確認）
+    """
+    try:
+        row = await run_blocking(store.get_file, file_id)
+        if not file_in_collection(row, collection):
+            raise HTTPException(
+                status_code=404,
+                detail="ファイルが見つかりません"
+            )
+        
+        # ファイル形式チェック（抽出方法が変わらないよう、元のファイルと同じ拡張子に限る）
+        if os.path.splitext(file.filename)[1].lower() != os.path.splitext(row["filename"])[1].lower():
+            raise HTTPException(
+                status_code=400,
+                detail=f"元のファイル「{row['filename']}」と同じ形式のファイルを指定してください。"
+            )
+        
+        # ready → updating を条件付きで変更し、同じファイルの更新を1つだけ通す（取り込み中・更新中は409）
+        claimed = await run_blocking(store.update_file_status, file_id, FILE_STATUS_UPDATING, FILE_STATUS_READY)
+        if claimed is None:
+            if row.get("status") == FILE_STATUS_FAILED:
+                raise HTTPException(
+                    status_code=409,
+                    detail="このファイルは取り込みに失敗しています。削除してからアップロードし直してください。"
+                )
+            raise HTTPException(
+                status_code=409,
+                detail="このファイルは取り込み中または更新中です。完了してから更新してください。"
+            )
+        # 読み込んだ後に終わった更新があっても、変更後の行（最新の版）と比較する
+        row = claimed
+        
+        submitted = False
+        try:
+            spooled = await spool_or_reject(file)
+            if spooled.content_hash == row.get("content_hash"):
+                remove_spooled(spooled.path)
+                return UploadResponse(
+                    id=file_id,
+                    filename=row["filename"],
+                    status="unchanged",
+                    job_id=None
+                )
+            
+            try:
+                await reject_duplicate_content(store, spooled, collection, exclude_file_id=file_id)
+                storage_path = await store_spooled(store, spooled, row["filename"])
+            except BaseException:
+                remove_spooled(spooled.path)
+                raise
+            
+            # 差分の取り込みはバックグラウンドで実行（一時ファイルはジョブの終了時に削除される）
+            job = IngestionJob(file_id=file_id, filename=row["filename"], collection=collection)
+            try:
+                await get_ingestion_queue().submit(
+                    job,
+                    lambda queued: reingest_file(
+                        queued,
+                        store,
+                        spooled.path,
+                        storage_path,
+                        spooled.content_hash,
+                        previous_storage_path=stored_path(row),
+                        byte_size=spooled.size
+                    )
+                )
+            except QueueFullError as e:
+                try:
+                    await run_blocking(store.remove_objects, [storage_path])
+                except:
+                    pass
+                remove_spooled(spooled.path)
+                raise HTTPException(
+                    status_code=503,
+                    detail=str(e)
+                )
+            submitted = True
+        finally:
+            # ジョブを登録しなかった場合はここで ready に戻す（登録した場合はジョブの終了時に戻る）
+            if not submitted:
+                await finish_update(store, file_id)
+        
+        return UploadResponse(
+            id=file_id,
+            filename=row["filename"],
+            status=job.stage,
+            job_id=job.id
+        )
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"ファイルの更新処理でエラーが発生しました: {str(e)}"
+        )
+
+
 @router.delete("/files/{file_id}", response_model=DeleteResponse)
 async def delete_file(
     file_id: str,
-    user: dict = Depends(verify_admin)
+    collection: str = Depends(collection_query),
+    user: dict = Depends(verify_admin),
+    store: Store = Depends(require_store)
 ):
     """
     ファイル削除
     
     Args:
         file_id: ファイルID
+        collection: ファイルの属するコレクション（他のコレクションのファイルは404）
         user: 認証済みユーザー情報（管理者のみ）
+        store: 保存先
         
     Returns:
         削除結果
     """
     try:
-        supabase_service = get_supabase_service_client()
-        
         # ファイル情報を取得
-        file_response = supabase_service.table("files").select("*").eq("id", file_id).execute()
+        file_row = await run_blocking(store.get_file, file_id)
         
-        if not file_response.data:
+        if not file_in_collection(file_row, collection):
             raise HTTPException(
                 status_code=404,
                 detail="ファイルが見つかりません"
             )
         
-        filename = file_response.data[0]["filename"]
-        storage_path = f"files/{filename}"
+        storage_path = stored_path(file_row)
         
         # データベースから削除（CASCADEでchunksも自動削除）
-        # サービスロールキーを使用してRLSをバイパス
-        delete_response = supabase_service.table("files").delete().eq("id", file_id).execute()
+        await run_blocking(store.delete_file, file_id)
+        
+        # インメモリインデックスからも削除
+        await run_blocking(get_vector_index(collection).remove_file, file_id)
         
         # Storageからも削除
         try:
-            supabase_service.storage.from_("files").remove([storage_path])
+            await run_blocking(store.remove_objects, [storage_path])
         except Exception as e:
             # Storage削除に失敗してもデータベース削除は完了しているので警告のみ
             print(f"警告: Storageからのファイル削除に失敗しました: {str(e)}")
@@ -306,3 +753,144 @@ async def delete_file(
             detail=f"ファイルの削除処理でエラーが発生しました: {str(e)}"
         )
 
+
+
+@router.get("/cache/stats")
+async def get_cache_stats(
+    user: dict = Depends(verify_admin)
+):
+    """
+    キャッシュのヒット・ミス統計を取得
+    
+    Args:
+        user: 認証済みユーザー情報（管理者のみ）
+        
+    Returns:
+        キャッシュ種別ごとの統計
+    """
+    return {
+        "embedding": get_embedding_cache().stats(),
+        "answer": get_answer_cache().stats()
+    }
+
+
+@router.get("/index/stats")
+async def get_index_stats(
+    recall_sample: int = 0,
+    collection: str = Depends(collection_query),
+    user: dict = Depends(verify_admin),
+    store: Store = Depends(require_store)
+):
+    """
+    コレクションのインメモリインデックスのメモリ使用量と、量子化した検索の再現率を取得
+
+    Args:
+        recall_sample: 再現率の測定に使う質問数（0の場合は測定しない。登録済みのチャンクに雑音を加えて作る）
+        collection: コレクション（未指定時は default）
+        user: 認証済みユーザー情報（管理者のみ）
+        store: 保存先
+
+    Returns:
+        チャンク数・量子化方式・行列のバイト数（と再現率）
+        
+    Raises:
+        HTTPException: コレクションにファイルがない場合（404）
+    """
+    try:
+        index = await run_blocking(get_vector_index, collection, store)
+    except UnknownCollectionError as e:
+        raise HTTPException(
+            status_code=404,
+            detail=str(e)
+        )
+    await run_blocking(index.ensure_fresh, store)
+    stats = index.memory_stats()
+    if recall_sample > 0:
+        stats["recall"] = await run_blocking(index.measure_recall, sample=min(recall_sample, 1000))
+    return stats
+
+
+@router.get("/jobs/{job_id}", response_model=JobResponse)
+async def get_job(
+    job_id: str,
+    user: dict = Depends(verify_admin)
+):
+    """
+    取り込みジョブの状態取得
+    
+    Args:
+        job_id: ジョブID
+        user: 認証済みユーザー情報（管理者のみ）
+        
+    Returns:
+        段階（queued / extracting / chunking / embedding / storing / completed / failed）、
+        進捗（0〜1）、エラー内容
+    """
+    job = await get_ingestion_queue().get_job(job_id)
+    if not isinstance(job, IngestionJob):
+        raise HTTPException(
+            status_code=404,
+            detail="ジョブが見つかりません"
+        )
+    
+    return JobResponse(
+        id=job.id,
+        file_id=job.file_id,
+        filename=job.filename,
+        stage=job.stage,
+        progress=job.progress,
+        chunks_total=job.chunks_total,
+        chunks_done=job.chunks_done,
+        chunks_reused=job.chunks_reused,
+        chunks_removed=job.chunks_removed,
+        collection=job.collection,
+        error=job.error,
+        created_at=datetime.fromtimestamp(job.created_at, tz=timezone.utc),
+        updated_at=datetime.fromtimestamp(job.updated_at, tz=timezone.utc)
+    )
+
+
+@router.get("/bulk-jobs/{job_id}", response_model=BulkJobResponse)
+async def get_bulk_job(
+    job_id: str,
+    user: dict = Depends(verify_admin)
+):
+    """
+    一括取り込みジョブの状態取得
+
+    Args:
+        job_id: ジョブID
+        user: 認証済みユーザー情報（管理者のみ）
+
+    Returns:
+        ファイルごとの段階・チャンク数・エラー内容と、全体の件数・スループット（docs/s, chunks/s）
+    """
+    job = await get_ingestion_queue().get_job(job_id)
+    if not isinstance(job, BulkIngestionJob):
+        raise HTTPException(
+            status_code=404,
+            detail="ジョブが見つかりません"
+        )
+
+    elapsed = None
+    if job.started_at is not None:
+        elapsed = round((job.finished_at or datetime.now(timezone.utc).timestamp()) - job.started_at, 3)
+
+    return BulkJobResponse(
+        id=job.id,
+        stage=job.stage,
+        progress=job.progress,
+        files=[BulkFileResponse(**vars(result)) for result in job.files],
+        docs_total=job.docs_total,
+        docs_done=job.docs_done,
+        docs_failed=job.docs_failed,
+        docs_skipped=job.docs_skipped,
+        chunks_done=job.chunks_done,
+        elapsed_seconds=elapsed,
+        docs_per_second=job.docs_per_second,
+        chunks_per_second=job.chunks_per_second,
+        collection=job.collection,
+        error=job.error,
+        created_at=datetime.fromtimestamp(job.created_at, tz=timezone.utc),
+        updated_at=datetime.fromtimestamp(job.updated_at, tz=timezone.utc)
+    )
@@ -3,7 +3,8 @@
 """
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
-from supabase_client import get_supabase_client
+from supabase_client import create_session_client
+from utils.concurrency import run_blocking
 
 
 router = APIRouter(prefix="/auth", tags=["認証"])
@@ -36,10 +37,11 @@ async def login(request: LoginRequest):
         HTTPException: ログインに失敗した場合
     """
     try:
-        supabase = get_supabase_client()
+        # ログインはセッションを保持するため、共有クライアントとは別に作成する
+        supabase = create_session_client()
         
         # Supabase Authでログイン
-        response = supabase.auth.sign_in_with_password({
+        response = await run_blocking(supabase.auth.sign_in_with_password, {
             "email": request.email,
             "password": request.password
         })
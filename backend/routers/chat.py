@@ -1,13 +1,25 @@
 """
 RAG質問APIルーター
 """
-from fastapi import APIRouter, HTTPException
-from pydantic import BaseModel
-from typing import List, Optional
-from supabase_client import get_supabase_service_client
-from utils.embedding import generate_embedding
-from openai import OpenAI
+from fastapi import APIRouter, Depends, HTTPException, Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+from typing import List, Literal, Optional, Tuple
+from utils.store import Store, require_store
+from openai_client import get_async_openai_client
+from utils.concurrency import run_blocking
+from utils.embedding import EmbeddingError, generate_embedding, generate_query_embeddings
+from utils.retrieval import retrieve_chunks, retrieve_chunks_batch, retrieve_hybrid
+from utils.vector_index import SearchHit
+from utils.answer_cache import get_answer_cache
+from utils.collection import COLLECTION_PATTERN, DEFAULT_COLLECTION, UnknownCollectionError
+from utils.corpus import current_version
+from utils.metrics import record_batch, record_usage, span
 from config import settings
+from openai import AsyncOpenAI
+import asyncio
+import json
+import time
 
 
 router = APIRouter(prefix="/chat", tags=["RAG質問"])
@@ -16,6 +28,23 @@ router = APIRouter(prefix="/chat", tags=["RAG質問"])
 class ChatRequest(BaseModel):
     """チャットリクエスト"""
     question: str
+    # 検索方式（memory / rpc / hybrid）。未指定時は設定値
+    retrieval_mode: Optional[Literal["memory", "rpc", "hybrid"]] = None
+    # ivfflat.probes（rpc時のみ有効）。未指定時は設定値
+    probes: Optional[int] = Field(default=None, ge=1, le=1000)
+    # 検索対象のコレクション（他のコレクションのチャンクは走査しない）
+    collection: str = Field(default=DEFAULT_COLLECTION, pattern=COLLECTION_PATTERN)
+
+
+class ChatBatchRequest(BaseModel):
+    """一括質問リクエスト"""
+    questions: List[str] = Field(min_length=1)
+    # 検索方式（memory / rpc / hybrid）。未指定時は設定値
+    retrieval_mode: Optional[Literal["memory", "rpc", "hybrid"]] = None
+    # ivfflat.probes（rpc時のみ有効）。未指定時は設定値
+    probes: Optional[int] = Field(default=None, ge=1, le=1000)
+    # 検索対象のコレクション（他のコレクションのチャンクは走査しない）
+    collection: str = Field(default=DEFAULT_COLLECTION, pattern=COLLECTION_PATTERN)
 
 
 class Source(BaseModel):
@@ -32,162 +61,261 @@ class ChatResponse(BaseModel):
     sources: List[Source]
 
 
-def get_openai_client() -> OpenAI:
-    """OpenAIクライアントを取得"""
-    return OpenAI(api_key=settings.openai_api_key)
+SYSTEM_PROMPT = "あなたは質問に対して、提供されたコンテキストを参考に正確で有用な回答を提供するアシスタントです。"
+CHAT_MODEL = "gpt-4o-mini"
+NO_CHUNKS_DETAIL = "関連するチャンクが見つかりませんでした。ナレッジベースが空の場合は、まずファイルをアップロードしてください。"
 
 
-@router.post("", response_model=ChatResponse)
-async def chat(request: ChatRequest):
+def embedding_failed(error: EmbeddingError) -> HTTPException:
+    """Embeddingの生成失敗（OpenAI APIの障害・レート制限）は再試行できるよう502で返す"""
+    return HTTPException(
+        status_code=502,
+        detail=str(error)
+    )
+
+
+def collection_not_found(error: UnknownCollectionError) -> HTTPException:
+    """ファイルのないコレクションの検索は404で返す"""
+    return HTTPException(
+        status_code=404,
+        detail=str(error)
+    )
+
+
+async def retrieve_top_chunks(
+    request: ChatRequest,
+    store: Store
+) -> Tuple[Optional[List[float]], List[SearchHit]]:
     """
-    RAG質問エンドポイント
+    質問文のEmbeddingを生成し、類似チャンクの上位3件を取得
     
     Args:
-        request: 質問内容
+        request: チャットリクエスト
+        store: 保存先
         
     Returns:
-        回答と参照元情報
+        (質問文のEmbedding（hybridで識別子の検索だけで済んだ場合はNone）, 検索結果)
+        
+    Raises:
+        HTTPException: 検索方式が不正（400）、Embeddingの生成に失敗した（502）、コレクションがない・該当チャンクがない（404）場合
     """
+    mode = request.retrieval_mode or settings.retrieval_mode
     try:
-        # サービスロールキーを使用してRLSをバイパス
-        supabase = get_supabase_service_client()
-        
-        # 質問文のEmbedding生成
-        question_embedding = generate_embedding(request.question)
-        
-        # pgvectorで類似度検索（コサイン類似度）
-        # SupabaseのPostgreSQLでベクトル検索を実行
-        # 注意: SupabaseのPythonクライアントでは直接SQLを実行する必要がある
-        
-        # 類似度検索用のSQLクエリ
-        # 1 - (embedding <=> question_embedding) でコサイン距離を計算
-        # <=> はpgvectorのコサイン距離演算子
-        
-        # SupabaseのRPC（Remote Procedure Call）を使用するか、
-        # または直接SQLを実行する必要があります
-        # ここでは、SupabaseのPostgreSQL関数を使用する方法を採用
-        
-        # まず、一時的にすべてのチャンクを取得してPython側で類似度計算
-        # 本番環境では、PostgreSQLの関数を使用することを推奨
-        
-        # 全チャンクを取得（サービスロールキーを使用してRLSをバイパス）
-        # ファイル名も取得するためにfilesテーブルとJOIN
-        chunks_response = supabase.table("chunks").select("id, file_id, content, embedding, files!inner(filename)").execute()
-        
-        if not chunks_response.data:
-            raise HTTPException(
-                status_code=404,
-                detail="ナレッジベースが空です。まずファイルをアップロードしてください。"
+        if mode == "hybrid":
+            # hybrid: 語彙検索とベクトル検索の順位を融合する（識別子の検索はEmbeddingを生成しない）
+            question_embedding, top_chunks = await retrieve_hybrid(
+                store,
+                request.question,
+                top_k=3,
+                collection=request.collection
             )
-        
-        # コサイン類似度を計算してソート
-        import numpy as np
-        import json
-        
-        similarities = []
-        for chunk in chunks_response.data:
-            chunk_embedding = chunk["embedding"]
-            
-            # embeddingが文字列の場合はリストに変換
-            if isinstance(chunk_embedding, str):
-                try:
-                    chunk_embedding = json.loads(chunk_embedding)
-                except:
-                    # JSONパースに失敗した場合はスキップ
-                    continue
+        else:
+            # 質問文のEmbedding生成
+            question_embedding = await generate_embedding(request.question)
             
-            # リストをnumpy配列に変換
-            chunk_embedding = np.array(chunk_embedding, dtype=np.float32)
-            question_embedding_array = np.array(question_embedding, dtype=np.float32)
-            
-            # コサイン類似度を計算
-            similarity = np.dot(question_embedding_array, chunk_embedding) / (
-                np.linalg.norm(question_embedding_array) * np.linalg.norm(chunk_embedding)
-            )
-            similarities.append({
-                "chunk": chunk,
-                "similarity": float(similarity)
-            })
-        
-        # 類似度でソート（降順）
-        similarities.sort(key=lambda x: x["similarity"], reverse=True)
-        
-        # 上位3件を取得
-        top_chunks = similarities[:3]
-        
-        if not top_chunks:
-            raise HTTPException(
-                status_code=404,
-                detail="関連するチャンクが見つかりませんでした"
+            # 類似度検索（コサイン類似度）
+            # memory: プロセス常駐の正規化済み行列に対して行列ベクトル積1回で上位k件を求める
+            # rpc: 保存先のmatch_chunksで上位k件のみ取得する（Supabaseではpgvectorのivfflatインデックス）
+            # 保存先の呼び出しはブロッキングするため、スレッドプールで実行
+            top_chunks = await run_blocking(
+                retrieve_chunks,
+                store,
+                question_embedding,
+                top_k=3,
+                mode=mode,
+                probes=request.probes,
+                collection=request.collection
             )
+    except EmbeddingError as e:
+        raise embedding_failed(e)
+    except UnknownCollectionError as e:
+        raise collection_not_found(e)
+    except ValueError as e:
+        # 検索方式・語彙検索の設定など、リクエストの誤り
+        raise HTTPException(
+            status_code=400,
+            detail=str(e)
+        )
+    
+    if not top_chunks:
+        raise HTTPException(
+            status_code=404,
+            detail=NO_CHUNKS_DETAIL
+        )
+    
+    return question_embedding, top_chunks
+
+
+def lookup_cached_answer(
+    question_embedding: Optional[List[float]],
+    top_chunks: List[SearchHit],
+    collection: str,
+    corpus_version: int
+) -> Optional[str]:
+    """回答キャッシュを検索（無効時、またはEmbeddingを生成しなかった場合は常にNone）"""
+    if not settings.answer_cache_enabled or question_embedding is None:
+        return None
+    return get_answer_cache().lookup(
+        question_embedding,
+        [chunk.chunk_id for chunk in top_chunks],
+        collection,
+        corpus_version
+    )
+
+
+def store_cached_answer(
+    question_embedding: Optional[List[float]],
+    top_chunks: List[SearchHit],
+    collection: str,
+    corpus_version: int,
+    answer: Optional[str]
+) -> None:
+    """回答をキャッシュに保存（無効時、またはEmbeddingを生成しなかった場合は何もしない）"""
+    if settings.answer_cache_enabled and answer and question_embedding is not None:
+        get_answer_cache().store(
+            question_embedding,
+            [chunk.chunk_id for chunk in top_chunks],
+            collection,
+            corpus_version,
+            answer
+        )
+
+
+def build_messages(question: str, top_chunks: List[SearchHit]) -> List[dict]:
+    """
+    検索結果をコンテキストとしてChat APIに渡すメッセージを構築
+    
+    Args:
+        question: 質問文
+        top_chunks: 検索結果
         
-        # プロンプトを構築
-        context = "\n\n".join([
-            f"[チャンク {i+1}]\n{chunk['chunk']['content']}"
-            for i, chunk in enumerate(top_chunks)
-        ])
-        
-        prompt = f"""以下のコンテキストを参考に、質問に回答してください。
+    Returns:
+        Chat APIのmessages
+    """
+    context = "\n\n".join([
+        f"[チャンク {i+1}]\n{chunk.content}"
+        for i, chunk in enumerate(top_chunks)
+    ])
+    
+    prompt = f"""以下のコンテキストを参考に、質問に回答してください。
 
 コンテキスト:
 {context}
 
-質問: {request.question}
+質問: {question}
 
 回答:"""
-        
-        # OpenAI Chat APIで回答生成
-        client = get_openai_client()
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "あなたは質問に対して、提供されたコンテキストを参考に正確で有用な回答を提供するアシスタントです。"},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.7,
-            max_tokens=1000
+    
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
+
+
+def build_sources(top_chunks: List[SearchHit]) -> List[Source]:
+    """参照元情報を構築（ファイル名は検索結果が保持している）"""
+    return [
+        Source(
+            file_id=chunk.file_id,
+            filename=chunk.filename,
+            chunk_id=chunk.chunk_id,
+            content=chunk.content[:200] + "..." if len(chunk.content) > 200 else chunk.content
         )
+        for chunk in top_chunks
+    ]
+
+
+def sse_event(event: str, data: dict) -> str:
+    """Server-Sent Events形式の1イベントを作成"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@router.post("", response_model=ChatResponse)
+async def chat(
+    request: ChatRequest,
+    response: Response,
+    store: Store = Depends(require_store),
+    client: AsyncOpenAI = Depends(get_async_openai_client)
+):
+    """
+    RAG質問エンドポイント
+    
+    Args:
+        request: 質問内容
+        response: レスポンス（X-Answer-Cacheヘッダーを設定）
+        store: 保存先
+        client: OpenAIクライアント
         
-        answer = response.choices[0].message.content
+    Returns:
+        回答と参照元情報
+    """
+    try:
+        # 検索より前に取得し、検索中に更新があった場合は古いバージョンとして扱う
+        corpus_version = current_version(request.collection)
+        question_embedding, top_chunks = await retrieve_top_chunks(request, store)
         
-        # 参照元情報を構築
-        sources = []
-        for chunk in top_chunks:
-            chunk_data = chunk["chunk"]
-            file_id = chunk_data["file_id"]
-            
-            # ファイル名を取得
-            filename = "不明"
-            try:
-                # filesテーブルからJOINで取得したファイル名を使用
-                if "files" in chunk_data:
-                    files_data = chunk_data["files"]
-                    if isinstance(files_data, list) and len(files_data) > 0:
-                        filename = files_data[0].get("filename", "不明")
-                    elif isinstance(files_data, dict):
-                        filename = files_data.get("filename", "不明")
-                
-                # ファイル名が取得できない場合は、別途取得を試みる
-                if filename == "不明":
-                    file_response = supabase.table("files").select("filename").eq("id", file_id).limit(1).execute()
-                    if file_response.data and len(file_response.data) > 0:
-                        filename = file_response.data[0].get("filename", "不明")
-            except Exception as e:
-                # エラーが発生した場合はファイル名を取得できないが続行
-                print(f"ファイル名取得エラー: {str(e)}")
+        # 似た質問・同じ参照元の回答があれば再利用
+        with span("answer_cache"):
+            answer = lookup_cached_answer(question_embedding, top_chunks, request.collection, corpus_version)
+        response.headers["X-Answer-Cache"] = "hit" if answer is not None else "miss"
+        
+        if answer is None:
+            # OpenAI Chat APIで回答生成
+            with span("completion"):
+                completion = await client.chat.completions.create(
+                    model=CHAT_MODEL,
+                    messages=build_messages(request.question, top_chunks),
+                    temperature=0.7,
+                    max_tokens=1000
+                )
+            record_usage(CHAT_MODEL, completion.usage)
             
-            sources.append(Source(
-                file_id=file_id,
-                filename=filename,
-                chunk_id=chunk_data["id"],
-                content=chunk_data["content"][:200] + "..." if len(chunk_data["content"]) > 200 else chunk_data["content"]
-            ))
+            answer = completion.choices[0].message.content
+            store_cached_answer(question_embedding, top_chunks, request.collection, corpus_version, answer)
         
         return ChatResponse(
             answer=answer,
-            sources=sources
+            sources=build_sources(top_chunks)
+        )
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"質問処理でエラーが発生しました: {str(e)}"
         )
+
+
+@router.post("/stream")
+async def chat_stream(
+    request: ChatRequest,
+    store: Store = Depends(require_store),
+    client: AsyncOpenAI = Depends(get_async_openai_client)
+):
+    """
+    RAG質問エンドポイント（Server-Sent Eventsでストリーミング）
+    
+    イベント:
+        sources: 参照元情報（検索完了時点で最初に送信）
+        token: 回答の断片（生成され次第送信。回答キャッシュのヒット時は回答全体）
+        done: トークン使用量・所要時間・キャッシュヒットの有無
+        error: 生成途中でエラーが発生した場合
+    
+    Args:
+        request: 質問内容
+        store: 保存先
+        client: OpenAIクライアント
         
+    Returns:
+        text/event-streamのレスポンス
+    """
+    started = time.perf_counter()
+    
+    # 検索までは通常のエラーレスポンスを返せるよう、ストリーム開始前に実行する
+    try:
+        corpus_version = current_version(request.collection)
+        question_embedding, top_chunks = await retrieve_top_chunks(request, store)
     except HTTPException:
         raise
     except Exception as e:
@@ -195,4 +323,234 @@ async def chat(request: ChatRequest):
             status_code=500,
             detail=f"質問処理でエラーが発生しました: {str(e)}"
         )
+    
+    retrieval_ms = (time.perf_counter() - started) * 1000
+    with span("answer_cache"):
+        cached_answer = lookup_cached_answer(question_embedding, top_chunks, request.collection, corpus_version)
+    
+    async def events():
+        yield sse_event("sources", {
+            "sources": [source.model_dump() for source in build_sources(top_chunks)]
+        })
+        
+        if cached_answer is not None:
+            # キャッシュヒット時は回答全体を1イベントで送る
+            yield sse_event("token", {"content": cached_answer})
+            yield sse_event("done", {
+                "usage": None,
+                "cached": True,
+                "timing": {
+                    "retrieval_ms": round(retrieval_ms, 1),
+                    "first_token_ms": round((time.perf_counter() - started) * 1000, 1),
+                    "total_ms": round((time.perf_counter() - started) * 1000, 1)
+                }
+            })
+            return
+        
+        usage = None
+        first_token_ms = None
+        parts = []
+        try:
+            # 回答生成の所要時間はストリームの終了まで（応答ヘッダーには含まれず、/metrics にのみ集計される）
+            with span("completion"):
+                stream = await client.chat.completions.create(
+                    model=CHAT_MODEL,
+                    messages=build_messages(request.question, top_chunks),
+                    temperature=0.7,
+                    max_tokens=1000,
+                    stream=True,
+                    stream_options={"include_usage": True}
+                )
+                async for chunk in stream:
+                    # 最後のチャンクはchoicesが空でusageのみを持つ
+                    if chunk.usage is not None:
+                        usage = chunk.usage.model_dump()
+                    if not chunk.choices:
+                        continue
+                    content = chunk.choices[0].delta.content
+                    if content:
+                        if first_token_ms is None:
+                            first_token_ms = (time.perf_counter() - started) * 1000
+                        parts.append(content)
+                        yield sse_event("token", {"content": content})
+        except Exception as e:
+            yield sse_event("error", {"detail": f"回答生成でエラーが発生しました: {str(e)}"})
+            return
+        
+        record_usage(CHAT_MODEL, usage)
+        store_cached_answer(question_embedding, top_chunks, request.collection, corpus_version, "".join(parts))
+        yield sse_event("done", {
+            "usage": usage,
+            "cached": False,
+            "timing": {
+                "retrieval_ms": round(retrieval_ms, 1),
+                "first_token_ms": round(first_token_ms, 1) if first_token_ms is not None else None,
+                "total_ms": round((time.perf_counter() - started) * 1000, 1)
+            }
+        })
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Answer-Cache": "hit" if cached_answer is not None else "miss",
+            # リバースプロキシでのバッファリングを無効化
+            "X-Accel-Buffering": "no"
+        }
+    )
+
 
+@router.post("/batch")
+async def chat_batch(
+    request: ChatBatchRequest,
+    store: Store = Depends(require_store),
+    client: AsyncOpenAI = Depends(get_async_openai_client)
+):
+    """
+    一括質問エンドポイント（評価・事前回答などのオフライン処理向け。Server-Sent Eventsで結果を返す）
+    
+    全質問のEmbeddingを1回の一括生成でまとめて作り（キャッシュ済みの質問は除く）、
+    memory検索では全質問と全チャンクの類似度を行列行列積でまとめて計算する。
+    回答生成は CHAT_BATCH_CONCURRENCY 件まで並行して行い、終わった質問から順に送信する。
+    
+    イベント:
+        result: 1問分の回答（index: 質問の位置、question、answer、sources、cached、usage）
+        error: 1問分のエラー（index、question、status、detail）。他の質問の処理は続ける
+        done: 件数（成功・失敗）と所要時間
+    
+    Args:
+        request: 質問のリスト
+        store: 保存先
+        client: OpenAIクライアント
+        
+    Returns:
+        text/event-streamのレスポンス
+        
+    Raises:
+        HTTPException: 質問数が上限を超える・検索方式が不正（400）、コレクションがない（404）、
+            Embeddingの生成に失敗した（502）、または検索に失敗した（500）場合
+    """
+    questions = request.questions
+    if len(questions) > settings.chat_batch_max_questions:
+        raise HTTPException(
+            status_code=400,
+            detail=f"質問数が上限（{settings.chat_batch_max_questions}件）を超えています。"
+        )
+    started = time.perf_counter()
+    record_batch("chat_question", len(questions))
+    
+    # Embedding生成と検索までは通常のエラーレスポンスを返せるよう、ストリーム開始前に実行する
+    try:
+        corpus_version = current_version(request.collection)
+        question_embeddings = await generate_query_embeddings(questions)
+        results = await retrieve_chunks_batch(
+            store,
+            questions,
+            question_embeddings,
+            top_k=3,
+            mode=request.retrieval_mode,
+            probes=request.probes,
+            concurrency=settings.chat_batch_concurrency,
+            collection=request.collection
+        )
+    except EmbeddingError as e:
+        raise embedding_failed(e)
+    except UnknownCollectionError as e:
+        raise collection_not_found(e)
+    except ValueError as e:
+        # 検索方式・語彙検索の設定など、リクエストの誤り
+        raise HTTPException(
+            status_code=400,
+            detail=str(e)
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"質問処理でエラーが発生しました: {str(e)}"
+        )
+    
+    retrieval_ms = (time.perf_counter() - started) * 1000
+    semaphore = asyncio.Semaphore(settings.chat_batch_concurrency)
+    
+    async def answer(index: int) -> Tuple[bool, str]:
+        """1問分の回答を生成し、(成功したか, 送信するイベント) を返す"""
+        question, top_chunks = questions[index], results[index]
+        if not top_chunks:
+            return False, sse_event("error", {
+                "index": index,
+                "question": question,
+                "status": 404,
+                "detail": NO_CHUNKS_DETAIL
+            })
+        
+        question_embedding = question_embeddings[index]
+        cached_answer = lookup_cached_answer(question_embedding, top_chunks, request.collection, corpus_version)
+        usage = None
+        if cached_answer is None:
+            try:
+                async with semaphore:
+                    with span("completion"):
+                        completion = await client.chat.completions.create(
+                            model=CHAT_MODEL,
+                            messages=build_messages(question, top_chunks),
+                            temperature=0.7,
+                            max_tokens=1000
+                        )
+                answer_text = completion.choices[0].message.content
+                usage = completion.usage.model_dump() if completion.usage is not None else None
+            except Exception as e:
+                return False, sse_event("error", {
+                    "index": index,
+                    "question": question,
+                    "status": 500,
+                    "detail": f"回答生成でエラーが発生しました: {str(e)}"
+                })
+            record_usage(CHAT_MODEL, completion.usage)
+            store_cached_answer(question_embedding, top_chunks, request.collection, corpus_version, answer_text)
+        else:
+            answer_text = cached_answer
+        
+        return True, sse_event("result", {
+            "index": index,
+            "question": question,
+            "answer": answer_text,
+            "sources": [source.model_dump() for source in build_sources(top_chunks)],
+            "cached": cached_answer is not None,
+            "usage": usage
+        })
+    
+    async def events():
+        tasks = [asyncio.create_task(answer(i)) for i in range(len(questions))]
+        failed = 0
+        try:
+            for finished in asyncio.as_completed(tasks):
+                succeeded, event = await finished
+                if not succeeded:
+                    failed += 1
+                yield event
+        finally:
+            # クライアントが切断した場合は未完了の回答生成を取り消す
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        
+        yield sse_event("done", {
+            "count": len(questions),
+            "succeeded": len(questions) - failed,
+            "failed": failed,
+            "timing": {
+                "retrieval_ms": round(retrieval_ms, 1),
+                "total_ms": round((time.perf_counter() - started) * 1000, 1)
+            }
+        })
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            # リバースプロキシでのバッファリングを無効化
+            "X-Accel-Buffering": "no"
+        }
+    )
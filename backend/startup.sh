@@ -3,5 +3,5 @@
 if [ -z "$PORT" ]; then
     PORT=8000
 fi
-gunicorn main:app --bind 0.0.0.0:$PORT --workers 2 --timeout 120
+gunicorn main:app -k uvicorn.workers.UvicornWorker --bind 0.0.0.0:$PORT --workers 2 --timeout 120
 
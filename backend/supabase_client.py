@@ -1,25 +1,147 @@
 """
 Supabaseクライアント設定
+
+クライアントはプロセスで1つずつ生成し、HTTPコネクションプールを共有する
+（リクエストごとのTLSハンドシェイクを避け、keep-aliveを効かせるため）。
+生成と破棄は main.py の lifespan で行う。
 """
-from supabase import create_client, Client
+from fastapi import HTTPException
+from supabase import create_client, Client, ClientOptions
 from config import settings
+from typing import Optional
+import threading
+import httpx
 
 
-def get_supabase_client() -> Client:
-    """Supabaseクライアントを取得"""
-    return create_client(settings.supabase_url, settings.supabase_key)
+_http_client: Optional[httpx.Client] = None
+_supabase_client: Optional[Client] = None
+_supabase_service_client: Optional[Client] = None
+_lock = threading.RLock()
 
 
-def get_supabase_service_client() -> Client:
-    """Supabaseサービスロールクライアントを取得（管理者操作用）"""
+def build_http_limits() -> httpx.Limits:
+    """設定からコネクションプールの上限を作成"""
+    return httpx.Limits(
+        max_connections=settings.http_pool_size,
+        max_keepalive_connections=settings.http_keepalive_connections,
+        keepalive_expiry=settings.http_keepalive_seconds
+    )
+
+
+def build_http_timeout() -> httpx.Timeout:
+    """設定からタイムアウトを作成"""
+    return httpx.Timeout(
+        settings.http_timeout_seconds,
+        connect=settings.http_connect_timeout_seconds
+    )
+
+
+def get_http_client() -> httpx.Client:
+    """Supabase用の共有HTTPクライアントを取得"""
+    global _http_client
+    if _http_client is None:
+        with _lock:
+            if _http_client is None:
+                _http_client = httpx.Client(
+                    limits=build_http_limits(),
+                    timeout=build_http_timeout()
+                )
+    return _http_client
+
+
+def _client_options() -> ClientOptions:
+    # サーバー側で共有するため、セッションの保存・自動更新は行わない
+    return ClientOptions(
+        httpx_client=get_http_client(),
+        auto_refresh_token=False,
+        persist_session=False
+    )
+
+
+def _check_service_key() -> None:
     if not settings.supabase_service_key:
         raise ValueError("SUPABASE_SERVICE_KEYが設定されていません。.envファイルを確認してください。")
-    
+
     # サービスロールキーの形式確認（eyJで始まるJWTトークン、またはsb_secret_で始まる新しい形式）
     if not (settings.supabase_service_key.startswith("eyJ") or settings.supabase_service_key.startswith("sb_secret_")):
         print(f"警告: SUPABASE_SERVICE_KEYの形式が標準的ではありません。")
         print(f"現在の値: {settings.supabase_service_key[:30]}...")
         print("動作確認が必要です。")
-    
-    return create_client(settings.supabase_url, settings.supabase_service_key)
 
+
+def get_supabase_client() -> Client:
+    """
+    Supabaseクライアントを取得（プロセス共通）
+
+    ログインなどセッションを保持する操作には create_session_client() を使うこと
+    """
+    global _supabase_client
+    if _supabase_client is None:
+        with _lock:
+            if _supabase_client is None:
+                _supabase_client = create_client(
+                    settings.supabase_url,
+                    settings.supabase_key,
+                    options=_client_options()
+                )
+    return _supabase_client
+
+
+def create_session_client() -> Client:
+    """
+    セッションを保持する操作用のSupabaseクライアントを作成
+
+    クライアント自体は毎回作成するが、コネクションプールは共有する
+    """
+    return create_client(settings.supabase_url, settings.supabase_key, options=_client_options())
+
+
+def get_supabase_service_client() -> Client:
+    """Supabaseサービスロールクライアントを取得（管理者操作用・プロセス共通）"""
+    global _supabase_service_client
+    if _supabase_service_client is None:
+        _check_service_key()
+        with _lock:
+            if _supabase_service_client is None:
+                _supabase_service_client = create_client(
+                    settings.supabase_url,
+                    settings.supabase_service_key,
+                    options=_client_options()
+                )
+    return _supabase_service_client
+
+
+def require_supabase_service_client() -> Client:
+    """
+    依存性注入用: Supabaseサービスロールクライアントを取得
+
+    Raises:
+        HTTPException: サービスロールキーが未設定の場合
+    """
+    try:
+        return get_supabase_service_client()
+    except ValueError as e:
+        raise HTTPException(
+            status_code=500,
+            detail=str(e)
+        )
+
+
+def init_supabase_clients() -> None:
+    """起動時にクライアントを生成（設定が不足している場合は初回利用時まで遅延）"""
+    if not settings.supabase_url:
+        return
+    get_supabase_client()
+    if settings.supabase_service_key:
+        get_supabase_service_client()
+
+
+def close_supabase_clients() -> None:
+    """終了時にコネクションプールを閉じる"""
+    global _http_client, _supabase_client, _supabase_service_client
+    with _lock:
+        _supabase_client = None
+        _supabase_service_client = None
+        if _http_client is not None:
+            _http_client.close()
+            _http_client = None
@@ -0,0 +1,109 @@
+"""
+チャンクの COPY 保存（utils.chunk_store.PostgresConnections.copy_rows）のテスト
+
+    python -m unittest test_chunk_store
+
+PostgreSQLに接続するテストは TEST_DATABASE_URL が設定されている場合だけ実行する
+（psycopg が必要。一時テーブルに COPY するため、既存のテーブルは変更しない）。
+"""
+from utils.chunk_store import CHUNK_COLUMNS, PostgresConnections, build_chunk_rows, psycopg
+import os
+import unittest
+import uuid
+
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL", "")
+
+
+class BrokenCopy:
+    """COPY の途中で失敗するカーソル"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def copy(self, statement):
+        raise ValueError("COPYに失敗しました")
+
+
+class BrokenConnection:
+    """COPY もロールバックも失敗する（接続が切れた）接続"""
+
+    closed = False
+    broken = True
+
+    def cursor(self):
+        return BrokenCopy()
+
+    def rollback(self):
+        raise ConnectionError("接続が切れています")
+
+    def close(self):
+        self.closed = True
+
+
+class CopyRowsErrorTest(unittest.TestCase):
+    def test_original_error_is_raised_when_rollback_fails(self):
+        connections = PostgresConnections("postgresql://unused", max_idle=1)
+        conn = BrokenConnection()
+        connections._idle.append(conn)
+
+        with self.assertRaisesRegex(ValueError, "COPYに失敗しました"):
+            connections.copy_rows([])
+        self.assertTrue(conn.closed)
+        self.assertEqual(connections._idle, [])
+
+
+@unittest.skipUnless(TEST_DATABASE_URL and psycopg is not None, "TEST_DATABASE_URL と psycopg が必要です")
+class CopyRowsTest(unittest.TestCase):
+    def setUp(self):
+        self.connections = PostgresConnections(TEST_DATABASE_URL, max_idle=1)
+        # 一時テーブルは接続ごとのため、この接続を使い回させる（chunks より先に見つかる）
+        self.conn = psycopg.connect(TEST_DATABASE_URL)
+        self.conn.execute(
+            "CREATE TEMP TABLE chunks ("
+            " id UUID PRIMARY KEY,"
+            " file_id UUID NOT NULL,"
+            " content TEXT NOT NULL,"
+            " content_hash VARCHAR(64),"
+            " embedding TEXT)"
+        )
+        self.conn.commit()
+        self.connections.release(self.conn)
+
+    def tearDown(self):
+        self.connections.close()
+        self.conn.close()
+
+    def test_copy_rows(self):
+        file_id = str(uuid.uuid4())
+        rows = build_chunk_rows(file_id, ["本文1", "本文2"], ["h1", "h2"], [[0.1, 0.2], [0.3, -0.4]])
+
+        self.connections.copy_rows(rows)
+
+        stored = self.conn.execute(
+            f"SELECT {', '.join(CHUNK_COLUMNS)} FROM chunks ORDER BY content"
+        ).fetchall()
+        self.assertEqual(
+            [(str(row[0]), str(row[1]), row[2], row[3], row[4]) for row in stored],
+            [tuple(row[column] for column in CHUNK_COLUMNS) for row in rows]
+        )
+        # 成功した接続はプールに戻る
+        self.assertEqual(self.connections._idle, [self.conn])
+
+    def test_failed_copy_closes_connection(self):
+        file_id = str(uuid.uuid4())
+        rows = build_chunk_rows(file_id, ["本文1"], ["h1"], [[0.1, 0.2]])
+        # 同じIDの行で一意制約違反にする
+        rows.append(dict(rows[0], content="重複"))
+
+        with self.assertRaises(psycopg.errors.UniqueViolation):
+            self.connections.copy_rows(rows)
+        self.assertTrue(self.conn.closed)
+        self.assertEqual(self.connections._idle, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
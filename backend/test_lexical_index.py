@@ -0,0 +1,79 @@
+"""
+語彙検索（utils.lexical_index）のテスト
+
+    python -m unittest test_lexical_index
+"""
+from utils.lexical_index import LexicalIndex, is_identifier_query, tokenize
+import unittest
+
+
+class TokenizeTest(unittest.TestCase):
+    def test_identifiers_and_ngrams(self):
+        terms = tokenize("ＳＫＵ-2024の在庫")
+
+        self.assertIn("sku-2024", terms)
+        self.assertIn("sku", terms)
+        self.assertIn("2024", terms)
+        self.assertEqual([term for term in terms if not term.isascii()], ["の在", "在庫"])
+
+
+class IdentifierQueryTest(unittest.TestCase):
+    def test_identifier_queries(self):
+        for question in ("E1234", "ERR_CONNECTION_RESET", "SKU-2024-001", "「E1234」", "Ｅ１２３４", "E1 E2 E3"):
+            with self.subTest(question=question):
+                self.assertTrue(is_identifier_query(question))
+
+    def test_other_queries(self):
+        for question in ("", "在庫はどこですか", "E1234 の意味は？", "hello", "Api", "E1 E2 E3 E4"):
+            with self.subTest(question=question):
+                self.assertFalse(is_identifier_query(question))
+
+
+class LexicalIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = LexicalIndex()
+        self.contents = {
+            "c1": "エラーコードE1234は接続の失敗を示します。",
+            "c2": "製品SKU-2024の在庫は東京倉庫にあります。",
+            "c3": "在庫の確認方法について説明します。在庫は毎日更新されます。",
+        }
+        self.index.add(list(self.contents), list(self.contents.values()))
+
+    def search_ids(self, query: str, top_k: int = 3, require_all: bool = False):
+        return [chunk_id for chunk_id, _ in self.index.search(query, top_k, require_all=require_all)]
+
+    def test_search_ranks_matching_chunks(self):
+        self.assertEqual(self.search_ids("E1234"), ["c1"])
+        self.assertEqual(self.search_ids("SKU-2024の在庫")[0], "c2")
+        scores = [score for _, score in self.index.search("在庫", 3)]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+
+    def test_require_all(self):
+        self.assertEqual(self.search_ids("在庫 東京", require_all=True), ["c2"])
+        self.assertEqual(self.search_ids("E1234 東京", require_all=True), [])
+
+    def test_remove(self):
+        self.index.remove(["c2"], [self.contents["c2"]])
+
+        self.assertEqual(len(self.index), 2)
+        self.assertEqual(self.search_ids("SKU-2024"), [])
+        self.assertEqual(self.search_ids("在庫"), ["c3"])
+        # c2 にだけ現れた語は転置リストごと消える
+        self.assertEqual(self.index.search("東京", 3), [])
+
+    def test_remove_all_matches_empty_index(self):
+        self.index.remove(list(self.contents), list(self.contents.values()))
+
+        self.assertEqual(len(self.index), 0)
+        self.assertEqual(self.index.term_count(), 0)
+        self.assertEqual(self.index.search("在庫", 3), [])
+
+    def test_add_after_remove(self):
+        self.index.remove(["c1"], [self.contents["c1"]])
+        self.index.add(["c4"], ["エラーコードE1234の対処方法です。"])
+
+        self.assertEqual(self.search_ids("E1234"), ["c4"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,123 @@
+"""
+ローカルの保存先（utils.local_store.LocalStore）のテスト
+
+    python -m unittest test_local_store
+
+保存先は一時ディレクトリに作る。
+"""
+from utils import local_store
+from utils.chunk_store import build_chunk_rows
+from utils.local_store import LocalStore
+import numpy as np
+import shutil
+import tempfile
+import unittest
+
+
+DIM = 8
+
+
+def axis(i: int, scale: float = 1.0) -> np.ndarray:
+    vector = np.zeros(DIM, dtype=np.float32)
+    vector[i] = scale
+    return vector
+
+
+class LocalStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = LocalStore(self.directory, dim=DIM)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def add_file(self, filename: str, contents, vectors, **values) -> str:
+        file_id = self.store.insert_file({"filename": filename, **values})["id"]
+        hashes = [f"{filename}-{i}" for i in range(len(contents))]
+        self.store.insert_chunks(build_chunk_rows(file_id, contents, hashes, [vector.tolist() for vector in vectors]))
+        return file_id
+
+    def next_row(self) -> int:
+        return self.store._query("SELECT next_row FROM store_state")[0][0]
+
+    def test_match_chunks_round_trip(self):
+        a = self.add_file("a.txt", ["a0", "a1"], [axis(0), axis(0) + axis(1)])
+        self.add_file("b.txt", ["b0"], [axis(1)])
+
+        results = self.store.match_chunks(axis(0, 2.0).tolist(), top_k=3)
+
+        self.assertEqual([row["content"] for row in results], ["a0", "a1", "b0"])
+        self.assertEqual(results[0]["file_id"], a)
+        self.assertEqual(results[0]["filename"], "a.txt")
+        self.assertAlmostEqual(results[0]["similarity"], 1.0, places=5)
+        self.assertAlmostEqual(results[1]["similarity"], float(np.sqrt(0.5)), places=5)
+
+    def test_match_chunks_filters(self):
+        a = self.add_file("a.txt", ["a0", "a1"], [axis(0), axis(0) + axis(1)])
+        self.add_file("b.txt", ["b0"], [axis(0) + axis(2) * 0.5])
+        self.add_file("c.txt", ["c0"], [axis(0)], status="processing")
+        self.add_file("d.txt", ["d0"], [axis(0)], collection="other")
+
+        query = axis(0).tolist()
+        self.assertEqual([row["content"] for row in self.store.match_chunks(query, top_k=5)], ["a0", "b0", "a1"])
+        self.assertEqual(
+            [row["content"] for row in self.store.match_chunks(query, top_k=5, min_similarity=0.8)],
+            ["a0", "b0"]
+        )
+        self.assertEqual([row["content"] for row in self.store.match_chunks(query, top_k=5, file_ids=[a])], ["a0", "a1"])
+        self.assertEqual([row["content"] for row in self.store.match_chunks(query, top_k=5, collection="other")], ["d0"])
+
+    def test_load_chunks(self):
+        a = self.add_file("a.txt", ["a0", "a1"], [axis(0, 3.0), axis(1)])
+
+        chunk_ids, file_ids, contents, matrix, filenames = self.store.load_chunks(DIM)
+
+        self.assertEqual(contents, ["a0", "a1"])
+        self.assertEqual(file_ids, [a, a])
+        self.assertEqual(len(chunk_ids), 2)
+        self.assertEqual(filenames, {a: "a.txt"})
+        np.testing.assert_allclose(matrix, np.stack([axis(0), axis(1)]))
+
+    def test_deleted_rows_are_reused(self):
+        a = self.add_file("a.txt", ["a0", "a1"], [axis(0), axis(1)])
+        self.add_file("b.txt", ["b0"], [axis(2)])
+        self.assertEqual(self.next_row(), 3)
+
+        self.store.delete_file(a)
+        self.add_file("c.txt", ["c0"], [axis(3)])
+
+        # 空いた行を使い、新しい行は確保しない
+        self.assertEqual(self.next_row(), 3)
+        self.assertEqual(self.store.match_chunks(axis(0).tolist(), top_k=5, min_similarity=0.5), [])
+        results = self.store.match_chunks(axis(3).tolist(), top_k=1)
+        self.assertEqual([row["content"] for row in results], ["c0"])
+        self.assertAlmostEqual(results[0]["similarity"], 1.0, places=5)
+        self.assertEqual(len(self.store.find_embeddings(["a.txt-0", "c.txt-0"])), 1)
+
+    def test_row_reused_during_scan_is_rescored(self):
+        a = self.add_file("a.txt", ["near"], [axis(0) + axis(1) * 0.01])
+        self.add_file("b.txt", [f"mid{i}" for i in range(3)], [axis(0, 0.5) + axis(i + 2) for i in range(3)])
+
+        # 走査が終わってから結果を対応づけるまでの間に、"near" の行が別のチャンクに再利用される
+        record_scan = local_store.record_scan
+
+        def reuse_row(*args):
+            self.store.delete_file(a)
+            self.add_file("c.txt", ["far"], [-axis(0) + axis(1) * 0.1])
+
+        local_store.record_scan = reuse_row
+        try:
+            results = self.store.match_chunks(axis(0).tolist(), top_k=3)
+        finally:
+            local_store.record_scan = record_scan
+
+        # "far" は走査時の "near" の類似度ではなく、自分の類似度で最後に並ぶ
+        self.assertEqual([row["content"] for row in results][-1], "far")
+        self.assertLess(results[-1]["similarity"], 0)
+        similarities = [row["similarity"] for row in results]
+        self.assertEqual(similarities, sorted(similarities, reverse=True))
+
+
+if __name__ == "__main__":
+    unittest.main()
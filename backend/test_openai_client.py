@@ -0,0 +1,46 @@
+"""
+OpenAIクライアント（openai_client.get_async_openai_client）のテスト
+
+    python -m unittest test_openai_client
+
+スタブサーバー（benchmarks.stub_services）に実際のHTTPでEmbeddingを要求する。
+"""
+from benchmarks.stub_services import StubServer, StubState
+from config import settings
+import openai_client
+import unittest
+
+
+class OpenAIClientTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.server = StubServer(StubState(dim=8)).start()
+        self.saved = (settings.openai_api_key, settings.openai_base_url)
+        settings.openai_api_key = "sk-test"
+        settings.openai_base_url = f"{self.server.url}/v1"
+
+    async def asyncTearDown(self):
+        await openai_client.close_openai_client()
+
+    def tearDown(self):
+        settings.openai_api_key, settings.openai_base_url = self.saved
+        self.server.stop()
+
+    def test_client_uses_configured_timeout(self):
+        client = openai_client.get_async_openai_client()
+
+        self.assertEqual(client.timeout.connect, settings.http_connect_timeout_seconds)
+        self.assertEqual(client.timeout.read, settings.http_timeout_seconds)
+        repr(client.timeout)
+
+    async def test_embedding_request(self):
+        client = openai_client.get_async_openai_client()
+
+        response = await client.embeddings.create(model="text-embedding-3-small", input=["本文"])
+
+        self.assertEqual(len(response.data), 1)
+        self.assertEqual(len(response.data[0].embedding), 8)
+        self.assertEqual(self.server.state.requests.get("openai.embeddings"), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,152 @@
+"""
+インメモリのベクトルインデックス（utils.vector_index.VectorIndex）のテスト
+
+    python -m unittest test_vector_index
+
+コーパスバージョンと再スコアリング用の行は一時ディレクトリ（LOCAL_STATE_DIR）に置く。
+"""
+from config import settings
+from utils.vector_index import VectorIndex
+import numpy as np
+import shutil
+import tempfile
+import unittest
+
+
+def unit(*values):
+    vector = np.asarray(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+class VectorIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.saved_state_dir = settings.local_state_dir
+        self.state_dir = tempfile.mkdtemp()
+        settings.local_state_dir = self.state_dir
+
+    def tearDown(self):
+        settings.local_state_dir = self.saved_state_dir
+        shutil.rmtree(self.state_dir, ignore_errors=True)
+
+
+class VectorIndexSearchTest(VectorIndexTestCase):
+    def setUp(self):
+        super().setUp()
+        self.index = VectorIndex(dim=3)
+        self.index.load_arrays(
+            ["a1", "a2", "b1", "b2"],
+            ["file-a", "file-a", "file-b", "file-b"],
+            ["本文a1", "本文a2", "本文b1", "本文b2"],
+            np.stack([unit(1, 0, 0), unit(1, 1, 0), unit(0, 1, 0), unit(-1, 0, 0)]),
+            {"file-a": "a.txt", "file-b": "b.txt"},
+            version=0
+        )
+
+    def test_search_orders_by_similarity(self):
+        hits = self.index.search([1, 0.1, 0], top_k=3)
+
+        self.assertEqual([hit.chunk_id for hit in hits], ["a1", "a2", "b1"])
+        self.assertEqual([hit.filename for hit in hits], ["a.txt", "a.txt", "b.txt"])
+        similarities = [hit.similarity for hit in hits]
+        self.assertEqual(similarities, sorted(similarities, reverse=True))
+        self.assertAlmostEqual(similarities[0], float(unit(1, 0.1, 0) @ unit(1, 0, 0)), places=5)
+
+    def test_search_applies_min_similarity(self):
+        hits = self.index.search([1, 0, 0], top_k=4, min_similarity=0.5)
+
+        self.assertEqual([hit.chunk_id for hit in hits], ["a1", "a2"])
+
+    def test_search_with_zero_query_returns_nothing(self):
+        self.assertEqual(self.index.search([0, 0, 0]), [])
+
+    def test_search_batch_matches_search(self):
+        queries = [[1, 0.1, 0], [0, 1, 0.2], [0, 0, 0]]
+
+        results = self.index.search_batch(queries, top_k=2, min_similarity=0.1)
+
+        self.assertEqual(
+            [[hit.chunk_id for hit in hits] for hits in results],
+            [[hit.chunk_id for hit in self.index.search(query, top_k=2, min_similarity=0.1)] for query in queries]
+        )
+
+    def test_remove_file(self):
+        self.index.remove_file("file-a")
+
+        hits = self.index.search([1, 0, 0], top_k=4)
+        self.assertEqual(len(self.index), 2)
+        self.assertEqual([hit.chunk_id for hit in hits], ["b1", "b2"])
+        self.assertEqual({hit.file_id for hit in hits}, {"file-b"})
+
+    def test_replace_chunks(self):
+        self.index.replace_chunks("file-b", "b2.txt", ["b2"], ["b3"], ["本文b3"], [unit(1, 0, 0.1)])
+
+        hits = self.index.search([1, 0, 0], top_k=4)
+        self.assertEqual([hit.chunk_id for hit in hits], ["a1", "b3", "a2", "b1"])
+        self.assertEqual(hits[1].content, "本文b3")
+        self.assertEqual(hits[1].filename, "b2.txt")
+
+    def test_add_file_after_remove(self):
+        self.index.remove_file("file-a")
+        self.index.add_file("file-c", "c.txt", ["c1"], ["本文c1"], [unit(1, 0, 0)])
+
+        hits = self.index.search([1, 0, 0], top_k=1)
+        self.assertEqual([(hit.chunk_id, hit.filename) for hit in hits], [("c1", "c.txt")])
+
+
+class QuantizedSearchTest(VectorIndexTestCase):
+    """量子化（int8 / float16）した行列の検索が、再スコアリング後にfloat32の全件走査と一致するか"""
+
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(0)
+        self.embeddings = rng.standard_normal((2000, 64)).astype(np.float32)
+        self.queries = self.embeddings[:50] + rng.normal(scale=0.1, size=(50, 64)).astype(np.float32)
+        self.exact = self.build("none")
+
+    def build(self, quantization: str) -> VectorIndex:
+        index = VectorIndex(dim=64, quantization=quantization, rescore_candidates=40)
+        ids = [f"c{i}" for i in range(len(self.embeddings))]
+        index.load_arrays(ids, ["file"] * len(ids), ids, self.embeddings, {"file": "f.txt"}, version=0)
+        return index
+
+    def assert_matches_float32(self, quantization: str) -> None:
+        index = self.build(quantization)
+
+        found = total = 0
+        for query in self.queries:
+            expected = self.exact.search(query, top_k=5)
+            hits = index.search(query, top_k=5)
+            found += len({hit.chunk_id for hit in hits} & {hit.chunk_id for hit in expected})
+            total += len(expected)
+            # 返した候補の類似度はfloat32で計算し直した値
+            for hit in hits:
+                row = int(hit.chunk_id[1:])
+                exact = float(self.embeddings[row] @ query / np.linalg.norm(self.embeddings[row]) / np.linalg.norm(query))
+                self.assertAlmostEqual(hit.similarity, exact, places=5)
+        self.assertGreaterEqual(found / total, 0.98)
+        self.assertGreaterEqual(index.measure_recall(self.queries, top_k=5)["recall"], 0.98)
+
+    def test_int8_recall(self):
+        self.assert_matches_float32("int8")
+
+    def test_float16_recall(self):
+        self.assert_matches_float32("float16")
+
+    def test_quantized_matrix_is_smaller(self):
+        self.assertEqual(self.build("int8").memory_stats()["matrix_bytes"] * 4, self.exact.memory_stats()["matrix_bytes"])
+        self.assertEqual(self.build("float16").memory_stats()["matrix_bytes"] * 2, self.exact.memory_stats()["matrix_bytes"])
+
+    def test_search_batch_rescores(self):
+        index = self.build("int8")
+
+        results = index.search_batch(self.queries[:10], top_k=5)
+
+        for query, hits in zip(self.queries[:10], results):
+            self.assertEqual(
+                [(hit.chunk_id, round(hit.similarity, 5)) for hit in hits],
+                [(hit.chunk_id, round(hit.similarity, 5)) for hit in index.search(query, top_k=5)]
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
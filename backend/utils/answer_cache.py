@@ -0,0 +1,186 @@
+"""
+回答キャッシュ（意味的キャッシュ）
+
+検索結果のチャンク集合が同じで、質問文Embeddingのコサイン類似度が
+しきい値以上の過去の回答を返す。
+各エントリはコレクションとそのコーパスバージョンを持ち、アップロード・削除で
+コレクションのバージョンが進むと、そのコレクションの古い回答は返さない。
+"""
+from config import settings
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, FrozenSet, Iterable, Optional, Sequence, Tuple
+import itertools
+import threading
+import time
+import numpy as np
+
+
+@dataclass
+class AnswerEntry:
+    """キャッシュ済みの回答1件"""
+    question_vector: np.ndarray
+    chunk_ids: FrozenSet[str]
+    collection: str
+    corpus_version: int
+    answer: str
+    expires_at: float
+
+
+class AnswerCache:
+    """
+    LRU・TTL付きの意味的回答キャッシュ
+
+    (コレクション, コーパスバージョン, チャンク集合) ごとにエントリをまとめ、
+    検索時はそのグループ内だけで類似度を計算する
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: int, threshold: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.threshold = threshold
+        self._entries: "OrderedDict[int, AnswerEntry]" = OrderedDict()
+        self._groups: Dict[Tuple[str, int, FrozenSet[str]], set] = {}
+        # コレクションごとの最新のコーパスバージョン
+        self._versions: Dict[str, int] = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0}
+
+    @staticmethod
+    def _normalize(embedding: Sequence[float]) -> Optional[np.ndarray]:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+
+    def _remove(self, entry_id: int) -> None:
+        entry = self._entries.pop(entry_id)
+        key = (entry.collection, entry.corpus_version, entry.chunk_ids)
+        group = self._groups.get(key)
+        if group is not None:
+            group.discard(entry_id)
+            if not group:
+                del self._groups[key]
+
+    def _evict_stale_versions(self, collection: str, corpus_version: int) -> None:
+        stale = [
+            i for i, e in self._entries.items()
+            if e.collection == collection and e.corpus_version != corpus_version
+        ]
+        for entry_id in stale:
+            self._remove(entry_id)
+
+    def lookup(
+        self,
+        question_embedding: Sequence[float],
+        chunk_ids: Iterable[str],
+        collection: str,
+        corpus_version: int
+    ) -> Optional[str]:
+        """
+        条件に合うキャッシュ済みの回答を取得
+
+        Args:
+            question_embedding: 質問文のEmbedding
+            chunk_ids: 今回の検索結果のチャンクID
+            collection: 検索したコレクション
+            corpus_version: 検索時点のコレクションのコーパスバージョン
+
+        Returns:
+            回答（該当がない場合はNone）
+        """
+        query = self._normalize(question_embedding)
+        key = (collection, corpus_version, frozenset(chunk_ids))
+        now = time.monotonic()
+
+        with self._lock:
+            best_id, best_similarity = None, self.threshold
+            for entry_id in list(self._groups.get(key, ())):
+                entry = self._entries[entry_id]
+                if entry.expires_at <= now:
+                    self._remove(entry_id)
+                    continue
+                similarity = float(entry.question_vector @ query) if query is not None else 0.0
+                if similarity >= best_similarity:
+                    best_id, best_similarity = entry_id, similarity
+
+            if best_id is None:
+                self._counters["misses"] += 1
+                return None
+            self._entries.move_to_end(best_id)
+            self._counters["hits"] += 1
+            return self._entries[best_id].answer
+
+    def store(
+        self,
+        question_embedding: Sequence[float],
+        chunk_ids: Iterable[str],
+        collection: str,
+        corpus_version: int,
+        answer: str
+    ) -> None:
+        """
+        回答をキャッシュに保存
+
+        Args:
+            question_embedding: 質問文のEmbedding
+            chunk_ids: 回答に使ったチャンクID
+            collection: 検索したコレクション
+            corpus_version: 検索時点のコレクションのコーパスバージョン
+            answer: 回答
+        """
+        query = self._normalize(question_embedding)
+        if query is None or self.max_size <= 0 or not answer:
+            return
+        entry = AnswerEntry(
+            question_vector=query,
+            chunk_ids=frozenset(chunk_ids),
+            collection=collection,
+            corpus_version=corpus_version,
+            answer=answer,
+            expires_at=time.monotonic() + self.ttl_seconds
+        )
+
+        with self._lock:
+            # コレクションが更新されたら、そのコレクションの古いバージョンの回答はまとめて破棄
+            # （他のコレクションの回答は残す）
+            newest = self._versions.get(collection)
+            if newest is not None and newest != corpus_version:
+                self._evict_stale_versions(collection, corpus_version)
+            self._versions[collection] = corpus_version
+
+            entry_id = next(self._ids)
+            self._entries[entry_id] = entry
+            self._groups.setdefault((collection, corpus_version, entry.chunk_ids), set()).add(entry_id)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def stats(self) -> dict:
+        """ヒット・ミスの回数とヒット率"""
+        with self._lock:
+            counters = dict(self._counters)
+            size = len(self._entries)
+        lookups = counters["hits"] + counters["misses"]
+        return {
+            **counters,
+            "hit_rate": round(counters["hits"] / lookups, 4) if lookups else 0.0,
+            "entries": size,
+        }
+
+
+_cache: Optional[AnswerCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_answer_cache() -> AnswerCache:
+    """プロセス共通の回答キャッシュを取得"""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = AnswerCache(
+                    settings.answer_cache_size,
+                    settings.answer_cache_ttl_seconds,
+                    settings.answer_cache_similarity_threshold
+                )
+    return _cache
@@ -0,0 +1,464 @@
+"""
+一括取り込み（複数ファイル・ZIP）
+
+登録（重複チェック・Storage送信・ファイル情報の保存）→ 抽出・チャンク分割 →
+Embedding生成 → チャンク保存 の各段階を上限付きの待ち行列でつなぎ、
+段階ごとに決まった数のワーカーで並行に処理する。
+あるファイルのEmbedding生成を待つ間に次のファイルの抽出が進むため、
+1件ずつ順に取り込むより全体の所要時間が短くなる。
+失敗したファイルはそのファイルだけを片付けて残りの取り込みを続け、
+ファイルごとの結果と全体のスループット（docs/s, chunks/s）をジョブに記録する。
+ZIPの展開後の合計サイズ・エントリ数が上限を超えた場合は、それ以降の展開をやめてジョブを失敗にする
+（圧縮率の高いファイルを多数含むZIPで一時ファイルの置き場が埋まらないように）。
+"""
+from config import settings
+from utils.collection import DEFAULT_COLLECTION
+from utils.concurrency import run_blocking
+from utils.ingestion import (
+    FILE_STATUS_PROCESSING,
+    FINISHED_STAGES,
+    STAGE_COMPLETED,
+    STAGE_EMBEDDING,
+    STAGE_EXTRACTING,
+    STAGE_FAILED,
+    STAGE_QUEUED,
+    STAGE_STORING,
+    embed_chunks,
+    extract_chunks,
+    get_ingestion_queue,
+    register_job_type,
+    store_chunks,
+)
+from utils.uploads import SpooledUpload, UploadTooLargeError, remove_spooled, spool_stream
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, List, Optional, Set, Tuple
+import asyncio
+import mimetypes
+import os
+import time
+import uuid
+import zipfile
+
+
+# 取り込み対象の拡張子
+ALLOWED_EXTENSIONS = {".pdf", ".txt", ".docx"}
+
+# 一括取り込みでのみ使うファイルの状態（ZIP内の対象外ファイルなど）
+STAGE_REGISTERING = "registering"
+STAGE_SKIPPED = "skipped"
+
+
+@dataclass
+class BulkFileResult:
+    """一括取り込みのファイルごとの結果"""
+    filename: str
+    file_id: Optional[str] = None
+    stage: str = STAGE_QUEUED
+    chunks: int = 0
+    # 同じ本文の既存チャンクからEmbeddingを再利用した数
+    chunks_reused: int = 0
+    error: Optional[str] = None
+
+
+@dataclass
+class BulkIngestionJob:
+    """一括取り込みジョブ"""
+    id: str = field(default_factory=lambda: str(uuid.uuid4()))
+    # 取り込み先のコレクション
+    collection: str = DEFAULT_COLLECTION
+    stage: str = STAGE_QUEUED
+    progress: float = 0.0
+    files: List[BulkFileResult] = field(default_factory=list)
+    docs_total: int = 0
+    docs_done: int = 0
+    docs_failed: int = 0
+    docs_skipped: int = 0
+    chunks_done: int = 0
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    # 取り込み開始から終了までの平均スループット
+    docs_per_second: float = 0.0
+    chunks_per_second: float = 0.0
+    error: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    updated_at: float = field(default_factory=time.time)
+
+    @property
+    def finished(self) -> bool:
+        return self.stage in FINISHED_STAGES
+
+    @property
+    def filename(self) -> str:
+        """ログ表示用"""
+        return f"一括取り込み（{len(self.files)}件）"
+
+    @property
+    def pending_file_ids(self) -> List[str]:
+        """中断した場合に状態を戻すファイル（登録済みで、完了・失敗していないもの）"""
+        return [
+            result.file_id
+            for result in self.files
+            if result.file_id and result.stage not in (STAGE_COMPLETED, STAGE_FAILED, STAGE_SKIPPED)
+        ]
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "BulkIngestionJob":
+        files = [BulkFileResult(**item) for item in data.pop("files", [])]
+        return cls(files=files, **data)
+
+
+register_job_type("BulkIngestionJob", BulkIngestionJob.from_dict)
+
+
+def is_supported(filename: str) -> bool:
+    return os.path.splitext(filename)[1].lower() in ALLOWED_EXTENSIONS
+
+
+def is_zip(filename: str) -> bool:
+    return os.path.splitext(filename)[1].lower() == ".zip"
+
+
+def zip_member_name(info: zipfile.ZipInfo) -> str:
+    """
+    ZIP内のファイル名（パスを除く）
+
+    UTF-8フラグのないエントリはWindowsで作られたShift_JIS（CP932）の名前として読み直す
+    """
+    name = info.filename
+    if not info.flag_bits & 0x800:
+        try:
+            name = name.encode("cp437").decode("cp932")
+        except (UnicodeEncodeError, UnicodeDecodeError):
+            pass
+    return name.replace("\\", "/").rsplit("/", 1)[-1]
+
+
+def is_ignored_member(info: zipfile.ZipInfo) -> bool:
+    """ディレクトリ・macOSのメタデータ・隠しファイルは結果にも含めない"""
+    if info.is_dir():
+        return True
+    parts = info.filename.replace("\\", "/").split("/")
+    return "__MACOSX" in parts or parts[-1].startswith(".")
+
+
+def spool_zip_member(
+    zip_path: str,
+    info: zipfile.ZipInfo,
+    filename: str,
+    max_bytes: Optional[int] = None
+) -> SpooledUpload:
+    """ZIP内のファイルを展開しながら一時ファイルに書き出す（上限は max_bytes、未指定時は MAX_UPLOAD_BYTES）"""
+    content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    with zipfile.ZipFile(zip_path) as archive, archive.open(info) as member:
+        return spool_stream(member, content_type, max_bytes=max_bytes)
+
+
+@dataclass
+class _Item:
+    """パイプラインを流れる1ファイル分の作業状態"""
+    result: BulkFileResult
+    spooled: SpooledUpload
+    storage_path: Optional[str] = None
+    chunks: List[str] = field(default_factory=list)
+    hashes: List[str] = field(default_factory=list)
+    embeddings: List[List[float]] = field(default_factory=list)
+
+
+# 段階の終わりを後段に伝える目印
+_DONE = object()
+
+
+async def run_stage(
+    inbox: asyncio.Queue,
+    outbox: Optional[asyncio.Queue],
+    handle: Callable[[_Item], Awaitable[bool]],
+    concurrency: int
+) -> None:
+    """
+    待ち行列から取り出した項目を concurrency 個のワーカーで処理し、次の段階へ渡す
+
+    handle が False を返した項目（失敗）は次の段階へ渡さない。
+    全ワーカーが終わったら後段に _DONE を送る。
+    """
+    async def worker() -> None:
+        while True:
+            item = await inbox.get()
+            if item is _DONE:
+                # 同じ段階の他のワーカーにも終わりを伝える
+                await inbox.put(_DONE)
+                return
+            if await handle(item) and outbox is not None:
+                await outbox.put(item)
+
+    await asyncio.gather(*[worker() for _ in range(max(1, concurrency))])
+    if outbox is not None:
+        await outbox.put(_DONE)
+
+
+class BulkIngestion:
+    """一括取り込みの1回分の実行"""
+
+    def __init__(self, job: BulkIngestionJob, store, uploads: List[Tuple[str, SpooledUpload]]):
+        self.job = job
+        self.store = store
+        self.uploads = uploads
+        # 同じ一括取り込みの中での重複チェック用
+        self._filenames: Set[str] = set()
+        self._content_hashes: Set[str] = set()
+        # 後片付けが必要な一時ファイル
+        self._spooled: Set[str] = {spooled.path for _, spooled in uploads}
+        # ZIPの展開の累計（上限の確認用）
+        self._zip_entries = 0
+        self._extracted_bytes = 0
+        # ジョブ全体を失敗にした理由（展開の上限超過）
+        self._abort_error: Optional[str] = None
+
+    async def run(self) -> None:
+        job = self.job
+        queue_size = settings.bulk_stage_queue_size
+        registering, extracting, embedding, storing = (asyncio.Queue(maxsize=queue_size) for _ in range(4))
+        # (入力, 出力, 段階, 処理, 同時実行数)
+        stages = [
+            (registering, extracting, STAGE_REGISTERING, self._register_file, settings.bulk_register_concurrency),
+            (extracting, embedding, STAGE_EXTRACTING, self._extract_file, settings.bulk_extract_concurrency),
+            (embedding, storing, STAGE_EMBEDDING, self._embed_file, settings.bulk_embed_concurrency),
+            (storing, None, STAGE_STORING, self._store_file, settings.bulk_store_concurrency),
+        ]
+
+        # 段階の処理がすべて終わったら、ジョブの段階を次へ進める
+        # （登録・抽出が終わると embedding、Embedding生成が終わると storing）
+        next_stages = {STAGE_EXTRACTING: STAGE_EMBEDDING, STAGE_EMBEDDING: STAGE_STORING}
+
+        async def run_tracked(inbox, outbox, stage, handle, concurrency) -> None:
+            await run_stage(inbox, outbox, self._guard(stage, handle), concurrency)
+            if stage in next_stages:
+                job.stage = next_stages[stage]
+                await self._save()
+
+        job.stage = STAGE_EXTRACTING
+        job.started_at = time.time()
+        await self._save()
+        try:
+            await asyncio.gather(
+                self._enqueue_sources(registering),
+                *[run_tracked(*stage) for stage in stages]
+            )
+        finally:
+            for path in self._spooled:
+                remove_spooled(path)
+
+        job.finished_at = time.time()
+        elapsed = max(job.finished_at - job.started_at, 1e-6)
+        job.docs_per_second = round(job.docs_done / elapsed, 3)
+        job.chunks_per_second = round(job.chunks_done / elapsed, 3)
+        job.progress = 1.0
+        if self._abort_error:
+            job.stage = STAGE_FAILED
+            job.error = self._abort_error
+        elif job.docs_done == 0 and job.docs_failed > 0:
+            job.stage = STAGE_FAILED
+            job.error = "すべてのファイルの取り込みに失敗しました"
+        else:
+            job.stage = STAGE_COMPLETED
+
+    async def _save(self) -> None:
+        job = self.job
+        if job.docs_total:
+            finished = job.docs_done + job.docs_failed + job.docs_skipped
+            job.progress = round(min(finished / job.docs_total, 0.99), 3)
+        await get_ingestion_queue().save_job(job)
+
+    def _add_result(self, filename: str, stage: str = STAGE_QUEUED, error: Optional[str] = None) -> BulkFileResult:
+        result = BulkFileResult(filename=filename, stage=stage, error=error)
+        self.job.files.append(result)
+        self.job.docs_total += 1
+        if stage == STAGE_SKIPPED:
+            self.job.docs_skipped += 1
+        return result
+
+    async def _enqueue_sources(self, outbox: asyncio.Queue) -> None:
+        """アップロードされたファイルとZIP内のファイルを順に登録段階へ送る"""
+        try:
+            for filename, spooled in self.uploads:
+                if self._abort_error:
+                    # 残りの一時ファイルは run の最後に削除する
+                    break
+                if is_zip(filename):
+                    await self._enqueue_zip(outbox, filename, spooled)
+                elif is_supported(filename):
+                    self._spooled.add(spooled.path)
+                    await outbox.put(_Item(result=self._add_result(filename), spooled=spooled))
+                else:
+                    self._add_result(filename, STAGE_SKIPPED, "サポートされていないファイル形式です")
+                    remove_spooled(spooled.path)
+        finally:
+            await outbox.put(_DONE)
+
+    async def _enqueue_zip(self, outbox: asyncio.Queue, zip_name: str, archive: SpooledUpload) -> None:
+        """ZIP内のファイルを1件ずつ一時ファイルに展開して送る（展開は後段の処理と並行に進む）"""
+        try:
+            infos = await run_blocking(lambda: zipfile.ZipFile(archive.path).infolist())
+        except zipfile.BadZipFile:
+            self._add_result(zip_name, STAGE_FAILED, "ZIPファイルを読み込めませんでした")
+            self.job.docs_failed += 1
+            remove_spooled(archive.path)
+            return
+
+        try:
+            # 展開する前に、ZIPのヘッダーの件数・サイズで上限を確認する
+            self._zip_entries += len(infos)
+            if self._zip_entries > settings.max_bulk_zip_entries:
+                self._abort(zip_name, f"ZIP内のファイル数が上限（{settings.max_bulk_zip_entries}件）を超えています")
+                return
+            declared = sum(info.file_size for info in infos if not is_ignored_member(info))
+            if self._extracted_bytes + declared > settings.max_bulk_uncompressed_bytes:
+                self._abort(zip_name, self._uncompressed_limit_message())
+                return
+
+            for info in infos:
+                if is_ignored_member(info):
+                    continue
+                filename = zip_member_name(info)
+                if not is_supported(filename):
+                    self._add_result(filename, STAGE_SKIPPED, "サポートされていないファイル形式です")
+                    continue
+                result = self._add_result(filename)
+                # ヘッダーのサイズは偽装できるため、展開中も合計の残りで打ち切る
+                remaining = settings.max_bulk_uncompressed_bytes - self._extracted_bytes
+                if remaining <= 0:
+                    self._abort(zip_name, self._uncompressed_limit_message(), result)
+                    return
+                try:
+                    spooled = await run_blocking(
+                        spool_zip_member, archive.path, info, filename, min(settings.max_upload_bytes, remaining)
+                    )
+                except UploadTooLargeError as e:
+                    if remaining < settings.max_upload_bytes:
+                        self._abort(zip_name, self._uncompressed_limit_message(), result)
+                        return
+                    self._mark_failed(result, e)
+                    continue
+                except Exception as e:
+                    self._mark_failed(result, e)
+                    continue
+                self._extracted_bytes += spooled.size
+                self._spooled.add(spooled.path)
+                await outbox.put(_Item(result=result, spooled=spooled))
+        finally:
+            remove_spooled(archive.path)
+
+    def _uncompressed_limit_message(self) -> str:
+        return f"ZIPの展開後の合計サイズが上限（{settings.max_bulk_uncompressed_bytes // (1024 * 1024)}MB）を超えています"
+
+    def _abort(self, zip_name: str, message: str, result: Optional[BulkFileResult] = None) -> None:
+        """展開の上限を超えたため、以降の展開をやめてジョブを失敗にする（展開済みのファイルは取り込みを続ける）"""
+        if result is not None:
+            self._mark_failed(result, ValueError(message))
+        self._abort_error = f"{zip_name}: {message}"
+        print(f"一括取り込み中止 ({self.job.id}): {self._abort_error}")
+
+    def _mark_failed(self, result: BulkFileResult, error: Exception) -> None:
+        result.stage = STAGE_FAILED
+        result.error = str(error)
+        self.job.docs_failed += 1
+        print(f"一括取り込み失敗 ({self.job.id}, {result.filename}): {str(error)}")
+
+    def _guard(self, stage: str, handle: Callable[[_Item], Awaitable[None]]) -> Callable[[_Item], Awaitable[bool]]:
+        """段階の処理を包み、失敗したファイルはそのファイルだけ片付けて結果に記録する"""
+        async def run(item: _Item) -> bool:
+            item.result.stage = stage
+            try:
+                await handle(item)
+                return True
+            except Exception as e:
+                await self._cleanup(item)
+                self._mark_failed(item.result, e)
+                await self._save()
+                return False
+        return run
+
+    async def _cleanup(self, item: _Item) -> None:
+        """失敗したファイルのファイル情報（CASCADEでchunksも）とStorageのファイルを削除"""
+        remove_spooled(item.spooled.path)
+        try:
+            if item.result.file_id:
+                await run_blocking(self.store.delete_file, item.result.file_id)
+            if item.storage_path:
+                await run_blocking(self.store.remove_objects, [item.storage_path])
+        except Exception:
+            pass
+
+    async def _register_file(self, item: _Item) -> None:
+        """重複チェックの後、Storageに送信してファイル情報を保存（status=processing）"""
+        filename = item.result.filename
+        content_hash = item.spooled.content_hash
+
+        # 同じ一括取り込みの中での重複（待たずに判定・登録するため競合しない）
+        if filename in self._filenames:
+            raise ValueError(f"同じファイル名「{filename}」が一括取り込みの中に複数あります。")
+        if content_hash in self._content_hashes:
+            raise ValueError("同じ内容のファイルが一括取り込みの中に複数あります。")
+        self._filenames.add(filename)
+        self._content_hashes.add(content_hash)
+
+        collection = self.job.collection
+        if await run_blocking(self.store.find_file, filename=filename, collection=collection):
+            raise ValueError(f"同じファイル名「{filename}」が既にアップロードされています。")
+        same_content = await run_blocking(self.store.find_file, content_hash=content_hash, collection=collection)
+        if same_content:
+            raise ValueError(f"同じ内容のファイル「{same_content['filename']}」が既にアップロードされています。")
+
+        storage_path = f"files/{uuid.uuid4()}{os.path.splitext(filename)[1]}"
+        await run_blocking(self.store.upload_object, storage_path, item.spooled)
+        item.storage_path = storage_path
+
+        row = await run_blocking(self.store.insert_file, {
+            "filename": filename,
+            "status": FILE_STATUS_PROCESSING,
+            "content_hash": content_hash,
+            "storage_path": storage_path,
+            "byte_size": item.spooled.size,
+            "collection": collection
+        })
+        if not row:
+            raise ValueError("ファイル情報の保存に失敗しました")
+        item.result.file_id = row["id"]
+
+    async def _extract_file(self, item: _Item) -> None:
+        try:
+            item.chunks = await extract_chunks(item.spooled.path, item.result.filename)
+        finally:
+            remove_spooled(item.spooled.path)
+        item.result.chunks = len(item.chunks)
+
+    async def _embed_file(self, item: _Item) -> None:
+        item.hashes, item.embeddings, item.result.chunks_reused = await embed_chunks(self.store, item.chunks)
+
+    async def _store_file(self, item: _Item) -> None:
+        await store_chunks(
+            self.store,
+            item.result.file_id,
+            item.result.filename,
+            item.chunks,
+            item.hashes,
+            item.embeddings,
+            collection=self.job.collection
+        )
+        item.result.stage = STAGE_COMPLETED
+        self.job.docs_done += 1
+        self.job.chunks_done += len(item.chunks)
+        # 保存済みのチャンクは次のファイルのために手放す
+        item.chunks, item.hashes, item.embeddings = [], [], []
+        await self._save()
+
+
+async def ingest_bulk(job: BulkIngestionJob, store, uploads: List[Tuple[str, SpooledUpload]]) -> None:
+    """
+    複数ファイル・ZIPをまとめて取り込む（ジョブ本体）
+
+    Args:
+        job: ジョブ
+        store: 保存先
+        uploads: (元のファイル名, 一時ファイル) のリスト。一時ファイルは成否によらず削除する
+    """
+    await BulkIngestion(job, store, uploads).run()
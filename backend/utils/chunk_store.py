@@ -0,0 +1,243 @@
+"""
+チャンクの一括保存
+
+Supabase（PostgREST）経由では、送信サイズ（バイト数）で区切ったバッチを複数同時に挿入する。
+EmbeddingはJSONの数値配列ではなくpgvectorのテキスト形式（有効桁数を落とした "[0.0123,...]"）で送り、
+IDはこちらで採番して挿入結果を返させないため、送受信量とJSONの処理が大きく減る。
+DATABASE_URL が設定されていれば、PostgreSQLに直接接続して COPY で流し込む
+（psycopg が必要。ローカルのPostgreSQL + pgvectorでも同じように動く）。
+ローカルの保存先（STORAGE_BACKEND=local）には1回の書き込みトランザクションで保存する。
+"""
+from config import settings
+from utils.concurrency import run_blocking
+from utils.metrics import record_batch
+from typing import Awaitable, Callable, List, Optional, Sequence
+import asyncio
+import json
+import threading
+import uuid
+
+try:
+    import psycopg
+except ImportError:
+    psycopg = None
+
+
+# チャンクの列（COPY の列順）
+CHUNK_COLUMNS = ("id", "file_id", "content", "content_hash", "embedding")
+
+
+def format_embedding(embedding: Sequence[float], precision: Optional[int] = None) -> str:
+    """
+    Embeddingをpgvectorのテキスト形式に変換
+
+    Args:
+        embedding: Embedding
+        precision: 有効桁数（未指定時は EMBEDDING_TEXT_PRECISION）
+
+    Returns:
+        "[0.0123,-0.0456,...]" 形式の文字列
+    """
+    pattern = f"%.{precision or settings.embedding_text_precision}g"
+    values = embedding.tolist() if hasattr(embedding, "tolist") else embedding
+    return "[" + ",".join([pattern % value for value in values]) + "]"
+
+
+def build_chunk_rows(
+    file_id: str,
+    chunks: List[str],
+    hashes: List[str],
+    embeddings: List[Sequence[float]]
+) -> List[dict]:
+    """保存するチャンクの行を作る（IDはここで採番する）"""
+    return [
+        {
+            "id": str(uuid.uuid4()),
+            "file_id": file_id,
+            "content": chunk,
+            "content_hash": digest,
+            "embedding": format_embedding(embedding)
+        }
+        for chunk, digest, embedding in zip(chunks, hashes, embeddings)
+    ]
+
+
+def plan_insert_batches(
+    rows: List[dict],
+    max_bytes: Optional[int] = None,
+    max_rows: Optional[int] = None
+) -> List[List[dict]]:
+    """
+    行を送信サイズ（JSONのバイト数）と行数の上限で区切る
+
+    1行で上限を超える場合はその行だけのバッチにする
+
+    Args:
+        rows: 行
+        max_bytes: 1バッチの上限バイト数（未指定時は CHUNK_INSERT_MAX_BYTES）
+        max_rows: 1バッチの上限行数（未指定時は CHUNK_INSERT_MAX_ROWS）
+
+    Returns:
+        バッチのリスト
+    """
+    max_bytes = max_bytes or settings.chunk_insert_max_bytes
+    max_rows = max_rows or settings.chunk_insert_max_rows
+
+    batches: List[List[dict]] = []
+    current: List[dict] = []
+    current_bytes = 0
+    for row in rows:
+        size = len(json.dumps(row)) + 1
+        if current and (current_bytes + size > max_bytes or len(current) >= max_rows):
+            batches.append(current)
+            current, current_bytes = [], 0
+        current.append(row)
+        current_bytes += size
+    if current:
+        batches.append(current)
+    return batches
+
+
+async def insert_rows_rest(
+    store,
+    rows: List[dict],
+    on_progress: Optional[Callable[[int], Awaitable[None]]] = None
+) -> None:
+    """
+    Supabase経由でバッチを並行に挿入（同時実行数は CHUNK_INSERT_CONCURRENCY）
+
+    Args:
+        store: 保存先（Supabase）
+        rows: 行
+        on_progress: 進捗通知（挿入済み件数）
+    """
+    semaphore = asyncio.Semaphore(max(1, settings.chunk_insert_concurrency))
+    done = 0
+
+    async def insert(batch: List[dict]) -> None:
+        nonlocal done
+        record_batch("chunk_insert", len(batch))
+        async with semaphore:
+            await run_blocking(store.insert_chunks, batch)
+        done += len(batch)
+        if on_progress is not None:
+            await on_progress(done)
+
+    await asyncio.gather(*[insert(batch) for batch in plan_insert_batches(rows)])
+
+
+class PostgresConnections:
+    """COPY 用の直接接続（使い終わった接続を少数だけ保持して使い回す）"""
+
+    def __init__(self, url: str, max_idle: int):
+        self.url = url
+        self.max_idle = max_idle
+        self._idle: list = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            while self._idle:
+                conn = self._idle.pop()
+                if not conn.closed:
+                    return conn
+        return psycopg.connect(self.url)
+
+    def release(self, conn) -> None:
+        with self._lock:
+            if not conn.closed and not conn.broken and len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def copy_rows(self, rows: List[dict]) -> None:
+        """行を COPY で挿入し、コミットする"""
+        conn = self.acquire()
+        try:
+            with conn.cursor() as cursor:
+                with cursor.copy(f"COPY chunks ({', '.join(CHUNK_COLUMNS)}) FROM STDIN") as copy:
+                    for row in rows:
+                        copy.write_row(tuple(row[column] for column in CHUNK_COLUMNS))
+            conn.commit()
+        except BaseException:
+            # 接続が切れている場合などにロールバック・切断が失敗しても、元の例外を投げ直す
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            try:
+                conn.close()
+            except Exception:
+                pass
+            raise
+        self.release(conn)
+
+
+_connections: Optional[PostgresConnections] = None
+_connections_lock = threading.Lock()
+_warned_missing_driver = False
+
+
+def get_postgres_connections() -> Optional[PostgresConnections]:
+    """
+    直接接続を取得（DATABASE_URL が未設定、または psycopg がない場合はNone）
+    """
+    global _connections, _warned_missing_driver
+    if not settings.database_url:
+        return None
+    if psycopg is None:
+        if not _warned_missing_driver:
+            _warned_missing_driver = True
+            print("警告: psycopgがインストールされていないため、DATABASE_URLを使わずSupabase経由でチャンクを保存します")
+        return None
+    if _connections is None:
+        with _connections_lock:
+            if _connections is None:
+                _connections = PostgresConnections(settings.database_url, settings.chunk_insert_concurrency)
+    return _connections
+
+
+def close_postgres_connections() -> None:
+    """終了時に保持している直接接続を閉じる"""
+    if _connections is not None:
+        _connections.close()
+
+
+async def insert_chunk_rows(
+    store,
+    rows: List[dict],
+    on_progress: Optional[Callable[[int], Awaitable[None]]] = None
+) -> None:
+    """
+    チャンクの行を挿入（DATABASE_URL があれば COPY、なければSupabase経由。ローカルの保存先には一括で）
+
+    Args:
+        store: 保存先
+        rows: build_chunk_rows で作った行
+        on_progress: 進捗通知（挿入済み件数）
+    """
+    if not rows:
+        return
+    if not store.parallel_inserts:
+        record_batch("chunk_insert", len(rows))
+        await run_blocking(store.insert_chunks, rows)
+        if on_progress is not None:
+            await on_progress(len(rows))
+        return
+
+    connections = get_postgres_connections()
+    if connections is None:
+        await insert_rows_rest(store, rows, on_progress=on_progress)
+        return
+
+    # COPY は行を流し続けるためバッチに分けない（1ファイル分を1回で送る）
+    record_batch("chunk_copy", len(rows))
+    await run_blocking(connections.copy_rows, rows)
+    if on_progress is not None:
+        await on_progress(len(rows))
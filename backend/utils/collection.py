@@ -0,0 +1,35 @@
+"""
+コレクション（互いに独立したナレッジベース）
+
+ファイルとチャンクはいずれか1つのコレクションに属し、
+検索・ファイル一覧・重複チェック・インメモリインデックスはコレクションごとに分かれる。
+コレクションは最初のアップロードで作られる（事前の登録は不要）。
+"""
+from fastapi import Query
+
+
+# collection を指定しない場合のコレクション（コレクション導入前のファイルもここに属する）
+DEFAULT_COLLECTION = "default"
+
+# コレクション名（英小文字・数字・アンダースコアで40文字まで）
+# pgvectorの部分インデックス名・コーパスバージョンのファイル名にそのまま使うため、使える文字を限る
+COLLECTION_PATTERN = r"^[a-z0-9][a-z0-9_]{0,39}$"
+
+
+class UnknownCollectionError(LookupError):
+    """ファイルが1つもない（作られていない）コレクション"""
+
+    def __init__(self, collection: str):
+        super().__init__(f"コレクション「{collection}」が見つかりません")
+        self.collection = collection
+
+
+def collection_query(
+    collection: str = Query(
+        DEFAULT_COLLECTION,
+        pattern=COLLECTION_PATTERN,
+        description="対象のコレクション（未指定時は default）"
+    )
+) -> str:
+    """依存性注入用: クエリパラメータ collection を取得（形式が不正な場合は422）"""
+    return collection
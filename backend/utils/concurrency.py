@@ -0,0 +1,41 @@
+"""
+同期I/Oのオフロードユーティリティ
+
+Supabaseクライアント（同期版）の execute() などブロッキングする呼び出しを
+上限付きのスレッドプールで実行し、イベントループを止めないようにする
+"""
+from config import settings
+from functools import partial
+from typing import Callable, Optional, TypeVar
+import anyio
+import anyio.to_thread
+
+
+T = TypeVar("T")
+
+_limiter: Optional[anyio.CapacityLimiter] = None
+
+
+def get_limiter() -> anyio.CapacityLimiter:
+    """ブロッキング処理用スレッドの同時実行数の上限"""
+    global _limiter
+    if _limiter is None:
+        _limiter = anyio.CapacityLimiter(settings.blocking_io_threads)
+    return _limiter
+
+
+async def run_blocking(func: Callable[..., T], *args, **kwargs) -> T:
+    """
+    ブロッキングする関数をスレッドプールで実行
+
+    例:
+        row = await run_blocking(store.get_file, file_id)
+
+    Args:
+        func: 実行する関数
+        *args, **kwargs: 関数の引数
+
+    Returns:
+        関数の戻り値
+    """
+    return await anyio.to_thread.run_sync(partial(func, *args, **kwargs), limiter=get_limiter())
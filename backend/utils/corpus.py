@@ -0,0 +1,76 @@
+"""
+コーパスバージョン管理ユーティリティ
+
+ファイルのアップロード・削除のたびにバージョンを進め、
+同一ホスト上の全ワーカーがナレッジベースの変更を検知できるようにする
+バージョンはコレクションごとに持ち、他のコレクションの変更では進まない
+"""
+from config import settings
+from utils.collection import DEFAULT_COLLECTION
+from typing import Tuple
+import fcntl
+import os
+
+
+VERSION_FILENAME = "corpus_version"
+
+
+def _version_path(collection: str) -> str:
+    """バージョンファイルのパスを取得（ディレクトリがなければ作成。default はコレクション導入前と同じファイル）"""
+    os.makedirs(settings.local_state_dir, exist_ok=True)
+    filename = VERSION_FILENAME if collection == DEFAULT_COLLECTION else f"{VERSION_FILENAME}.{collection}"
+    return os.path.join(settings.local_state_dir, filename)
+
+
+def _read(f) -> int:
+    f.seek(0)
+    raw = f.read().strip()
+    try:
+        return int(raw) if raw else 0
+    except ValueError:
+        return 0
+
+
+def current_version(collection: str = DEFAULT_COLLECTION) -> int:
+    """
+    現在のコーパスバージョンを取得
+
+    Args:
+        collection: コレクション
+
+    Returns:
+        コーパスバージョン（未作成の場合は0）
+    """
+    try:
+        with open(_version_path(collection), "r") as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            try:
+                return _read(f)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+    except FileNotFoundError:
+        return 0
+
+
+def bump_version(collection: str = DEFAULT_COLLECTION) -> Tuple[int, int]:
+    """
+    コーパスバージョンを1つ進める
+
+    Args:
+        collection: コレクション
+
+    Returns:
+        (更新前のバージョン, 更新後のバージョン)
+    """
+    with open(_version_path(collection), "a+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            previous = _read(f)
+            f.seek(0)
+            f.truncate()
+            f.write(str(previous + 1))
+            f.flush()
+            os.fsync(f.fileno())
+            return previous, previous + 1
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
@@ -1,66 +1,253 @@
 """
 Embedding生成ユーティリティ
 """
-from openai import OpenAI
+from openai import APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+from openai_client import get_async_openai_client
 from config import settings
-from typing import List
-import numpy as np
+from utils.concurrency import run_blocking
+from utils.embedding_cache import get_embedding_cache
+from utils.metrics import record_batch, record_retry, record_usage, span
+from utils.tokenizer import count_tokens
+from typing import Awaitable, Callable, List, Optional
+import asyncio
+import random
 
 
-def get_openai_client() -> OpenAI:
-    """
-    OpenAIクライアントを取得
-    
-    Returns:
-        OpenAIクライアント
-    """
-    return OpenAI(api_key=settings.openai_api_key)
+# 再試行の対象（レート制限・タイムアウト・接続エラー・5xx）
+RETRYABLE_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
 
 
-def generate_embedding(text: str, model: str = "text-embedding-ada-002") -> List[float]:
+class EmbeddingError(ValueError):
+    """Embeddingの生成に失敗した（OpenAI APIの障害・タイムアウト・レート制限など。リクエストの誤りではない）"""
+
+
+async def generate_embedding(text: str, model: str = "text-embedding-ada-002") -> List[float]:
     """
     テキストからEmbeddingを生成
     
+    同じ質問文（正規化後）はキャッシュから返し、OpenAI APIを呼ばない
+    
     Args:
         text: テキスト
         model: 使用するモデル名
         
     Returns:
         Embeddingベクトル（リスト）
+        
+    Raises:
+        EmbeddingError: Embeddingの生成に失敗した場合
     """
+    cache = get_embedding_cache()
+    # 永続キャッシュはSQLiteを読むため、スレッドプールで実行
+    with span("embedding_cache"):
+        cached = await run_blocking(cache.get, model, text)
+    if cached is not None:
+        return cached.tolist()
+    
     try:
-        client = get_openai_client()
+        client = get_async_openai_client()
         
-        response = client.embeddings.create(
-            model=model,
-            input=text
-        )
+        with span("embedding"):
+            response = await client.embeddings.create(
+                model=model,
+                input=text
+            )
         
-        return response.data[0].embedding
+        embedding = response.data[0].embedding
+        record_usage(model, response.usage)
     except Exception as e:
-        raise ValueError(f"Embedding生成に失敗しました: {str(e)}")
+        raise EmbeddingError(f"Embedding生成に失敗しました: {str(e)}")
+    
+    await run_blocking(cache.set, model, text, embedding)
+    return embedding
 
 
-def generate_embeddings_batch(texts: List[str], model: str = "text-embedding-ada-002") -> List[List[float]]:
+def plan_batches(texts: List[str], max_tokens: int, max_inputs: int) -> List[List[int]]:
     """
-    複数のテキストからEmbeddingを一括生成
+    入力をトークン数と件数の上限に収まるサブバッチに分割
+    
+    Args:
+        texts: テキストのリスト
+        max_tokens: 1リクエストあたりの合計トークン数の上限
+        max_inputs: 1リクエストあたりの入力件数の上限
+        
+    Returns:
+        サブバッチごとの入力インデックスのリスト（入力順）
+    """
+    batches: List[List[int]] = []
+    current: List[int] = []
+    current_tokens = 0
+    
+    for i, text in enumerate(texts):
+        tokens = count_tokens(text)
+        if current and (current_tokens + tokens > max_tokens or len(current) >= max_inputs):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += tokens
+    
+    if current:
+        batches.append(current)
+    return batches
+
+
+def retry_delay(attempt: int, error: Exception) -> float:
+    """
+    再試行までの待ち時間（指数バックオフ + フルジッター）
+    
+    レート制限の応答にRetry-Afterがあればそれ以上待つ
+    """
+    delay = min(settings.embedding_retry_max_delay, settings.embedding_retry_base_delay * (2 ** attempt))
+    delay = random.uniform(0, delay)
+    
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            delay = max(delay, float(retry_after))
+        except ValueError:
+            pass
+    return delay
+
+
+async def embed_with_retry(texts: List[str], model: str) -> List[List[float]]:
+    """
+    1サブバッチ分のEmbeddingを生成（レート制限・一時的なエラーは再試行）
     
     Args:
         texts: テキストのリスト
         model: 使用するモデル名
         
     Returns:
-        Embeddingベクトルのリスト
+        Embeddingベクトルのリスト（入力順）
+    
+    再試行の回数は /metrics（smallbase_openai_retries_total）で確認する
+    （レート制限中はサブバッチごとに再試行が続くため、ログには出さない）
     """
-    try:
-        client = get_openai_client()
+    # 再試行はここで制御するため、SDK側の自動再試行は無効にする
+    client = get_async_openai_client().with_options(max_retries=0)
+    record_batch("embedding", len(texts))
+    
+    attempt = 0
+    while True:
+        try:
+            response = await client.embeddings.create(
+                model=model,
+                input=texts
+            )
+            record_usage(model, response.usage)
+            # 応答の順序は index で保証されている
+            return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+        except RETRYABLE_ERRORS as e:
+            if attempt >= settings.embedding_max_retries:
+                raise
+            record_retry("embedding", e)
+            await asyncio.sleep(retry_delay(attempt, e))
+            attempt += 1
+
+
+async def generate_embeddings_batch(
+    texts: List[str],
+    model: str = "text-embedding-ada-002",
+    on_progress: Optional[Callable[[int], Awaitable[None]]] = None
+) -> List[List[float]]:
+    """
+    複数のテキストからEmbeddingを一括生成
+    
+    入力をトークン数・件数の上限に収まるサブバッチに分割し、
+    同時実行数を制限しながら並行して生成する
+    
+    Args:
+        texts: テキストのリスト
+        model: 使用するモデル名
+        on_progress: サブバッチ完了ごとに生成済みの件数を受け取るコールバック
         
-        response = client.embeddings.create(
-            model=model,
-            input=texts
-        )
+    Returns:
+        Embeddingベクトルのリスト（入力順）
         
-        return [item.embedding for item in response.data]
+    Raises:
+        EmbeddingError: Embeddingの生成に失敗した場合
+    """
+    if not texts:
+        return []
+    
+    batches = plan_batches(
+        texts,
+        settings.embedding_batch_max_tokens,
+        settings.embedding_batch_max_inputs
+    )
+    results: List[Optional[List[float]]] = [None] * len(texts)
+    semaphore = asyncio.Semaphore(settings.embedding_concurrency)
+    done = 0
+    
+    async def run(indices: List[int]) -> None:
+        nonlocal done
+        async with semaphore:
+            vectors = await embed_with_retry([texts[i] for i in indices], model)
+        for i, vector in zip(indices, vectors):
+            results[i] = vector
+        done += len(indices)
+        if on_progress is not None:
+            await on_progress(done)
+    
+    tasks = [asyncio.create_task(run(indices)) for indices in batches]
+    try:
+        await asyncio.gather(*tasks)
     except Exception as e:
-        raise ValueError(f"Embedding一括生成に失敗しました: {str(e)}")
+        # 1つでも失敗したら残りのサブバッチは取り消す
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise EmbeddingError(f"Embedding一括生成に失敗しました: {str(e)}")
+    
+    return results
+
 
+async def generate_query_embeddings(
+    texts: List[str],
+    model: str = "text-embedding-ada-002"
+) -> List[List[float]]:
+    """
+    複数の質問文のEmbeddingを生成（キャッシュにない質問だけを一括生成）
+    
+    全く同じ質問文が複数含まれていても1回だけ生成する
+    
+    Args:
+        texts: 質問文のリスト
+        model: 使用するモデル名
+        
+    Returns:
+        Embeddingベクトルのリスト（入力順）
+        
+    Raises:
+        EmbeddingError: Embeddingの生成に失敗した場合
+    """
+    cache = get_embedding_cache()
+    unique = list(dict.fromkeys(texts))
+    
+    def lookup() -> List[Optional[List[float]]]:
+        found = []
+        for text in unique:
+            cached = cache.get(model, text)
+            found.append(cached.tolist() if cached is not None else None)
+        return found
+    
+    # 永続キャッシュはSQLiteを読むため、まとめてスレッドプールで実行
+    with span("embedding_cache"):
+        vectors = await run_blocking(lookup)
+    
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    if missing:
+        with span("embedding"):
+            generated = await generate_embeddings_batch([unique[i] for i in missing], model)
+        
+        def store() -> None:
+            for i, vector in zip(missing, generated):
+                cache.set(model, unique[i], vector)
+        
+        for i, vector in zip(missing, generated):
+            vectors[i] = vector
+        await run_blocking(store)
+    
+    by_text = dict(zip(unique, vectors))
+    return [by_text[text] for text in texts]
@@ -0,0 +1,229 @@
+"""
+Embeddingキャッシュ
+
+キーは (モデル名, 正規化した質問文) のSHA-256。
+    1段目: プロセス内のLRU（TTL付き）
+    2段目: SQLite（任意）。再起動後も残り、同一ホストのワーカー間で共有される
+ベクトルはfloat32のバイト列として保持する。
+"""
+from config import settings
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+import numpy as np
+
+
+def normalize_text(text: str) -> str:
+    """全角・半角の揺れと空白の違いを吸収"""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+def cache_key(model: str, text: str) -> str:
+    """キャッシュキーを作成"""
+    return hashlib.sha256(f"{model}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+class PersistentEmbeddingStore:
+    """SQLiteによる永続キャッシュ（WALモードで複数プロセスから読み書き）"""
+
+    # この回数の書き込みごとに期限切れ・上限超過分を削除する
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path: str, ttl_seconds: int, max_entries: int):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._writes = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=5.0, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embedding_cache ("
+            " key TEXT PRIMARY KEY,"
+            " vector BLOB NOT NULL,"
+            " created_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT vector, created_at FROM embedding_cache WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or row[1] < time.time() - self.ttl_seconds:
+            return None
+        return np.frombuffer(row[0], dtype=np.float32)
+
+    def set(self, key: str, vector: np.ndarray) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO embedding_cache (key, vector, created_at) VALUES (?, ?, ?)",
+                (key, sqlite3.Binary(vector.tobytes()), time.time())
+            )
+            self._writes += 1
+            if self._writes % self.PRUNE_EVERY == 0:
+                self._prune()
+            self._conn.commit()
+
+    def _prune(self) -> None:
+        self._conn.execute(
+            "DELETE FROM embedding_cache WHERE created_at < ?", (time.time() - self.ttl_seconds,)
+        )
+        self._conn.execute(
+            "DELETE FROM embedding_cache WHERE key IN ("
+            " SELECT key FROM embedding_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class EmbeddingCache:
+    """
+    2段構成のEmbeddingキャッシュ
+
+    ヒット・ミスの回数は stats() で取得できる
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        ttl_seconds: int,
+        persistent: Optional[PersistentEmbeddingStore] = None
+    ):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.persistent = persistent
+        self._entries: "OrderedDict[str, Tuple[np.ndarray, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters: Dict[str, int] = {"memory_hits": 0, "persistent_hits": 0, "misses": 0}
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counters[name] += 1
+
+    def _get_memory(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            vector, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return vector
+
+    def _set_memory(self, key: str, vector: np.ndarray) -> None:
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (vector, time.monotonic() + self.ttl_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get(self, model: str, text: str) -> Optional[np.ndarray]:
+        """
+        キャッシュからEmbeddingを取得
+
+        Args:
+            model: モデル名
+            text: 入力テキスト
+
+        Returns:
+            float32配列（キャッシュにない場合はNone）
+        """
+        key = cache_key(model, text)
+        vector = self._get_memory(key)
+        if vector is not None:
+            self._count("memory_hits")
+            return vector
+
+        if self.persistent is not None:
+            try:
+                vector = self.persistent.get(key)
+            except sqlite3.Error as e:
+                print(f"警告: Embeddingキャッシュの読み込みに失敗しました: {str(e)}")
+                vector = None
+            if vector is not None:
+                self._set_memory(key, vector)
+                self._count("persistent_hits")
+                return vector
+
+        self._count("misses")
+        return None
+
+    def set(self, model: str, text: str, embedding) -> None:
+        """
+        Embeddingをキャッシュに保存
+
+        Args:
+            model: モデル名
+            text: 入力テキスト
+            embedding: Embeddingベクトル
+        """
+        key = cache_key(model, text)
+        vector = np.asarray(embedding, dtype=np.float32)
+        self._set_memory(key, vector)
+        if self.persistent is not None:
+            try:
+                self.persistent.set(key, vector)
+            except sqlite3.Error as e:
+                print(f"警告: Embeddingキャッシュの書き込みに失敗しました: {str(e)}")
+
+    def stats(self) -> dict:
+        """ヒット・ミスの回数とヒット率"""
+        with self._lock:
+            counters = dict(self._counters)
+            size = len(self._entries)
+        lookups = counters["memory_hits"] + counters["persistent_hits"] + counters["misses"]
+        hits = lookups - counters["misses"]
+        return {
+            **counters,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "memory_entries": size,
+            "persistent": self.persistent is not None,
+        }
+
+
+_cache: Optional[EmbeddingCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    """プロセス共通のEmbeddingキャッシュを取得"""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                persistent = None
+                if settings.embedding_cache_persistent:
+                    path = settings.embedding_cache_path or os.path.join(
+                        settings.local_state_dir, "embedding_cache.sqlite3"
+                    )
+                    try:
+                        persistent = PersistentEmbeddingStore(
+                            path,
+                            settings.embedding_cache_persistent_ttl_seconds,
+                            settings.embedding_cache_persistent_max_entries
+                        )
+                    except sqlite3.Error as e:
+                        print(f"警告: 永続Embeddingキャッシュを開けません。メモリのみで動作します: {str(e)}")
+                _cache = EmbeddingCache(
+                    settings.embedding_cache_size,
+                    settings.embedding_cache_ttl_seconds,
+                    persistent
+                )
+    return _cache
@@ -0,0 +1,647 @@
+"""
+取り込みジョブキュー
+
+アップロードされたファイルのテキスト抽出・チャンク分割・Embedding生成・保存を
+HTTPリクエストから切り離し、上限付きのワーカーでバックグラウンド実行する。
+ジョブの状態はSQLiteに保存し、同一ホストのどのワーカーからでも参照できる。
+起動時には、終了したプロセスが実行していた未完了のジョブを失敗にし、ファイルの状態を戻す。
+"""
+from config import settings
+from utils.collection import DEFAULT_COLLECTION
+from utils.chunk_store import build_chunk_rows, format_embedding, insert_chunk_rows
+from utils.concurrency import run_blocking
+from utils.embedding import generate_embeddings_batch
+from utils.metrics import span
+from utils.owner import is_alive, process_id, remove_dead_owners
+from utils.store import get_store
+from utils.text_extractor import iter_chunks, iter_text
+from utils.uploads import remove_orphaned_spools, remove_spooled
+from utils.vector_index import get_vector_index, parse_embedding
+from dataclasses import asdict, dataclass, field
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+
+# ジョブの段階
+STAGE_QUEUED = "queued"
+STAGE_EXTRACTING = "extracting"
+STAGE_EMBEDDING = "embedding"
+STAGE_STORING = "storing"
+STAGE_COMPLETED = "completed"
+STAGE_FAILED = "failed"
+
+FINISHED_STAGES = (STAGE_COMPLETED, STAGE_FAILED)
+
+# filesテーブルのstatus列
+FILE_STATUS_PROCESSING = "processing"
+FILE_STATUS_READY = "ready"
+# 差分取り込み中（旧版は検索対象のまま。同じファイルの更新は受け付けない）
+FILE_STATUS_UPDATING = "updating"
+# 取り込みが中断された（サーバーの停止など。削除してからアップロードし直す）
+FILE_STATUS_FAILED = "failed"
+
+# 起動時に失敗にしたジョブのエラー
+INTERRUPTED_ERROR = "サーバーの停止により取り込みが中断されました。もう一度アップロードしてください。"
+
+@dataclass
+class IngestionJob:
+    """取り込みジョブ"""
+    file_id: str
+    filename: str
+    # ファイルの属するコレクション
+    collection: str = DEFAULT_COLLECTION
+    id: str = field(default_factory=lambda: str(uuid.uuid4()))
+    stage: str = STAGE_QUEUED
+    progress: float = 0.0
+    chunks_total: int = 0
+    chunks_done: int = 0
+    # 同じ本文の既存チャンクからEmbeddingを再利用した数
+    chunks_reused: int = 0
+    # 更新時に削除したチャンク数
+    chunks_removed: int = 0
+    error: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    updated_at: float = field(default_factory=time.time)
+
+    @property
+    def finished(self) -> bool:
+        return self.stage in FINISHED_STAGES
+
+    @property
+    def pending_file_ids(self) -> List[str]:
+        """中断した場合に状態を戻すファイル"""
+        return [] if self.finished else [self.file_id]
+
+
+# 保存するジョブの種類（クラス名 → 辞書から復元する関数）
+JOB_TYPES: Dict[str, Callable[[dict], object]] = {
+    "IngestionJob": lambda data: IngestionJob(**data),
+}
+
+
+def register_job_type(name: str, load: Callable[[dict], object]) -> None:
+    """JobStore で保存・復元するジョブの種類を追加"""
+    JOB_TYPES[name] = load
+
+
+class JobStore:
+    """
+    ジョブ状態の保存先（SQLite・WALモード）
+
+    ジョブを保存したプロセスのID（utils.owner）を owner 列に記録する
+    """
+
+    def __init__(self, path: str, retention_seconds: int):
+        self.retention_seconds = retention_seconds
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=5.0, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS ingestion_jobs ("
+            " id TEXT PRIMARY KEY,"
+            " data TEXT NOT NULL,"
+            " updated_at REAL NOT NULL,"
+            " owner TEXT)"
+        )
+        # owner 列のない（以前に作った）テーブルに追加
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(ingestion_jobs)").fetchall()}
+        if "owner" not in columns:
+            self._conn.execute("ALTER TABLE ingestion_jobs ADD COLUMN owner TEXT")
+        self._conn.commit()
+
+    def save(self, job: IngestionJob) -> None:
+        job.updated_at = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO ingestion_jobs (id, data, updated_at, owner) VALUES (?, ?, ?, ?)",
+                (
+                    job.id,
+                    json.dumps({"kind": type(job).__name__, **asdict(job)}, ensure_ascii=False),
+                    job.updated_at,
+                    process_id()
+                )
+            )
+            self._conn.commit()
+
+    def get(self, job_id: str):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM ingestion_jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return self._load(row[0])
+
+    @staticmethod
+    def _load(raw: str):
+        data = json.loads(raw)
+        load = JOB_TYPES.get(data.pop("kind", "IngestionJob"))
+        return load(data) if load else None
+
+    def interrupted(self) -> list:
+        """保存したプロセスが終了した、未完了のジョブ"""
+        with self._lock:
+            rows = self._conn.execute("SELECT data, owner FROM ingestion_jobs").fetchall()
+        jobs = []
+        for raw, owner in rows:
+            job = self._load(raw)
+            if job is not None and not job.finished and not is_alive(owner):
+                jobs.append(job)
+        return jobs
+
+    def prune(self) -> None:
+        """保持期間を過ぎたジョブを削除"""
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM ingestion_jobs WHERE updated_at < ?",
+                (time.time() - self.retention_seconds,)
+            )
+            self._conn.commit()
+
+
+class QueueFullError(Exception):
+    """ジョブキューが満杯"""
+
+
+class IngestionQueue:
+    """
+    上限付きの取り込みワーカープール
+
+    ワーカー数は INGESTION_WORKERS、待ち行列の長さは INGESTION_QUEUE_SIZE で設定する
+    """
+
+    def __init__(self, store: JobStore, workers: int, max_queued: int):
+        self.store = store
+        self.workers = workers
+        self.max_queued = max_queued
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+    async def start(self) -> None:
+        self._queue = asyncio.Queue(maxsize=self.max_queued)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        await run_blocking(self.store.prune)
+        try:
+            await self.recover()
+        except Exception as e:
+            print(f"警告: 中断された取り込みジョブを片付けられませんでした: {str(e)}")
+
+    async def recover(self) -> int:
+        """
+        終了したプロセスが実行していた未完了のジョブを失敗にし、ファイルの状態を戻す
+
+        取り込み中（processing）のファイルは failed に、差分取り込み中（updating）のファイルは
+        旧版が残っているため ready に戻す。ジョブの一時ファイルは残っていても再実行せずに削除する。
+
+        Returns:
+            失敗にしたジョブの数
+        """
+        jobs = await run_blocking(self.store.interrupted)
+        store = get_store() if jobs else None
+        for job in jobs:
+            for file_id in job.pending_file_ids:
+                await finish_update(store, file_id)
+                await run_blocking(store.update_file_status, file_id, FILE_STATUS_FAILED, FILE_STATUS_PROCESSING)
+            job.stage = STAGE_FAILED
+            job.error = INTERRUPTED_ERROR
+            await self.save_job(job)
+            print(f"中断された取り込みジョブを失敗にしました ({job.id}, {job.filename})")
+        await run_blocking(remove_orphaned_spools)
+        await run_blocking(remove_dead_owners)
+        return len(jobs)
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, job: IngestionJob, run: Callable[[IngestionJob], Awaitable[None]]) -> None:
+        """
+        ジョブを登録し、ワーカーの空きを待たずに戻る
+
+        Args:
+            job: ジョブ
+            run: ジョブ本体（進捗は job を更新して save_job で保存する）
+
+        Raises:
+            QueueFullError: 待ち行列が満杯の場合
+        """
+        if self._queue is None:
+            raise RuntimeError("取り込みキューが起動していません")
+        if self._queue.full():
+            raise QueueFullError("取り込み待ちのファイルが多すぎます。しばらくしてから再試行してください。")
+        await self.save_job(job)
+        self._queue.put_nowait((job, run))
+
+    async def save_job(self, job: IngestionJob) -> None:
+        await run_blocking(self.store.save, job)
+
+    async def get_job(self, job_id: str):
+        return await run_blocking(self.store.get, job_id)
+
+    async def _worker(self) -> None:
+        while True:
+            job, run = await self._queue.get()
+            try:
+                await run(job)
+            except Exception as e:
+                job.stage = STAGE_FAILED
+                job.error = str(e)
+                print(f"取り込みジョブ失敗 ({job.id}, {job.filename}): {str(e)}")
+            finally:
+                try:
+                    await self.save_job(job)
+                except Exception as e:
+                    print(f"警告: ジョブ状態の保存に失敗しました ({job.id}): {str(e)}")
+                self._queue.task_done()
+
+
+_queue: Optional[IngestionQueue] = None
+
+
+def get_ingestion_queue() -> IngestionQueue:
+    """プロセス共通の取り込みキューを取得"""
+    global _queue
+    if _queue is None:
+        store = JobStore(
+            os.path.join(settings.local_state_dir, "ingestion_jobs.sqlite3"),
+            settings.ingestion_job_retention_seconds
+        )
+        _queue = IngestionQueue(store, settings.ingestion_workers, settings.ingestion_queue_size)
+    return _queue
+
+
+async def start_ingestion_queue() -> None:
+    """起動時にワーカーを開始"""
+    await get_ingestion_queue().start()
+
+
+async def stop_ingestion_queue() -> None:
+    """終了時にワーカーを停止"""
+    if _queue is not None:
+        await _queue.stop()
+
+
+def chunk_hash(content: str) -> str:
+    """チャンク本文のSHA-256（16進）"""
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+async def find_existing_embeddings(store, hashes: Iterable[str]) -> Dict[str, List[float]]:
+    """
+    同じ本文の保存済みチャンクからEmbeddingを取得
+
+    Args:
+        store: 保存先
+        hashes: チャンク本文のハッシュ
+
+    Returns:
+        ハッシュ → Embedding（見つかったものだけ）
+    """
+    found: Dict[str, List[float]] = {}
+    rows = await run_blocking(store.find_embeddings, list(dict.fromkeys(hashes)))
+    for row in rows:
+        if row["content_hash"] in found:
+            continue
+        vector = parse_embedding(row.get("embedding"))
+        if vector is not None and vector.size == settings.embedding_dimensions:
+            found[row["content_hash"]] = vector.tolist()
+    return found
+
+
+async def embed_chunks(
+    store,
+    chunks: List[str],
+    on_progress: Optional[Callable[[int, int], Awaitable[None]]] = None
+) -> Tuple[List[str], List[List[float]], int]:
+    """
+    チャンクのEmbeddingを用意する（同じ本文は既存のものを再利用）
+
+    文書内で重複する本文は1回だけ、保存済みのチャンクと同じ本文は
+    OpenAIを呼ばずに既存のEmbeddingを使う。
+
+    Args:
+        store: 保存先
+        chunks: チャンク本文のリスト
+        on_progress: 進捗通知（生成済み件数, 生成が必要な件数）
+
+    Returns:
+        (チャンクのハッシュ, Embedding, 再利用した件数)
+    """
+    hashes = [chunk_hash(chunk) for chunk in chunks]
+    known = await find_existing_embeddings(store, hashes)
+
+    missing: Dict[str, str] = {}
+    for digest, chunk in zip(hashes, chunks):
+        if digest not in known:
+            missing.setdefault(digest, chunk)
+
+    if missing:
+        generated = await generate_embeddings_batch(
+            list(missing.values()),
+            on_progress=(lambda done: on_progress(done, len(missing))) if on_progress else None
+        )
+        known.update(zip(missing.keys(), generated))
+
+    reused = sum(1 for digest in hashes if digest not in missing)
+    return hashes, [known[digest] for digest in hashes], reused
+
+
+async def extract_chunks(source_path: str, filename: str) -> List[str]:
+    """
+    ファイルからチャンクを作る
+
+    抽出とチャンク分割はCPU処理のためスレッドプールで実行する
+    （ページ単位の抽出結果を順にチャンクにするため、文書全体の文字列は作らない）
+    """
+    chunks = await run_blocking(lambda: list(iter_chunks(iter_text(source_path, filename))))
+    if not chunks:
+        raise ValueError("ファイルからテキストを抽出できませんでした")
+    return chunks
+
+
+async def store_chunks(
+    store,
+    file_id: str,
+    filename: str,
+    chunks: List[str],
+    hashes: List[str],
+    embeddings: List[List[float]],
+    on_progress: Optional[Callable[[int], Awaitable[None]]] = None,
+    collection: str = DEFAULT_COLLECTION
+) -> List[str]:
+    """
+    チャンクを保存し、ファイルを検索対象（status=ready）にする
+
+    Args:
+        store: 保存先
+        file_id: ファイルID
+        filename: ファイル名
+        chunks: チャンク本文
+        hashes: チャンク本文のハッシュ
+        embeddings: Embedding
+        on_progress: 進捗通知（保存済み件数）
+        collection: ファイルの属するコレクション（追加先のインメモリインデックス）
+
+    Returns:
+        保存したチャンクのID
+    """
+    # 送信サイズで区切ったバッチを並行に挿入（DATABASE_URL があれば COPY）
+    rows = build_chunk_rows(file_id, chunks, hashes, embeddings)
+    await insert_chunk_rows(store, rows, on_progress=on_progress)
+    inserted_ids = [row["id"] for row in rows]
+
+    # 検索対象にする（チャンク数は一覧で集計しないようここで記録する）
+    await run_blocking(store.update_file, file_id, {
+        "status": FILE_STATUS_READY,
+        "chunk_count": len(rows)
+    })
+
+    # インメモリインデックスに差分追加（全件再読み込みはしない）
+    await run_blocking(
+        get_vector_index(collection).add_file,
+        file_id,
+        filename,
+        inserted_ids,
+        chunks,
+        embeddings
+    )
+    return inserted_ids
+
+
+async def ingest_file(
+    job: IngestionJob,
+    store,
+    source_path: str,
+    storage_path: str
+) -> None:
+    """
+    アップロード済みファイルを取り込む（ジョブ本体）
+
+    抽出 → チャンク分割 → Embedding生成 → チャンク保存 の順に進め、
+    完了したらファイルを検索対象（status=ready）にする。
+    失敗した場合はファイル情報とStorageのファイルを削除する。
+    アップロードの一時ファイルは成否によらず最後に削除する。
+
+    Args:
+        job: ジョブ
+        store: 保存先
+        source_path: アップロードの一時ファイルのパス
+        storage_path: Storage上のパス（失敗時の削除用）
+    """
+    queue = get_ingestion_queue()
+
+    async def advance(stage: str, progress: float) -> None:
+        job.stage = stage
+        job.progress = round(progress, 3)
+        await queue.save_job(job)
+
+    try:
+        await advance(STAGE_EXTRACTING, 0.05)
+        with span("ingest_extract"):
+            chunks = await extract_chunks(source_path, job.filename)
+        job.chunks_total = len(chunks)
+
+        # Embeddingを一括生成（同じ本文のチャンクは既存のEmbeddingを再利用）
+        await advance(STAGE_EMBEDDING, 0.2)
+        with span("ingest_embedding"):
+            hashes, embeddings, job.chunks_reused = await embed_chunks(
+                store,
+                chunks,
+                on_progress=lambda done, total: advance(STAGE_EMBEDDING, 0.2 + 0.4 * done / total)
+            )
+
+        # チャンクとEmbeddingをデータベースに保存し、検索対象にする
+        await advance(STAGE_STORING, 0.6)
+
+        async def stored(done: int) -> None:
+            job.chunks_done = done
+            await advance(STAGE_STORING, 0.6 + 0.35 * done / job.chunks_total)
+
+        with span("ingest_store"):
+            await store_chunks(
+                store,
+                job.file_id,
+                job.filename,
+                chunks,
+                hashes,
+                embeddings,
+                on_progress=stored,
+                collection=job.collection
+            )
+    except Exception:
+        # 失敗した場合、ファイルとチャンクを削除（CASCADEでchunksも削除）
+        try:
+            await run_blocking(store.delete_file, job.file_id)
+            await run_blocking(store.remove_objects, [storage_path])
+        except Exception:
+            pass
+        raise
+    finally:
+        remove_spooled(source_path)
+
+    job.stage = STAGE_COMPLETED
+    job.progress = 1.0
+
+
+async def fetch_file_chunks(store, file_id: str) -> List[dict]:
+    """ファイルに属する保存済みチャンクの id と content_hash を取得"""
+    rows = await run_blocking(store.file_chunks, file_id)
+    for row in rows:
+        # ハッシュ導入前のチャンクは本文から計算する
+        row["content_hash"] = row.get("content_hash") or chunk_hash(row["content"])
+    return rows
+
+
+def diff_chunks(existing: List[dict], hashes: List[str]) -> Tuple[List[int], List[str], int]:
+    """
+    新しいチャンク列と保存済みチャンクの差分を取る
+
+    同じハッシュのチャンクは件数分だけ対応づけ、余った保存済みチャンクを削除対象にする
+
+    Args:
+        existing: 保存済みチャンク（id, content_hash）
+        hashes: 新しいチャンクのハッシュ
+
+    Returns:
+        (追加するチャンクの位置, 削除するチャンクID, 変更のないチャンク数)
+    """
+    remaining: Dict[str, List[str]] = {}
+    for row in existing:
+        remaining.setdefault(row["content_hash"], []).append(row["id"])
+
+    added: List[int] = []
+    for position, digest in enumerate(hashes):
+        ids = remaining.get(digest)
+        if ids:
+            ids.pop()
+        else:
+            added.append(position)
+
+    removed = [chunk_id for ids in remaining.values() for chunk_id in ids]
+    return added, removed, len(hashes) - len(added)
+
+
+async def finish_update(store, file_id: str) -> None:
+    """差分取り込みの終了時にファイルを status=ready に戻す（失敗した場合も旧版が残っているため）"""
+    try:
+        await run_blocking(store.update_file_status, file_id, FILE_STATUS_READY, FILE_STATUS_UPDATING)
+    except Exception as e:
+        print(f"警告: ファイルの状態を戻せませんでした ({file_id}): {str(e)}")
+
+
+async def reingest_file(
+    job: IngestionJob,
+    store,
+    source_path: str,
+    storage_path: str,
+    content_hash: str,
+    previous_storage_path: Optional[str] = None,
+    byte_size: Optional[int] = None
+) -> None:
+    """
+    更新されたファイルを差分で取り込む（ジョブ本体）
+
+    新しい版をチャンク分割し、保存済みチャンクとハッシュで比較する。
+    新しいチャンクだけEmbeddingを生成し、削除・追加は replace_file_chunks で
+    1トランザクションにまとめて反映する。反映までは旧版が検索対象のまま残る。
+    失敗した場合は新しい版のStorageのファイルだけを削除し、旧版はそのまま残す。
+    ファイルは登録時に status=updating にしておき、成否によらず最後に ready に戻す。
+
+    Args:
+        job: ジョブ
+        store: 保存先
+        source_path: アップロードの一時ファイルのパス
+        storage_path: 新しい版のStorage上のパス
+        content_hash: 新しい版の内容のハッシュ
+        previous_storage_path: 旧版のStorage上のパス（反映後に削除）
+        byte_size: 新しい版のバイト数
+    """
+    queue = get_ingestion_queue()
+
+    async def advance(stage: str, progress: float) -> None:
+        job.stage = stage
+        job.progress = round(progress, 3)
+        await queue.save_job(job)
+
+    try:
+        await advance(STAGE_EXTRACTING, 0.05)
+        chunks = await extract_chunks(source_path, job.filename)
+        job.chunks_total = len(chunks)
+
+        # 保存済みチャンクとの差分
+        hashes = [chunk_hash(chunk) for chunk in chunks]
+        existing = await fetch_file_chunks(store, job.file_id)
+        added, removed_ids, unchanged = diff_chunks(existing, hashes)
+        job.chunks_removed = len(removed_ids)
+
+        # 新しいチャンクだけEmbeddingを生成（他のファイルと同じ本文なら再利用）
+        await advance(STAGE_EMBEDDING, 0.2)
+        added_chunks = [chunks[i] for i in added]
+        added_hashes, added_embeddings, reused = await embed_chunks(
+            store,
+            added_chunks,
+            on_progress=lambda done, total: advance(STAGE_EMBEDDING, 0.2 + 0.6 * done / total)
+        )
+        job.chunks_reused = unchanged + reused
+
+        # 削除と追加をまとめて反映
+        await advance(STAGE_STORING, 0.8)
+        replaced = await run_blocking(
+            store.replace_file_chunks,
+            job.file_id,
+            removed_ids,
+            [
+                {"content": chunk, "content_hash": digest, "embedding": format_embedding(embedding)}
+                for chunk, digest, embedding in zip(added_chunks, added_hashes, added_embeddings)
+            ],
+            content_hash,
+            storage_path,
+            byte_size
+        )
+        # 戻り値の行をハッシュで追加したチャンクに対応づける
+        returned: Dict[str, List[str]] = {}
+        for row in replaced:
+            returned.setdefault(row["content_hash"], []).append(row["id"])
+        added_ids = [returned[digest].pop() for digest in added_hashes]
+        job.chunks_done = job.chunks_total
+
+        await run_blocking(
+            get_vector_index(job.collection).replace_chunks,
+            job.file_id,
+            job.filename,
+            removed_ids,
+            added_ids,
+            added_chunks,
+            added_embeddings
+        )
+    except Exception:
+        # 旧版はそのまま残し、新しい版のファイルだけ削除
+        try:
+            await run_blocking(store.remove_objects, [storage_path])
+        except Exception:
+            pass
+        raise
+    finally:
+        remove_spooled(source_path)
+        await finish_update(store, job.file_id)
+
+    if previous_storage_path and previous_storage_path != storage_path:
+        try:
+            await run_blocking(store.remove_objects, [previous_storage_path])
+        except Exception as e:
+            print(f"警告: 旧版のファイルをStorageから削除できませんでした: {str(e)}")
+
+    job.stage = STAGE_COMPLETED
+    job.progress = 1.0
@@ -0,0 +1,173 @@
+"""
+語彙検索（文字n-gramの転置インデックス + BM25）
+
+日本語は単語の区切りがないため、かな・漢字の連続は文字n-gram（既定はbigram）に、
+英数字の連続（型番・エラーコードなど）は1語として索引する。
+チャンクの追加・削除のたびに差分だけを更新する（全件の再構築はしない）。
+"""
+from typing import Dict, List, Sequence, Tuple
+import heapq
+import math
+import re
+import unicodedata
+
+
+# 英数字の語（記号でつながった型番・識別子も1語として扱う）
+WORD_PATTERN = re.compile(r"[a-z0-9]+(?:[-_./:#][a-z0-9]+)*")
+WORD_SEPARATOR = re.compile(r"[-_./:#]")
+# かな・漢字の連続（n-gramにする）
+CJK_RUN_PATTERN = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff々〆]+")
+
+# 全チャンクのこの割合以上に現れる語は、他の語があれば検索に使わない（BM25の寄与が小さく、走査が重い）
+COMMON_TERM_RATIO = 0.5
+
+# 識別子とみなす語（数字・区切り記号を含むか、全体が大文字で3文字以上）
+IDENTIFIER_TOKEN = re.compile(r"[A-Za-z0-9]+(?:[-_./:#][A-Za-z0-9]+)*")
+IDENTIFIER_QUOTES = "\"'`「」『』"
+
+
+def normalize_text(text: str) -> str:
+    """全角英数字を半角にし、小文字にそろえる"""
+    return unicodedata.normalize("NFKC", text).lower()
+
+
+def tokenize(text: str, ngram: int = 2) -> List[str]:
+    """
+    索引・検索に使う語を取り出す
+
+    Args:
+        text: 本文または質問文
+        ngram: かな・漢字のn-gramの文字数
+
+    Returns:
+        語のリスト（重複を含む）
+    """
+    text = normalize_text(text)
+    terms: List[str] = []
+    for match in WORD_PATTERN.finditer(text):
+        word = match.group()
+        terms.append(word)
+        # "abc-123" は "abc" "123" でも引けるようにする
+        parts = WORD_SEPARATOR.split(word)
+        if len(parts) > 1:
+            terms.extend(part for part in parts if part)
+    for match in CJK_RUN_PATTERN.finditer(text):
+        run = match.group()
+        if len(run) <= ngram:
+            terms.append(run)
+            continue
+        terms.extend(run[i:i + ngram] for i in range(len(run) - ngram + 1))
+    return terms
+
+
+def is_identifier_query(question: str) -> bool:
+    """
+    型番・エラーコードなどの識別子だけからなる質問か
+
+    例: "E1234", "ERR_CONNECTION_RESET", "SKU-2024-001"（3語まで）
+    """
+    text = unicodedata.normalize("NFKC", question).strip().strip(IDENTIFIER_QUOTES).strip()
+    tokens = text.split()
+    if not 1 <= len(tokens) <= 3:
+        return False
+    for token in tokens:
+        if not IDENTIFIER_TOKEN.fullmatch(token):
+            return False
+        has_digit = any(c.isdigit() for c in token)
+        has_separator = WORD_SEPARATOR.search(token) is not None
+        if not (has_digit or has_separator or (token.isupper() and len(token) >= 3)):
+            return False
+    return True
+
+
+class LexicalIndex:
+    """
+    チャンクIDをキーにした転置インデックス（スレッドセーフではない。呼び出し側でロックする）
+    """
+
+    def __init__(self, ngram: int = 2, k1: float = 1.2, b: float = 0.75):
+        self.ngram = ngram
+        self.k1 = k1
+        self.b = b
+        self.clear()
+
+    def __len__(self) -> int:
+        return len(self._lengths)
+
+    def clear(self) -> None:
+        # 語 → {チャンクID: 出現回数}
+        self._postings: Dict[str, Dict[str, int]] = {}
+        # チャンクID → 語数
+        self._lengths: Dict[str, int] = {}
+        self._total_length = 0
+
+    def add(self, chunk_ids: Sequence[str], contents: Sequence[str]) -> None:
+        """チャンクを索引に追加"""
+        for chunk_id, content in zip(chunk_ids, contents):
+            terms = tokenize(content, self.ngram)
+            counts: Dict[str, int] = {}
+            for term in terms:
+                counts[term] = counts.get(term, 0) + 1
+            for term, count in counts.items():
+                self._postings.setdefault(term, {})[chunk_id] = count
+            self._lengths[chunk_id] = len(terms)
+            self._total_length += len(terms)
+
+    def remove(self, chunk_ids: Sequence[str], contents: Sequence[str]) -> None:
+        """チャンクを索引から削除（本文から語を求め直し、その語の転置リストだけを更新する）"""
+        for chunk_id, content in zip(chunk_ids, contents):
+            length = self._lengths.pop(chunk_id, None)
+            if length is None:
+                continue
+            self._total_length -= length
+            for term in set(tokenize(content, self.ngram)):
+                postings = self._postings.get(term)
+                if postings is None:
+                    continue
+                postings.pop(chunk_id, None)
+                if not postings:
+                    del self._postings[term]
+
+    def search(self, query: str, top_k: int, require_all: bool = False) -> List[Tuple[str, float]]:
+        """
+        BM25で上位k件を取得
+
+        Args:
+            query: 質問文
+            top_k: 取得件数
+            require_all: Trueの場合、質問の語をすべて含むチャンクのみ返す
+
+        Returns:
+            (チャンクID, スコア) のスコア降順のリスト
+        """
+        n = len(self._lengths)
+        terms = set(tokenize(query, self.ngram))
+        if n == 0 or not terms:
+            return []
+
+        postings = [(term, self._postings.get(term, {})) for term in terms]
+        if require_all and any(not docs for _, docs in postings):
+            return []
+        if not require_all:
+            postings = [(term, docs) for term, docs in postings if docs]
+            rare = [(term, docs) for term, docs in postings if len(docs) < n * COMMON_TERM_RATIO]
+            if rare:
+                postings = rare
+
+        average_length = self._total_length / n
+        scores: Dict[str, float] = {}
+        matched: Dict[str, int] = {}
+        for _, docs in postings:
+            idf = math.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            for chunk_id, tf in docs.items():
+                norm = self.k1 * (1 - self.b + self.b * self._lengths[chunk_id] / average_length)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+                matched[chunk_id] = matched.get(chunk_id, 0) + 1
+
+        if require_all:
+            scores = {chunk_id: score for chunk_id, score in scores.items() if matched[chunk_id] == len(postings)}
+        return heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+
+    def term_count(self) -> int:
+        return len(self._postings)
+
@@ -0,0 +1,574 @@
+"""
+ローカルの保存先（STORAGE_BACKEND=local）
+
+Supabaseを使わず、同一ホストのディスクだけに保存する（単一テナントの小規模な構成・オフラインの検証用）。
+    store.sqlite3: ファイル情報とチャンク（WALモード。同一ホストの複数ワーカーから読み書きできる）
+    embeddings.f32: Embeddingの行（正規化済みfloat32）。メモリマップして読み書きする
+    objects/: 元ファイル（Storage上のパスと同じ相対パス）
+チャンクは embeddings.f32 の行番号を持ち、削除された行は次の挿入で再利用する。
+チャンクにはファイルのコレクションを複製して持たせ、検索はそのコレクションの行だけを走査する。
+書き込みは BEGIN IMMEDIATE で直列化し、Embeddingの行はチャンクの行をコミットする前に書く。
+"""
+from config import settings
+from utils.collection import DEFAULT_COLLECTION
+from utils.metrics import record_scan
+from utils.store import FILE_COLUMNS, SEARCHABLE_STATUSES, LoadedChunks, Store
+from utils.uploads import SpooledUpload
+from utils.vector_index import normalize_rows, parse_embedding
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+import os
+import shutil
+import sqlite3
+import threading
+import uuid
+import numpy as np
+
+
+# 1回のSQLで IN (...) に渡す値の数の上限
+SQL_BATCH = 500
+
+# 類似度を計算する際の1回あたりの行数
+SCAN_BLOCK_ROWS = 4096
+
+# 検索対象のファイルの条件（files の別名は f）
+SEARCHABLE_CONDITION = f"f.status IN ({', '.join(repr(status) for status in SEARCHABLE_STATUSES)})"
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS files ("
+    " id TEXT PRIMARY KEY,"
+    " filename TEXT NOT NULL,"
+    " created_at TEXT NOT NULL,"
+    " status TEXT NOT NULL DEFAULT 'ready',"
+    " content_hash TEXT,"
+    " storage_path TEXT,"
+    " chunk_count INTEGER,"
+    " byte_size INTEGER,"
+    " collection TEXT NOT NULL DEFAULT 'default')",
+    "CREATE INDEX IF NOT EXISTS files_created_at_id_idx ON files(created_at DESC, id DESC)",
+    "CREATE INDEX IF NOT EXISTS files_filename_idx ON files(filename)",
+    "CREATE INDEX IF NOT EXISTS files_content_hash_idx ON files(content_hash)",
+    "CREATE TABLE IF NOT EXISTS chunks ("
+    " id TEXT PRIMARY KEY,"
+    " file_id TEXT NOT NULL REFERENCES files(id) ON DELETE CASCADE,"
+    " content TEXT NOT NULL,"
+    " content_hash TEXT,"
+    " vector_row INTEGER NOT NULL UNIQUE,"
+    " collection TEXT NOT NULL DEFAULT 'default')",
+    "CREATE INDEX IF NOT EXISTS chunks_file_id_idx ON chunks(file_id)",
+    "CREATE INDEX IF NOT EXISTS chunks_content_hash_idx ON chunks(content_hash)",
+    # 削除されたチャンクの embeddings.f32 の行（次の挿入で再利用する）
+    "CREATE TABLE IF NOT EXISTS free_rows (vector_row INTEGER PRIMARY KEY)",
+    # catalog_version: ファイル一覧のバージョン（一覧のETag）
+    # data_version: 検索対象のチャンクが変わるたびに進む（検索対象の行の一覧を作り直す）
+    # next_row: embeddings.f32 のまだ使っていない先頭の行
+    "CREATE TABLE IF NOT EXISTS store_state ("
+    " id INTEGER PRIMARY KEY CHECK (id = 1),"
+    " dim INTEGER NOT NULL,"
+    " catalog_version INTEGER NOT NULL DEFAULT 0,"
+    " data_version INTEGER NOT NULL DEFAULT 0,"
+    " next_row INTEGER NOT NULL DEFAULT 0)",
+    "CREATE TRIGGER IF NOT EXISTS files_catalog_insert AFTER INSERT ON files"
+    " BEGIN UPDATE store_state SET catalog_version = catalog_version + 1; END",
+    "CREATE TRIGGER IF NOT EXISTS files_catalog_update AFTER UPDATE ON files"
+    " BEGIN UPDATE store_state SET catalog_version = catalog_version + 1; END",
+    "CREATE TRIGGER IF NOT EXISTS files_catalog_delete AFTER DELETE ON files"
+    " BEGIN UPDATE store_state SET catalog_version = catalog_version + 1; END",
+    # ファイルの削除（CASCADE）でも発火する
+    "CREATE TRIGGER IF NOT EXISTS chunks_free_row AFTER DELETE ON chunks"
+    " BEGIN INSERT OR IGNORE INTO free_rows (vector_row) VALUES (OLD.vector_row); END",
+)
+
+# コレクション導入前に作った保存先には collection 列を追加してから作る
+COLLECTION_SCHEMA = (
+    "CREATE INDEX IF NOT EXISTS files_collection_created_at_id_idx ON files(collection, created_at DESC, id DESC)",
+    "CREATE INDEX IF NOT EXISTS files_collection_filename_idx ON files(collection, filename)",
+    "CREATE INDEX IF NOT EXISTS chunks_collection_row_idx ON chunks(collection, vector_row)",
+)
+
+
+def utc_timestamp() -> str:
+    """created_at の値（桁数を固定し、文字列の比較で時刻順になるようにする）"""
+    return datetime.now(timezone.utc).isoformat(timespec="microseconds")
+
+
+def placeholders(n: int) -> str:
+    return ",".join("?" * n)
+
+
+class VectorFile:
+    """
+    Embeddingの行を置くファイル（float32・行ごとに dim 個）
+
+    容量は倍々に広げ、他のプロセスが広げた場合は読む前にマップし直す
+    """
+
+    def __init__(self, path: str, dim: int):
+        self.path = path
+        self.dim = dim
+        self.row_bytes = dim * 4
+        open(path, "ab").close()
+        self._lock = threading.Lock()
+        self._rows = self._map()
+
+    def _map(self) -> np.ndarray:
+        capacity = os.path.getsize(self.path) // self.row_bytes
+        if capacity == 0:
+            return np.empty((0, self.dim), dtype=np.float32)
+        return np.memmap(self.path, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+
+    def view(self, rows: int) -> np.ndarray:
+        """先頭から rows 行以上を含むマップを取得"""
+        mapped = self._rows
+        if rows > mapped.shape[0]:
+            with self._lock:
+                if rows > self._rows.shape[0]:
+                    self._rows = self._map()
+                mapped = self._rows
+        return mapped
+
+    def reserve(self, rows: int) -> np.ndarray:
+        """容量を rows 行以上に広げる（書き込みトランザクションの中で呼ぶ）"""
+        capacity = os.path.getsize(self.path) // self.row_bytes
+        if rows > capacity:
+            with open(self.path, "r+b") as f:
+                f.truncate(max(rows, capacity * 2, 1024) * self.row_bytes)
+        return self.view(rows)
+
+    def write(self, rows: np.ndarray, vectors: np.ndarray) -> None:
+        if rows.size == 0:
+            return
+        mapped = self.reserve(int(rows.max()) + 1)
+        mapped[rows] = vectors
+        mapped.flush()
+
+    def read(self, rows: np.ndarray) -> np.ndarray:
+        if rows.size == 0:
+            return np.empty((0, self.dim), dtype=np.float32)
+        return np.asarray(self.view(int(rows.max()) + 1)[rows])
+
+    def close(self) -> None:
+        with self._lock:
+            self._rows = np.empty((0, self.dim), dtype=np.float32)
+
+
+class LocalStore(Store):
+    """SQLite・ファイル・メモリマップしたEmbeddingファイルに保存する"""
+
+    name = "local"
+
+    def __init__(self, directory: str, dim: Optional[int] = None):
+        self.directory = directory
+        self.dim = dim or settings.embedding_dimensions
+        self.objects_dir = os.path.join(directory, "objects")
+        os.makedirs(self.objects_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        # 自動コミットにし、書き込みは _write() で BEGIN IMMEDIATE から始める
+        self._conn = sqlite3.connect(
+            os.path.join(directory, "store.sqlite3"),
+            timeout=30.0,
+            check_same_thread=False,
+            isolation_level=None
+        )
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        with self._write() as conn:
+            for statement in SCHEMA:
+                conn.execute(statement)
+            self._add_collection_columns(conn)
+            for statement in COLLECTION_SCHEMA:
+                conn.execute(statement)
+            conn.execute("INSERT OR IGNORE INTO store_state (id, dim) VALUES (1, ?)", (self.dim,))
+            stored_dim = conn.execute("SELECT dim FROM store_state").fetchone()[0]
+        if stored_dim != self.dim:
+            raise ValueError(
+                f"ローカルの保存先のEmbedding次元数（{stored_dim}）が EMBEDDING_DIMENSIONS（{self.dim}）と一致しません"
+            )
+
+        self.vectors = VectorFile(os.path.join(directory, "embeddings.f32"), self.dim)
+        # コレクション → (data_version, 検索対象のチャンクの行番号)（data_version が変わったら作り直す）
+        self._ready: Dict[str, Tuple[int, np.ndarray]] = {}
+
+    @contextmanager
+    def _write(self) -> Iterator[sqlite3.Connection]:
+        """書き込みトランザクション（他のスレッド・プロセスの書き込みとは直列に実行される）"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def _query(self, sql: str, params: Sequence = ()) -> List[sqlite3.Row]:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    @staticmethod
+    def _add_collection_columns(conn: sqlite3.Connection) -> None:
+        """collection 列がない（コレクション導入前の）テーブルに追加（既存の行は default）"""
+        for table in ("files", "chunks"):
+            columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})").fetchall()}
+            if "collection" not in columns:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN collection TEXT NOT NULL DEFAULT '{DEFAULT_COLLECTION}'")
+
+    @staticmethod
+    def _bump_data_version(conn: sqlite3.Connection) -> None:
+        conn.execute("UPDATE store_state SET data_version = data_version + 1")
+
+    @staticmethod
+    def _check_columns(columns: Sequence[str]) -> None:
+        unknown = [column for column in columns if column not in FILE_COLUMNS]
+        if unknown:
+            raise ValueError(f"filesにない列です: {', '.join(unknown)}")
+
+    # ファイル情報
+
+    def catalog_version(self) -> Optional[int]:
+        return int(self._query("SELECT catalog_version FROM store_state")[0][0])
+
+    def list_files(
+        self,
+        columns: Sequence[str],
+        limit: int,
+        after: Optional[Tuple[str, str]] = None,
+        collection: Optional[str] = None
+    ) -> List[dict]:
+        self._check_columns(columns)
+        conditions, params = [], []
+        if collection is not None:
+            conditions.append("collection = ?")
+            params.append(collection)
+        if after is not None:
+            created_at, file_id = after
+            conditions.append("(created_at < ? OR (created_at = ? AND id < ?))")
+            params.extend([created_at, created_at, file_id])
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        sql = f"SELECT {', '.join(columns)} FROM files{where} ORDER BY created_at DESC, id DESC LIMIT ?"
+        return [dict(row) for row in self._query(sql, params + [limit])]
+
+    def list_collections(self) -> List[dict]:
+        rows = self._query(
+            "SELECT collection, COUNT(*) AS file_count, COALESCE(SUM(chunk_count), 0) AS chunk_count"
+            " FROM files GROUP BY collection ORDER BY collection"
+        )
+        return [dict(row) for row in rows]
+
+    def get_file(self, file_id: str) -> Optional[dict]:
+        rows = self._query("SELECT * FROM files WHERE id = ?", (file_id,))
+        return dict(rows[0]) if rows else None
+
+    def find_file(
+        self,
+        filename: Optional[str] = None,
+        content_hash: Optional[str] = None,
+        exclude_id: Optional[str] = None,
+        collection: Optional[str] = None
+    ) -> Optional[dict]:
+        conditions, params = [], []
+        if collection is not None:
+            conditions.append("collection = ?")
+            params.append(collection)
+        if filename is not None:
+            conditions.append("filename = ?")
+            params.append(filename)
+        if content_hash is not None:
+            conditions.append("content_hash = ?")
+            params.append(content_hash)
+        if exclude_id:
+            conditions.append("id <> ?")
+            params.append(exclude_id)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = self._query(f"SELECT id, filename FROM files{where} LIMIT 1", params)
+        return dict(rows[0]) if rows else None
+
+    def insert_file(self, values: dict) -> Optional[dict]:
+        row = {"id": str(uuid.uuid4()), "created_at": utc_timestamp(), "status": "ready", **values}
+        self._check_columns(row.keys())
+        with self._write() as conn:
+            conn.execute(
+                f"INSERT INTO files ({', '.join(row)}) VALUES ({placeholders(len(row))})",
+                list(row.values())
+            )
+            self._bump_data_version(conn)
+            inserted = conn.execute("SELECT * FROM files WHERE id = ?", (row["id"],)).fetchone()
+        return dict(inserted)
+
+    def update_file(self, file_id: str, values: dict) -> None:
+        if not values:
+            return
+        self._check_columns(values.keys())
+        assignments = ", ".join(f"{column} = ?" for column in values)
+        with self._write() as conn:
+            conn.execute(f"UPDATE files SET {assignments} WHERE id = ?", [*values.values(), file_id])
+            self._bump_data_version(conn)
+
+    def update_file_status(self, file_id: str, status: str, expected: str) -> Optional[dict]:
+        with self._write() as conn:
+            cursor = conn.execute(
+                "UPDATE files SET status = ? WHERE id = ? AND status = ?",
+                (status, file_id, expected)
+            )
+            if cursor.rowcount == 0:
+                return None
+            self._bump_data_version(conn)
+            updated = conn.execute("SELECT * FROM files WHERE id = ?", (file_id,)).fetchone()
+        return dict(updated)
+
+    def delete_file(self, file_id: str) -> None:
+        with self._write() as conn:
+            conn.execute("DELETE FROM files WHERE id = ?", (file_id,))
+            self._bump_data_version(conn)
+
+    # 元ファイル
+
+    def _object_path(self, path: str) -> str:
+        """Storage上のパスを objects/ 配下の絶対パスにする（外に出るパスは拒否）"""
+        relative = os.path.normpath(path)
+        if os.path.isabs(relative) or relative == ".." or relative.startswith(".." + os.sep):
+            raise ValueError(f"保存先のパスが不正です: {path}")
+        return os.path.join(self.objects_dir, relative)
+
+    def upload_object(self, path: str, upload: SpooledUpload) -> None:
+        target = self._object_path(path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # 一時ファイルはジョブが読むため移動せずにコピーし、書き終えてから置き換える
+        partial = f"{target}.{uuid.uuid4().hex}.part"
+        try:
+            shutil.copyfile(upload.path, partial)
+            os.replace(partial, target)
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+
+    def remove_objects(self, paths: List[str]) -> None:
+        for path in paths:
+            try:
+                os.remove(self._object_path(path))
+            except FileNotFoundError:
+                pass
+
+    # チャンク
+
+    def _allocate_rows(self, conn: sqlite3.Connection, n: int) -> np.ndarray:
+        """
+        embeddings.f32 の行を n 行確保（削除済みの行を先に使う）
+
+        同じトランザクションで削除した行は、コミット前の読み手がまだ参照しうるため使わない
+        （削除より前に呼ぶこと）
+        """
+        free = [row[0] for row in conn.execute(
+            "SELECT vector_row FROM free_rows ORDER BY vector_row LIMIT ?", (n,)
+        ).fetchall()]
+        conn.executemany("DELETE FROM free_rows WHERE vector_row = ?", [(row,) for row in free])
+        rest = n - len(free)
+        if rest:
+            start = conn.execute("SELECT next_row FROM store_state").fetchone()[0]
+            conn.execute("UPDATE store_state SET next_row = next_row + ?", (rest,))
+            free.extend(range(start, start + rest))
+        return np.asarray(free, dtype=np.int64)
+
+    def _vectors_of(self, rows: Sequence[dict]) -> np.ndarray:
+        """行の embedding（テキスト形式または配列）を正規化済みのfloat32行列にする"""
+        matrix = np.empty((len(rows), self.dim), dtype=np.float32)
+        for i, row in enumerate(rows):
+            vector = parse_embedding(row["embedding"])
+            if vector is None or vector.size != self.dim:
+                raise ValueError(f"Embeddingの次元数が {self.dim} ではありません")
+            matrix[i] = vector
+        return normalize_rows(matrix)
+
+    def _insert_chunk_rows(self, conn: sqlite3.Connection, file_id: Optional[str], rows: List[dict]) -> List[str]:
+        vectors = self._vectors_of(rows)
+        positions = self._allocate_rows(conn, len(rows))
+        # チャンクの行が見える（コミット）より前にEmbeddingを書いておく
+        self.vectors.write(positions, vectors)
+        ids = [row.get("id") or str(uuid.uuid4()) for row in rows]
+        values = []
+        for chunk_id, row, position in zip(ids, rows, positions):
+            row_file_id = file_id or row["file_id"]
+            values.append((chunk_id, row_file_id, row["content"], row.get("content_hash"), int(position), row_file_id))
+        # コレクションはファイルのものを複製する
+        conn.executemany(
+            "INSERT INTO chunks (id, file_id, content, content_hash, vector_row, collection)"
+            " VALUES (?, ?, ?, ?, ?, (SELECT collection FROM files WHERE id = ?))",
+            values
+        )
+        return ids
+
+    def insert_chunks(self, rows: List[dict]) -> None:
+        if not rows:
+            return
+        with self._write() as conn:
+            self._insert_chunk_rows(conn, None, rows)
+            self._bump_data_version(conn)
+
+    def find_embeddings(self, hashes: Sequence[str]) -> List[dict]:
+        hashes = list(dict.fromkeys(hashes))
+        found: Dict[str, int] = {}
+        for i in range(0, len(hashes), SQL_BATCH):
+            batch = hashes[i:i + SQL_BATCH]
+            for row in self._query(
+                f"SELECT content_hash, vector_row FROM chunks WHERE content_hash IN ({placeholders(len(batch))})",
+                batch
+            ):
+                found.setdefault(row["content_hash"], row["vector_row"])
+        vectors = self.vectors.read(np.fromiter(found.values(), dtype=np.int64, count=len(found)))
+        return [
+            {"content_hash": digest, "embedding": vector}
+            for digest, vector in zip(found.keys(), vectors)
+        ]
+
+    def file_chunks(self, file_id: str) -> List[dict]:
+        rows = self._query("SELECT id, content, content_hash FROM chunks WHERE file_id = ? ORDER BY id", (file_id,))
+        return [dict(row) for row in rows]
+
+    def replace_file_chunks(
+        self,
+        file_id: str,
+        removed_ids: List[str],
+        added: List[dict],
+        content_hash: Optional[str] = None,
+        storage_path: Optional[str] = None,
+        byte_size: Optional[int] = None
+    ) -> List[dict]:
+        with self._write() as conn:
+            # 行の確保は削除より前（同じトランザクションで空いた行は使わない）
+            ids = self._insert_chunk_rows(conn, file_id, added) if added else []
+            conn.executemany(
+                "DELETE FROM chunks WHERE file_id = ? AND id = ?",
+                [(file_id, chunk_id) for chunk_id in removed_ids]
+            )
+            conn.execute(
+                "UPDATE files SET"
+                " content_hash = COALESCE(?, content_hash),"
+                " storage_path = COALESCE(?, storage_path),"
+                " byte_size = COALESCE(?, byte_size),"
+                " chunk_count = (SELECT COUNT(*) FROM chunks WHERE file_id = ?)"
+                " WHERE id = ?",
+                (content_hash, storage_path, byte_size, file_id, file_id)
+            )
+            self._bump_data_version(conn)
+        return [{"id": chunk_id, "content_hash": row.get("content_hash")} for chunk_id, row in zip(ids, added)]
+
+    def load_chunks(self, dim: int, collection: str = DEFAULT_COLLECTION) -> LoadedChunks:
+        # Embeddingはテキストを経由せず、ファイルの行をそのまま読む
+        rows = self._query(
+            "SELECT c.id, c.file_id, c.content, c.vector_row, f.filename FROM chunks c"
+            " JOIN files f ON f.id = c.file_id"
+            f" WHERE c.collection = ? AND {SEARCHABLE_CONDITION} ORDER BY c.vector_row",
+            (collection,)
+        )
+        if dim != self.dim:
+            return [], [], [], np.empty((0, dim), dtype=np.float32), {}
+        positions = np.fromiter((row["vector_row"] for row in rows), dtype=np.int64, count=len(rows))
+        return (
+            [row["id"] for row in rows],
+            [row["file_id"] for row in rows],
+            [row["content"] for row in rows],
+            self.vectors.read(positions),
+            {row["file_id"]: row["filename"] for row in rows},
+        )
+
+    def _ready_rows(self, collection: str, file_ids: Optional[List[str]] = None) -> np.ndarray:
+        """コレクションの検索対象のチャンクの行番号（昇順）"""
+        sql = (
+            "SELECT c.vector_row FROM chunks c JOIN files f ON f.id = c.file_id"
+            f" WHERE c.collection = ? AND {SEARCHABLE_CONDITION}"
+        )
+        if file_ids is not None:
+            rows = self._query(
+                f"{sql} AND c.file_id IN ({placeholders(len(file_ids))}) ORDER BY c.vector_row",
+                [collection, *file_ids]
+            ) if file_ids else []
+            return np.asarray([row[0] for row in rows], dtype=np.int64)
+
+        version = self._query("SELECT data_version FROM store_state")[0][0]
+        cached_version, cached = self._ready.get(collection, (-1, None))
+        if cached_version == version:
+            return cached
+        rows = np.asarray(
+            [row[0] for row in self._query(f"{sql} ORDER BY c.vector_row", (collection,))],
+            dtype=np.int64
+        )
+        self._ready[collection] = (version, rows)
+        return rows
+
+    def match_chunks(
+        self,
+        query_embedding: Sequence[float],
+        top_k: int,
+        min_similarity: Optional[float] = None,
+        file_ids: Optional[List[str]] = None,
+        probes: Optional[int] = None,
+        collection: str = DEFAULT_COLLECTION
+    ) -> List[dict]:
+        # コレクションの全件を正確に走査する（probes は使わない）
+        query = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        rows = self._ready_rows(collection, file_ids)
+        if rows.size == 0 or top_k <= 0 or norm == 0:
+            return []
+        query = query / norm
+
+        mapped = self.vectors.view(int(rows[-1]) + 1)
+        scores = np.empty(rows.size, dtype=np.float32)
+        for start in range(0, rows.size, SCAN_BLOCK_ROWS):
+            block = rows[start:start + SCAN_BLOCK_ROWS]
+            first, last = int(block[0]), int(block[-1])
+            # 連続した行はコピーせずにそのまま掛ける
+            vectors = mapped[first:last + 1] if last - first + 1 == block.size else mapped[block]
+            scores[start:start + block.size] = vectors @ query
+        record_scan("local", int(rows.size))
+
+        k = min(top_k, rows.size)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        if min_similarity is not None:
+            top = top[scores[top] >= min_similarity]
+        if top.size == 0:
+            return []
+
+        # 走査中に削除されたチャンクは、行番号の対応がないため結果から落ちる
+        candidates = [int(position) for position in rows[top]]
+        found = {
+            row["vector_row"]: row
+            for row in self._query(
+                "SELECT c.vector_row, c.id, c.file_id, c.content, f.filename FROM chunks c"
+                " JOIN files f ON f.id = c.file_id"
+                f" WHERE c.collection = ? AND {SEARCHABLE_CONDITION} AND c.vector_row IN ({placeholders(len(candidates))})",
+                [collection, *candidates]
+            )
+        }
+        positions = [position for position in candidates if position in found]
+        if not positions:
+            return []
+
+        # 走査中に空いた行が別のチャンクに再利用されていると、走査時の類似度はそのチャンクのものではない
+        # 対応づけた後の行（Embeddingはチャンクの行より先に書かれる）を読み直し、類似度を計算し直す
+        rescored = self.vectors.read(np.asarray(positions, dtype=np.int64)) @ query
+        results = []
+        for i in np.argsort(-rescored, kind="stable"):
+            score = float(rescored[i])
+            if min_similarity is not None and score < min_similarity:
+                continue
+            row = found[positions[i]]
+            results.append({
+                "id": row["id"],
+                "file_id": row["file_id"],
+                "filename": row["filename"],
+                "content": row["content"],
+                "similarity": score,
+            })
+        return results
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+        self.vectors.close()
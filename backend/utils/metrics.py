@@ -0,0 +1,277 @@
+"""
+処理段階ごとの所要時間の計測とPrometheus形式のメトリクス
+
+リクエストの処理中は span() で囲んだ段階の所要時間を記録し、
+Server-Timing ヘッダー（embedding;dur=12.3, search;dur=0.8, ...）として返す。
+同じ値をヒストグラムにも集計し、/metrics でPrometheusのテキスト形式で出力する。
+集計はプロセスごと（複数ワーカーの場合はワーカーごとにスクレイプされる値になる）。
+"""
+from config import settings
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+import bisect
+import threading
+import time
+
+
+# 所要時間（秒）のバケット
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# 件数（走査したチャンク数・バッチの件数）のバケット
+SIZE_BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000, 10000, 50000, 100000, 500000, 1000000)
+
+# リクエスト外（取り込みジョブなど）で記録した段階の endpoint ラベル
+BACKGROUND_ENDPOINT = "background"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    """単調増加するカウンター（ラベルの組ごと）"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            lines.append(f"{self.name}{format_labels(self.labelnames, key)} {format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """ヒストグラム（ラベルの組ごとにバケット別の件数・合計・件数を保持）"""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # ラベルの組 → ([バケットごとの件数（累積ではない。最後は+Inf）], 合計)
+        self._series: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            series[0][position] += 1
+            series[1][0] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((key, list(counts), total[0]) for key, (counts, total) in self._series.items())
+        for key, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                labels = format_labels(self.labelnames, key, f'le="{format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+STAGE_SECONDS = Histogram(
+    "smallbase_stage_duration_seconds",
+    "Duration of each processing stage.",
+    ("endpoint", "stage")
+)
+REQUEST_SECONDS = Histogram(
+    "smallbase_request_duration_seconds",
+    "Duration of HTTP requests including streamed bodies.",
+    ("endpoint",)
+)
+OPENAI_TOKENS = Counter(
+    "smallbase_openai_tokens_total",
+    "OpenAI tokens reported in API usage.",
+    ("model", "kind")
+)
+CHUNKS_SCANNED = Histogram(
+    "smallbase_chunks_scanned",
+    "Chunks scored per search.",
+    ("method",),
+    SIZE_BUCKETS
+)
+BATCH_SIZE = Histogram(
+    "smallbase_batch_size",
+    "Items per batch sent to OpenAI or the database.",
+    ("kind",),
+    SIZE_BUCKETS
+)
+OPENAI_RETRIES = Counter(
+    "smallbase_openai_retries_total",
+    "OpenAI requests retried after a rate limit or transient error.",
+    ("kind", "error")
+)
+
+METRICS = (STAGE_SECONDS, REQUEST_SECONDS, OPENAI_TOKENS, CHUNKS_SCANNED, BATCH_SIZE, OPENAI_RETRIES)
+
+
+def render_metrics() -> str:
+    """全メトリクスをPrometheusのテキスト形式で出力"""
+    lines: List[str] = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+@dataclass
+class RequestTiming:
+    """1リクエスト分の段階ごとの所要時間（秒）"""
+    started: float = field(default_factory=time.perf_counter)
+    spans: List[Tuple[str, float]] = field(default_factory=list)
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.spans.append((stage, seconds))
+
+    def server_timing(self) -> str:
+        """Server-Timing ヘッダーの値（同じ段階は合計し、最後に total を付ける）"""
+        totals: Dict[str, float] = {}
+        for stage, seconds in list(self.spans):
+            totals[stage] = totals.get(stage, 0.0) + seconds
+        totals["total"] = time.perf_counter() - self.started
+        return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in totals.items())
+
+
+# 処理中のリクエスト（スレッドプールで実行する関数にもコンテキストごと引き継がれる）
+_current_timing: ContextVar[Optional[RequestTiming]] = ContextVar("request_timing", default=None)
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """
+    段階の所要時間を計測
+
+    リクエストの処理中であればそのリクエストの段階として記録し（ヒストグラムへの集計はリクエストの終了時）、
+    それ以外（取り込みジョブなど）は endpoint="background" としてすぐに集計する
+
+    例:
+        with span("embedding"):
+            embedding = await generate_embedding(question)
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        timing = _current_timing.get()
+        if timing is not None:
+            timing.add(stage, seconds)
+        elif settings.metrics_enabled:
+            STAGE_SECONDS.observe(seconds, endpoint=BACKGROUND_ENDPOINT, stage=stage)
+
+
+def record_usage(model: str, usage) -> None:
+    """OpenAI APIの応答の usage（またはその dict）をトークン数として集計"""
+    if usage is None or not settings.metrics_enabled:
+        return
+    if not isinstance(usage, dict):
+        usage = usage.model_dump() if hasattr(usage, "model_dump") else vars(usage)
+    for kind in ("prompt_tokens", "completion_tokens"):
+        if usage.get(kind):
+            OPENAI_TOKENS.inc(usage[kind], model=model, kind=kind.replace("_tokens", ""))
+
+
+def record_scan(method: str, chunks: int) -> None:
+    """1回の検索で類似度を計算したチャンク数を集計"""
+    if settings.metrics_enabled:
+        CHUNKS_SCANNED.observe(chunks, method=method)
+
+
+def record_batch(kind: str, size: int) -> None:
+    """バッチの件数を集計（embedding / chunk_insert / chunk_copy / chat_question）"""
+    if settings.metrics_enabled:
+        BATCH_SIZE.observe(size, kind=kind)
+
+
+def record_retry(kind: str, error: Exception) -> None:
+    """OpenAI APIの再試行を集計（kind は embedding など、error は例外のクラス名）"""
+    if settings.metrics_enabled:
+        OPENAI_RETRIES.inc(kind=kind, error=type(error).__name__)
+
+
+def route_label(scope) -> Optional[str]:
+    """ルートのパスのテンプレート（"POST /admin/files/{file_id}" など。未定義のパスはNone）"""
+    route = scope.get("route")
+    path = getattr(route, "path", None)
+    if path is None:
+        return None
+    return f"{scope['method']} {path}"
+
+
+class TimingMiddleware:
+    """
+    リクエストごとに段階の所要時間を集め、Server-Timing ヘッダーとヒストグラムに反映する
+
+    ヘッダーには応答の開始までに終わった段階だけが入る（ストリーミングの回答生成は含まない）。
+    ヒストグラムへの集計は本文の送信が終わってから行う
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not (settings.metrics_enabled or settings.server_timing_enabled):
+            await self.app(scope, receive, send)
+            return
+
+        timing = RequestTiming()
+        token = _current_timing.set(timing)
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start" and settings.server_timing_enabled and timing.spans:
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", timing.server_timing().encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current_timing.reset(token)
+            endpoint = route_label(scope)
+            if settings.metrics_enabled and endpoint is not None:
+                for stage, seconds in timing.spans:
+                    STAGE_SECONDS.observe(seconds, endpoint=endpoint, stage=stage)
+                REQUEST_SECONDS.observe(time.perf_counter() - timing.started, endpoint=endpoint)
@@ -0,0 +1,92 @@
+"""
+プロセスの生存確認（同一ホストの複数ワーカー間）
+
+各プロセスは一意のIDを決め、local_state_dir/owners/<ID>.lock を排他ロックしたまま保持する。
+ロックはプロセスが終了するとOSが解放するため、ロックを取れるIDのプロセスは終了している。
+取り込みジョブとアップロードの一時ファイルにこのIDを記録し、
+起動時に終了したプロセスが残したものを片付ける。
+"""
+from config import settings
+from typing import List, Optional
+import fcntl
+import os
+import threading
+import uuid
+
+
+OWNERS_DIRNAME = "owners"
+
+_process_id: Optional[str] = None
+# ロックを保持するファイル（プロセスの終了まで閉じない）
+_lock_file = None
+_lock = threading.Lock()
+
+
+def _owners_dir() -> str:
+    return os.path.join(settings.local_state_dir, OWNERS_DIRNAME)
+
+
+def _lock_path(owner: str) -> str:
+    return os.path.join(_owners_dir(), f"{owner}.lock")
+
+
+def process_id() -> str:
+    """このプロセスのID（初回の呼び出しでロックを取得し、プロセスの終了まで保持する）"""
+    global _process_id, _lock_file
+    if _process_id is None:
+        with _lock:
+            if _process_id is None:
+                owner = uuid.uuid4().hex
+                os.makedirs(_owners_dir(), exist_ok=True)
+                f = open(_lock_path(owner), "w")
+                fcntl.flock(f, fcntl.LOCK_EX)
+                _lock_file = f
+                _process_id = owner
+    return _process_id
+
+
+def is_alive(owner: Optional[str]) -> bool:
+    """
+    IDのプロセスが動いているか
+
+    Args:
+        owner: プロセスのID（記録のない古いデータはNone）
+
+    Returns:
+        ロックが保持されていればTrue（ロックファイルがない・ロックを取れる場合は終了している）
+    """
+    if not owner:
+        return False
+    if owner == _process_id:
+        return True
+    try:
+        f = open(_lock_path(owner), "r")
+    except (FileNotFoundError, ValueError):
+        return False
+    with f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        fcntl.flock(f, fcntl.LOCK_UN)
+        return False
+
+
+def remove_dead_owners() -> List[str]:
+    """終了したプロセスのロックファイルを削除し、そのIDを返す（片付けが済んでから呼ぶ）"""
+    removed: List[str] = []
+    try:
+        names = os.listdir(_owners_dir())
+    except FileNotFoundError:
+        return removed
+    for name in names:
+        owner, extension = os.path.splitext(name)
+        if extension != ".lock" or is_alive(owner):
+            continue
+        try:
+            os.remove(_lock_path(owner))
+        except FileNotFoundError:
+            # 同時に起動した他のプロセスが削除した
+            pass
+        removed.append(owner)
+    return removed
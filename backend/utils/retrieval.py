@@ -0,0 +1,250 @@
+"""
+類似チャンク検索ユーティリティ
+
+検索方式:
+    memory: プロセス常駐のインメモリインデックス（utils.vector_index）
+    rpc: 保存先の match_chunks
+         Supabaseでは PostgreSQL関数 match_chunks（pgvectorのivfflatインデックス）
+         VECTOR_QUANTIZATION=float16 の場合は match_chunks_halfvec（halfvecで候補を選び再スコアリング）
+         ローカルの保存先ではメモリマップしたEmbeddingファイルの全件走査
+    hybrid: インメモリインデックス + 語彙検索（utils.lexical_index）の順位の融合
+            識別子だけの質問は語彙検索で見つかればEmbeddingを生成しない
+
+複数の質問をまとめて検索する場合（/chat/batch）は retrieve_chunks_batch を使う
+いずれの方式も、指定したコレクション（utils.collection）のチャンクだけを検索する
+"""
+from config import settings
+from utils.collection import DEFAULT_COLLECTION
+from utils.concurrency import run_blocking
+from utils.embedding import generate_embedding
+from utils.lexical_index import is_identifier_query
+from utils.metrics import span
+from utils.vector_index import SearchHit, get_vector_index
+from typing import List, Optional, Sequence, Tuple
+import asyncio
+
+
+def search_memory(
+    store,
+    query_embedding: Sequence[float],
+    top_k: int,
+    min_similarity: Optional[float] = None,
+    collection: str = DEFAULT_COLLECTION
+) -> List[SearchHit]:
+    """コレクションのインメモリインデックスで検索（ファイルのないコレクションは UnknownCollectionError）"""
+    index = get_vector_index(collection, store)
+    with span("index_refresh"):
+        index.ensure_fresh(store)
+    with span("search"):
+        return index.search(query_embedding, top_k=top_k, min_similarity=min_similarity)
+
+
+def search_memory_batch(
+    store,
+    query_embeddings: Sequence[Sequence[float]],
+    top_k: int,
+    min_similarity: Optional[float] = None,
+    collection: str = DEFAULT_COLLECTION
+) -> List[List[SearchHit]]:
+    """コレクションのインメモリインデックスで複数の質問をまとめて検索（行列行列積）"""
+    index = get_vector_index(collection, store)
+    with span("index_refresh"):
+        index.ensure_fresh(store)
+    with span("search"):
+        return index.search_batch(query_embeddings, top_k=top_k, min_similarity=min_similarity)
+
+
+def search_rpc(
+    store,
+    query_embedding: Sequence[float],
+    top_k: int,
+    min_similarity: Optional[float] = None,
+    file_ids: Optional[List[str]] = None,
+    probes: Optional[int] = None,
+    collection: str = DEFAULT_COLLECTION
+) -> List[SearchHit]:
+    """
+    保存先の match_chunks で検索（Supabaseでは上位k件のみがネットワークを通る）
+
+    Args:
+        store: 保存先
+        query_embedding: 質問文のEmbedding
+        top_k: 取得件数
+        min_similarity: 類似度の下限
+        file_ids: 検索対象のファイルID（未指定時はコレクションの全件）
+        probes: ivfflat.probes（未指定時は設定値）
+        collection: コレクション
+
+    Returns:
+        類似度の降順に並んだ検索結果
+    """
+    with span("search_rpc"):
+        rows = store.match_chunks(
+            query_embedding,
+            top_k,
+            min_similarity,
+            file_ids=file_ids,
+            probes=probes,
+            collection=collection
+        )
+
+    return [
+        SearchHit(
+            chunk_id=row["id"],
+            file_id=row["file_id"],
+            filename=row.get("filename") or "不明",
+            content=row["content"],
+            similarity=float(row["similarity"])
+        )
+        for row in rows
+    ]
+
+
+async def retrieve_hybrid(
+    store,
+    question: str,
+    top_k: int,
+    min_similarity: Optional[float] = None,
+    collection: str = DEFAULT_COLLECTION
+) -> Tuple[Optional[List[float]], List[SearchHit]]:
+    """
+    語彙検索とベクトル検索を融合して検索
+
+    Args:
+        store: 保存先
+        question: 質問文
+        top_k: 取得件数
+        min_similarity: コサイン類似度の下限
+        collection: コレクション
+
+    Returns:
+        (質問文のEmbedding（生成しなかった場合はNone）, 検索結果)
+
+    Raises:
+        ValueError: 語彙検索が無効な場合
+        UnknownCollectionError: コレクションにファイルがない場合
+    """
+    index = await run_blocking(get_vector_index, collection, store)
+    with span("index_refresh"):
+        await run_blocking(index.ensure_fresh, store)
+
+    # 型番・エラーコードの検索は、その語を含むチャンクがあればOpenAIを呼ばずに返す
+    if settings.hybrid_identifier_skip_embedding and is_identifier_query(question):
+        with span("lexical_search"):
+            hits = await run_blocking(index.search_lexical, question, top_k, True)
+        if hits:
+            return None, hits
+
+    query_embedding = await generate_embedding(question)
+    with span("search"):
+        hits = await run_blocking(index.search_hybrid, question, query_embedding, top_k, min_similarity)
+    return query_embedding, hits
+
+
+def retrieve_chunks(
+    store,
+    query_embedding: Sequence[float],
+    top_k: int = 3,
+    mode: Optional[str] = None,
+    min_similarity: Optional[float] = None,
+    probes: Optional[int] = None,
+    collection: str = DEFAULT_COLLECTION
+) -> List[SearchHit]:
+    """
+    設定された検索方式で類似チャンクを取得
+
+    Args:
+        store: 保存先
+        query_embedding: 質問文のEmbedding
+        top_k: 取得件数
+        mode: 検索方式（未指定時は設定値）
+        min_similarity: 類似度の下限
+        probes: ivfflat.probes（rpc時のみ有効）
+        collection: コレクション
+
+    Returns:
+        類似度の降順に並んだ検索結果
+
+    Raises:
+        ValueError: 未対応の検索方式の場合
+        UnknownCollectionError: memory でコレクションにファイルがない場合
+    """
+    mode = mode or settings.retrieval_mode
+    if mode == "memory":
+        return search_memory(store, query_embedding, top_k, min_similarity, collection=collection)
+    if mode == "rpc":
+        return search_rpc(store, query_embedding, top_k, min_similarity, probes=probes, collection=collection)
+    if mode == "hybrid":
+        raise ValueError("hybrid検索は質問文が必要です（retrieve_hybrid を使用してください）")
+    raise ValueError(f"サポートされていない検索方式: {mode}")
+
+
+async def retrieve_chunks_batch(
+    store,
+    questions: List[str],
+    query_embeddings: List[List[float]],
+    top_k: int = 3,
+    mode: Optional[str] = None,
+    probes: Optional[int] = None,
+    concurrency: int = 4,
+    collection: str = DEFAULT_COLLECTION
+) -> List[List[SearchHit]]:
+    """
+    複数の質問の類似チャンクをまとめて取得
+
+    memory: インメモリインデックスに対して行列行列積でまとめて検索する
+    rpc: 保存先の match_chunks を concurrency 件まで並行して呼ぶ
+    hybrid: 生成済みのEmbeddingで質問ごとに融合検索する（識別子の質問でもEmbeddingを使う）
+
+    Args:
+        store: 保存先
+        questions: 質問文のリスト
+        query_embeddings: 質問文のEmbeddingのリスト（questions と同じ順序）
+        top_k: 取得件数
+        mode: 検索方式（未指定時は設定値）
+        probes: ivfflat.probes（rpc時のみ有効）
+        concurrency: rpc の同時実行数
+        collection: コレクション
+
+    Returns:
+        質問ごとの、類似度の降順に並んだ検索結果（入力順）
+
+    Raises:
+        ValueError: 未対応の検索方式、または hybrid で語彙検索が無効な場合
+        UnknownCollectionError: memory / hybrid でコレクションにファイルがない場合
+    """
+    mode = mode or settings.retrieval_mode
+    if mode == "memory":
+        return await run_blocking(search_memory_batch, store, query_embeddings, top_k, collection=collection)
+
+    if mode == "hybrid":
+        index = await run_blocking(get_vector_index, collection, store)
+        with span("index_refresh"):
+            await run_blocking(index.ensure_fresh, store)
+
+        def search_all() -> List[List[SearchHit]]:
+            return [
+                index.search_hybrid(question, query_embedding, top_k)
+                for question, query_embedding in zip(questions, query_embeddings)
+            ]
+
+        with span("search"):
+            return await run_blocking(search_all)
+
+    if mode == "rpc":
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run(query_embedding: List[float]) -> List[SearchHit]:
+            async with semaphore:
+                return await run_blocking(
+                    search_rpc,
+                    store,
+                    query_embedding,
+                    top_k,
+                    probes=probes,
+                    collection=collection
+                )
+
+        return list(await asyncio.gather(*[run(query_embedding) for query_embedding in query_embeddings]))
+
+    raise ValueError(f"サポートされていない検索方式: {mode}")
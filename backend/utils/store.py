@@ -0,0 +1,442 @@
+"""
+データの保存先（ファイル情報・チャンク・元ファイル）
+
+ルーターと取り込み処理は Store のメソッドだけを使い、保存先は STORAGE_BACKEND で切り替える。
+    supabase: Supabase（PostgREST・Storage・RPC）。既定
+    local: 同一ホストのSQLite・ファイル・メモリマップしたEmbeddingファイル（utils.local_store）
+メソッドはブロッキングするため、非同期の処理からは run_blocking で呼ぶ。
+ファイルとチャンクはコレクション（utils.collection）に属し、検索・読み込みはコレクションを指定して行う。
+"""
+from fastapi import HTTPException
+from config import settings
+from supabase_client import get_supabase_service_client
+from utils.collection import DEFAULT_COLLECTION
+from utils.uploads import SpooledUpload, send_spooled
+from utils.vector_index import parse_embedding
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Sequence, Tuple
+import os
+import threading
+import numpy as np
+
+
+# filesテーブルの列（一覧・挿入・更新で指定できるもの）
+FILE_COLUMNS = (
+    "id", "filename", "created_at", "status", "content_hash", "storage_path", "chunk_count", "byte_size", "collection"
+)
+
+# 検索対象にするファイルの status（updating は差分取り込み中。差し替えまでは旧版を検索対象に残す）
+SEARCHABLE_STATUSES = ("ready", "updating")
+
+# 元ファイルを置くバケット
+BUCKET = "files"
+
+# 既存チャンクのEmbeddingを問い合わせる際の1回あたりのハッシュ数（応答はハッシュごとに1行）
+HASH_LOOKUP_BATCH = 500
+
+# load_chunks の戻り値: (チャンクID, ファイルID, 本文, Embedding行列, ファイルID → ファイル名)
+LoadedChunks = Tuple[List[str], List[str], List[str], np.ndarray, Dict[str, str]]
+
+
+class Store(ABC):
+    """
+    保存先の共通インターフェース
+
+    行は Supabase の応答と同じ形の dict で受け渡す
+    （created_at はISO 8601の文字列、Embeddingはpgvectorのテキスト形式または配列）
+    """
+
+    # バックエンド名（STORAGE_BACKEND の値）
+    name = ""
+    # チャンクの挿入を送信サイズで区切ったバッチに分けて並行に送るか（リモートの保存先のみ）
+    parallel_inserts = False
+
+    @abstractmethod
+    def catalog_version(self) -> Optional[int]:
+        """ファイル一覧のバージョン（filesの追加・更新・削除で進む。取得できない場合はNone）"""
+
+    @abstractmethod
+    def list_files(
+        self,
+        columns: Sequence[str],
+        limit: int,
+        after: Optional[Tuple[str, str]] = None,
+        collection: Optional[str] = None
+    ) -> List[dict]:
+        """
+        ファイル一覧を (created_at, id) の降順で取得
+
+        Args:
+            columns: 取得する列
+            limit: 件数
+            after: この (created_at, id) より後（古い側）の行だけを返す
+            collection: このコレクションのファイルだけを返す（未指定時は全コレクション）
+        """
+
+    @abstractmethod
+    def list_collections(self) -> List[dict]:
+        """ファイルのあるコレクションの collection, file_count, chunk_count を取得（コレクション名の昇順）"""
+
+    @abstractmethod
+    def get_file(self, file_id: str) -> Optional[dict]:
+        """ファイル情報（全列）を取得"""
+
+    @abstractmethod
+    def find_file(
+        self,
+        filename: Optional[str] = None,
+        content_hash: Optional[str] = None,
+        exclude_id: Optional[str] = None,
+        collection: Optional[str] = None
+    ) -> Optional[dict]:
+        """ファイル名または内容のハッシュが一致するファイル（id, filename）を1件取得（collection 指定時はその中だけ）"""
+
+    @abstractmethod
+    def insert_file(self, values: dict) -> Optional[dict]:
+        """ファイル情報を保存し、保存した行（id, created_at を含む）を返す"""
+
+    @abstractmethod
+    def update_file(self, file_id: str, values: dict) -> None:
+        """ファイル情報の列を更新"""
+
+    @abstractmethod
+    def update_file_status(self, file_id: str, status: str, expected: str) -> Optional[dict]:
+        """status が expected のファイルだけ status を変更し、変更後の行（全列）を返す（一致しなければNone）"""
+
+    @abstractmethod
+    def delete_file(self, file_id: str) -> None:
+        """ファイル情報を削除（チャンクも削除される）"""
+
+    @abstractmethod
+    def upload_object(self, path: str, upload: SpooledUpload) -> None:
+        """一時ファイルを元ファイルとして保存（同じパスがあれば上書き）"""
+
+    @abstractmethod
+    def remove_objects(self, paths: List[str]) -> None:
+        """元ファイルを削除（存在しないパスは無視される）"""
+
+    @abstractmethod
+    def insert_chunks(self, rows: List[dict]) -> None:
+        """build_chunk_rows で作った行を挿入（コレクションはファイルのものになる。結果の行は返さない）"""
+
+    @abstractmethod
+    def find_embeddings(self, hashes: Sequence[str]) -> List[dict]:
+        """本文のハッシュが一致する保存済みチャンクの content_hash と embedding をハッシュごとに1件取得（全コレクションから）"""
+
+    @abstractmethod
+    def file_chunks(self, file_id: str) -> List[dict]:
+        """ファイルに属するチャンクの id, content, content_hash を取得"""
+
+    @abstractmethod
+    def replace_file_chunks(
+        self,
+        file_id: str,
+        removed_ids: List[str],
+        added: List[dict],
+        content_hash: Optional[str] = None,
+        storage_path: Optional[str] = None,
+        byte_size: Optional[int] = None
+    ) -> List[dict]:
+        """
+        チャンクの削除・追加とファイル情報の更新を1トランザクションで行う
+
+        Args:
+            file_id: ファイルID
+            removed_ids: 削除するチャンクID
+            added: 追加するチャンク（content, content_hash, embedding）
+            content_hash: 新しい版の内容のハッシュ
+            storage_path: 新しい版の保存先のパス
+            byte_size: 新しい版のバイト数
+
+        Returns:
+            追加したチャンクの id と content_hash
+        """
+
+    @abstractmethod
+    def load_chunks(self, dim: int, collection: str = DEFAULT_COLLECTION) -> LoadedChunks:
+        """コレクションの検索対象（files.status が SEARCHABLE_STATUSES）のチャンクをすべて読み込む（次元数の異なる行は除く）"""
+
+    @abstractmethod
+    def match_chunks(
+        self,
+        query_embedding: Sequence[float],
+        top_k: int,
+        min_similarity: Optional[float] = None,
+        file_ids: Optional[List[str]] = None,
+        probes: Optional[int] = None,
+        collection: str = DEFAULT_COLLECTION
+    ) -> List[dict]:
+        """
+        コレクションの検索対象のチャンクから類似度の上位k件を取得（他のコレクションの行は走査しない）
+
+        Returns:
+            id, file_id, filename, content, similarity の行（類似度の降順）
+        """
+
+    def close(self) -> None:
+        pass
+
+
+class SupabaseStore(Store):
+    """Supabase（PostgREST・Storage・RPC）に保存する"""
+
+    name = "supabase"
+    parallel_inserts = True
+
+    def __init__(self, client):
+        self.client = client
+
+    def catalog_version(self) -> Optional[int]:
+        response = self.client.table("catalog_state").select("version").limit(1).execute()
+        if not response.data:
+            return None
+        return int(response.data[0]["version"])
+
+    def list_files(
+        self,
+        columns: Sequence[str],
+        limit: int,
+        after: Optional[Tuple[str, str]] = None,
+        collection: Optional[str] = None
+    ) -> List[dict]:
+        query = self.client.table("files").select(", ".join(columns))
+        if collection is not None:
+            query = query.eq("collection", collection)
+        if after is not None:
+            created_at, file_id = after
+            query = query.or_(
+                f'created_at.lt."{created_at}",and(created_at.eq."{created_at}",id.lt.{file_id})'
+            )
+        return query.order("created_at", desc=True).order("id", desc=True).limit(limit).execute().data
+
+    def list_collections(self) -> List[dict]:
+        # コレクションごとの集計はビュー（docs/init_db.sql の file_collections）で行う
+        response = self.client.table("file_collections") \
+            .select("collection, file_count, chunk_count") \
+            .order("collection") \
+            .execute()
+        return response.data or []
+
+    def get_file(self, file_id: str) -> Optional[dict]:
+        response = self.client.table("files").select("*").eq("id", file_id).execute()
+        return response.data[0] if response.data else None
+
+    def find_file(
+        self,
+        filename: Optional[str] = None,
+        content_hash: Optional[str] = None,
+        exclude_id: Optional[str] = None,
+        collection: Optional[str] = None
+    ) -> Optional[dict]:
+        query = self.client.table("files").select("id, filename")
+        if collection is not None:
+            query = query.eq("collection", collection)
+        if filename is not None:
+            query = query.eq("filename", filename)
+        if content_hash is not None:
+            query = query.eq("content_hash", content_hash)
+        if exclude_id:
+            query = query.neq("id", exclude_id)
+        response = query.limit(1).execute()
+        return response.data[0] if response.data else None
+
+    def insert_file(self, values: dict) -> Optional[dict]:
+        response = self.client.table("files").insert(values).execute()
+        return response.data[0] if response.data else None
+
+    def update_file(self, file_id: str, values: dict) -> None:
+        self.client.table("files").update(values).eq("id", file_id).execute()
+
+    def update_file_status(self, file_id: str, status: str, expected: str) -> Optional[dict]:
+        # 条件付きのUPDATE（1文で判定と更新を行うため、同時に呼ばれても変更できるのは1つだけ）
+        response = self.client.table("files") \
+            .update({"status": status}) \
+            .eq("id", file_id) \
+            .eq("status", expected) \
+            .execute()
+        return response.data[0] if response.data else None
+
+    def delete_file(self, file_id: str) -> None:
+        # CASCADEでchunksも削除される
+        self.client.table("files").delete().eq("id", file_id).execute()
+
+    def upload_object(self, path: str, upload: SpooledUpload) -> None:
+        bucket = self.client.storage.from_(BUCKET)
+        try:
+            send_spooled(bucket.upload, path, upload)
+        except Exception as e:
+            # 既に存在する場合は上書きする
+            message = str(e).lower()
+            if "duplicate" not in message and "already exists" not in message:
+                raise
+            send_spooled(bucket.update, path, upload)
+
+    def remove_objects(self, paths: List[str]) -> None:
+        self.client.storage.from_(BUCKET).remove(paths)
+
+    def insert_chunks(self, rows: List[dict]) -> None:
+        # 挿入した行（Embeddingを含む）を返させない
+        self.client.table("chunks").insert(rows, returning="minimal").execute()
+
+    def find_embeddings(self, hashes: Sequence[str]) -> List[dict]:
+        hashes = list(hashes)
+        rows: List[dict] = []
+        for i in range(0, len(hashes), HASH_LOOKUP_BATCH):
+            # DISTINCT ON で1件に絞る（docs/init_db.sql の find_chunk_embeddings）
+            response = self.client.rpc(
+                "find_chunk_embeddings",
+                {"hashes": hashes[i:i + HASH_LOOKUP_BATCH]}
+            ).execute()
+            rows.extend(response.data or [])
+        return rows
+
+    def file_chunks(self, file_id: str) -> List[dict]:
+        rows: List[dict] = []
+        page_size = settings.vector_index_page_size
+        while True:
+            response = self.client.table("chunks") \
+                .select("id, content, content_hash") \
+                .eq("file_id", file_id) \
+                .order("id") \
+                .range(len(rows), len(rows) + page_size - 1) \
+                .execute()
+            rows.extend(response.data)
+            if len(response.data) < page_size:
+                return rows
+
+    def replace_file_chunks(
+        self,
+        file_id: str,
+        removed_ids: List[str],
+        added: List[dict],
+        content_hash: Optional[str] = None,
+        storage_path: Optional[str] = None,
+        byte_size: Optional[int] = None
+    ) -> List[dict]:
+        response = self.client.rpc("replace_file_chunks", {
+            "target_file_id": file_id,
+            "removed_ids": removed_ids,
+            "added": added,
+            "new_content_hash": content_hash,
+            "new_storage_path": storage_path,
+            "new_byte_size": byte_size
+        }).execute()
+        return response.data or []
+
+    def load_chunks(self, dim: int, collection: str = DEFAULT_COLLECTION) -> LoadedChunks:
+        page_size = settings.vector_index_page_size
+        chunk_ids: List[str] = []
+        file_ids: List[str] = []
+        contents: List[str] = []
+        vectors: List[np.ndarray] = []
+        filenames: Dict[str, str] = {}
+        start = 0
+
+        while True:
+            response = self.client.table("chunks") \
+                .select("id, file_id, content, embedding, files!inner(filename)") \
+                .eq("collection", collection) \
+                .in_("files.status", list(SEARCHABLE_STATUSES)) \
+                .order("id") \
+                .range(start, start + page_size - 1) \
+                .execute()
+            rows = response.data or []
+            for row in rows:
+                vector = parse_embedding(row.get("embedding"))
+                if vector is None or vector.size != dim:
+                    continue
+                files_data = row.get("files")
+                if isinstance(files_data, list) and files_data:
+                    files_data = files_data[0]
+                if isinstance(files_data, dict) and files_data.get("filename"):
+                    filenames[row["file_id"]] = files_data["filename"]
+                chunk_ids.append(row["id"])
+                file_ids.append(row["file_id"])
+                contents.append(row["content"])
+                vectors.append(vector)
+            if len(rows) < page_size:
+                break
+            start += page_size
+
+        matrix = np.vstack(vectors) if vectors else np.empty((0, dim), dtype=np.float32)
+        return chunk_ids, file_ids, contents, matrix, filenames
+
+    def match_chunks(
+        self,
+        query_embedding: Sequence[float],
+        top_k: int,
+        min_similarity: Optional[float] = None,
+        file_ids: Optional[List[str]] = None,
+        probes: Optional[int] = None,
+        collection: str = DEFAULT_COLLECTION
+    ) -> List[dict]:
+        params = {
+            "query_embedding": list(query_embedding),
+            "match_count": top_k,
+            "min_similarity": min_similarity,
+            "file_ids": file_ids,
+            "collection_name": collection,
+        }
+        if settings.vector_quantization == "float16":
+            # halfvecで候補を選び、候補だけをvectorで再スコアリングする
+            params["candidate_count"] = settings.vector_rescore_candidates
+            response = self.client.rpc("match_chunks_halfvec", params).execute()
+        else:
+            params["probes"] = probes if probes is not None else settings.ivfflat_probes
+            response = self.client.rpc("match_chunks", params).execute()
+        return response.data or []
+
+
+_store: Optional[Store] = None
+_lock = threading.Lock()
+
+
+def create_store() -> Store:
+    """
+    設定に従って保存先を作成
+
+    Raises:
+        ValueError: STORAGE_BACKEND が不正、または必要な設定が不足している場合
+    """
+    backend = settings.storage_backend
+    if backend == "supabase":
+        return SupabaseStore(get_supabase_service_client())
+    if backend == "local":
+        from utils.local_store import LocalStore
+        return LocalStore(settings.local_store_dir or os.path.join(settings.local_state_dir, "store"))
+    raise ValueError(f"サポートされていない保存先です: {backend}（supabase または local）")
+
+
+def get_store() -> Store:
+    """プロセス共通の保存先を取得"""
+    global _store
+    if _store is None:
+        with _lock:
+            if _store is None:
+                _store = create_store()
+    return _store
+
+
+def require_store() -> Store:
+    """
+    依存性注入用: 保存先を取得
+
+    Raises:
+        HTTPException: 保存先の設定が不足している場合
+    """
+    try:
+        return get_store()
+    except ValueError as e:
+        raise HTTPException(
+            status_code=500,
+            detail=str(e)
+        )
+
+
+def close_store() -> None:
+    """終了時に保存先を閉じる"""
+    global _store
+    with _lock:
+        if _store is not None:
+            _store.close()
+            _store = None
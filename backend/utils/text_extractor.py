@@ -1,10 +1,247 @@
 """
 テキスト抽出・チャンク分割ユーティリティ
+
+抽出はページ（DOCXは段落）単位のジェネレータで行い、チャンク分割もその列を
+順に読みながらトークン数の上限に収まる文単位のチャンクを生成する。
+ページ数の多いPDFはページ範囲ごとにプロセスプールへ分散し、
+ページごとのタイムアウトと抽出テキスト全体の上限を設ける。
+入力はバイト列のほか、一時保存したファイルのパスも受け付ける。パスの場合は
+メモリマップ・ファイルから必要な部分だけを読み、ファイル全体を複製しない。
 """
+from config import settings
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Union
+from utils.tokenizer import count_tokens
+import codecs
+import io
+import mmap
+import multiprocessing
+import os
+import re
+import signal
+import threading
 import PyPDF2
 from docx import Document
-from typing import List
-import io
+
+
+# ファイルのバイト列、またはファイルのパス
+Source = Union[bytes, str]
+
+# TXTを読み進める単位（文字数）
+TXT_READ_CHARS = 1024 * 1024
+
+
+@contextmanager
+def open_source(source: Source) -> Iterator[BinaryIO]:
+    """
+    入力をバイナリストリームとして開く
+
+    パスの場合は読み取り専用のメモリマップを返す（空ファイルはそのまま開く）
+    """
+    if isinstance(source, (bytes, bytearray)):
+        yield io.BytesIO(source)
+        return
+    with open(source, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield f
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield mapped
+
+
+class PageTimeoutError(Exception):
+    """1ページの抽出がタイムアウトした"""
+
+
+def _raise_page_timeout(signum, frame):
+    raise PageTimeoutError()
+
+
+def _extract_pdf_pages(source: Source, start: int, stop: int, page_timeout: float) -> List[str]:
+    """
+    PDFの指定範囲のページからテキストを抽出（プロセスプールのワーカーで実行）
+
+    ワーカープロセスのメインスレッドで動くため、SIGALRMでページごとに打ち切る。
+    タイムアウトしたページは空文字として扱う。
+
+    Args:
+        source: PDFファイルのバイト列またはパス
+        start: 開始ページ（0始まり）
+        stop: 終了ページ（このページは含まない）
+        page_timeout: 1ページあたりのタイムアウト（秒）
+
+    Returns:
+        ページごとのテキスト
+    """
+    use_alarm = page_timeout > 0 and hasattr(signal, "setitimer")
+    if use_alarm:
+        signal.signal(signal.SIGALRM, _raise_page_timeout)
+
+    pages = []
+    with open_source(source) as stream:
+        reader = PyPDF2.PdfReader(stream)
+        for number in range(start, stop):
+            try:
+                if use_alarm:
+                    signal.setitimer(signal.ITIMER_REAL, page_timeout)
+                pages.append(reader.pages[number].extract_text() or "")
+            except PageTimeoutError:
+                print(f"警告: PDFの{number + 1}ページ目の抽出がタイムアウトしたため、スキップします")
+                pages.append("")
+            finally:
+                if use_alarm:
+                    signal.setitimer(signal.ITIMER_REAL, 0)
+    return pages
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def get_extraction_pool() -> ProcessPoolExecutor:
+    """
+    PDF抽出用のプロセスプールを取得
+
+    スレッドを持つ親プロセスをforkしないよう spawn で起動する
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                workers = settings.extraction_workers or os.cpu_count() or 1
+                _pool = ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+    return _pool
+
+
+def shutdown_extraction_pool() -> None:
+    """プロセスプールを停止（終了時・プールが壊れた場合）"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def iter_text_from_pdf(source: Source) -> Iterator[str]:
+    """
+    PDFからページごとにテキストを取り出す
+
+    EXTRACTION_PARALLEL_MIN_PAGES 以上のPDFはプロセスプールで並列に抽出し、
+    ページ順に返す。パスを渡した場合、ワーカーには内容ではなくパスを渡す。
+
+    Args:
+        source: PDFファイルのバイト列またはパス
+
+    Yields:
+        ページのテキスト
+    """
+    try:
+        with open_source(source) as stream:
+            page_count = len(PyPDF2.PdfReader(stream).pages)
+    except Exception as e:
+        raise ValueError(f"PDFのテキスト抽出に失敗しました: {str(e)}")
+
+    page_timeout = settings.extraction_page_timeout_seconds
+    if page_count < settings.extraction_parallel_min_pages:
+        try:
+            pages = _extract_pdf_pages(source, 0, page_count, 0)
+        except Exception as e:
+            raise ValueError(f"PDFのテキスト抽出に失敗しました: {str(e)}")
+        yield from pages
+        return
+
+    step = max(1, settings.extraction_pages_per_task)
+    pool = get_extraction_pool()
+    futures = [
+        pool.submit(_extract_pdf_pages, source, start, min(start + step, page_count), page_timeout)
+        for start in range(0, page_count, step)
+    ]
+    # ページのタイムアウトが効かなかった場合に備え、タスク全体にも上限を設ける
+    task_timeout = page_timeout * step + 30 if page_timeout > 0 else None
+    try:
+        for future in futures:
+            yield from future.result(timeout=task_timeout)
+    except FutureTimeoutError:
+        raise ValueError("PDFのテキスト抽出がタイムアウトしました")
+    except BrokenProcessPool as e:
+        shutdown_extraction_pool()
+        raise ValueError(f"PDFのテキスト抽出に失敗しました: {str(e)}")
+    except Exception as e:
+        raise ValueError(f"PDFのテキスト抽出に失敗しました: {str(e)}")
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def iter_text_from_docx(source: Source) -> Iterator[str]:
+    """
+    DOCXから段落ごとにテキストを取り出す
+
+    Args:
+        source: DOCXファイルのバイト列またはパス
+
+    Yields:
+        段落のテキスト
+    """
+    with open_source(source) as stream:
+        try:
+            doc = Document(stream)
+        except Exception as e:
+            raise ValueError(f"DOCXのテキスト抽出に失敗しました: {str(e)}")
+    for paragraph in doc.paragraphs:
+        yield paragraph.text
+
+
+def _detect_txt_encoding(path: str) -> str:
+    """UTF-8として読めるかを少しずつ確認し、読めなければShift-JISとする"""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    with open(path, "rb") as f:
+        try:
+            for block in iter(lambda: f.read(TXT_READ_CHARS), b""):
+                decoder.decode(block)
+            decoder.decode(b"", final=True)
+        except UnicodeDecodeError:
+            return "shift-jis"
+    return "utf-8"
+
+
+def iter_text_from_txt(source: Source) -> Iterator[str]:
+    """
+    TXTからテキストを少しずつ取り出す
+
+    パスの場合は行単位で読み、空行（なければ行末）で区切って返す
+
+    Args:
+        source: TXTファイルのバイト列またはパス
+
+    Yields:
+        テキスト
+    """
+    if isinstance(source, (bytes, bytearray)):
+        yield extract_text_from_txt(source)
+        return
+
+    encoding = _detect_txt_encoding(source)
+    try:
+        with open(source, "r", encoding=encoding) as f:
+            buffer: List[str] = []
+            size = 0
+            for line in f:
+                buffer.append(line)
+                size += len(line)
+                if size >= TXT_READ_CHARS and (not line.strip() or size >= TXT_READ_CHARS * 2):
+                    yield "".join(buffer)
+                    buffer, size = [], 0
+            if buffer:
+                yield "".join(buffer)
+    except UnicodeDecodeError as e:
+        raise ValueError(f"TXTのテキスト抽出に失敗しました: {str(e)}")
 
 
 def extract_text_from_pdf(file_content: bytes) -> str:
@@ -17,17 +254,7 @@ def extract_text_from_pdf(file_content: bytes) -> str:
     Returns:
         抽出されたテキスト
     """
-    try:
-        pdf_file = io.BytesIO(file_content)
-        pdf_reader = PyPDF2.PdfReader(pdf_file)
-        text = ""
-        
-        for page in pdf_reader.pages:
-            text += page.extract_text() + "\n"
-        
-        return text.strip()
-    except Exception as e:
-        raise ValueError(f"PDFのテキスト抽出に失敗しました: {str(e)}")
+    return "\n".join(iter_text_from_pdf(file_content)).strip()
 
 
 def extract_text_from_docx(file_content: bytes) -> str:
@@ -40,17 +267,7 @@ def extract_text_from_docx(file_content: bytes) -> str:
     Returns:
         抽出されたテキスト
     """
-    try:
-        docx_file = io.BytesIO(file_content)
-        doc = Document(docx_file)
-        text = ""
-        
-        for paragraph in doc.paragraphs:
-            text += paragraph.text + "\n"
-        
-        return text.strip()
-    except Exception as e:
-        raise ValueError(f"DOCXのテキスト抽出に失敗しました: {str(e)}")
+    return "\n".join(iter_text_from_docx(file_content)).strip()
 
 
 def extract_text_from_txt(file_content: bytes) -> str:
@@ -76,63 +293,225 @@ def extract_text_from_txt(file_content: bytes) -> str:
             raise ValueError(f"TXTのテキスト抽出に失敗しました: {str(e)}")
 
 
-def extract_text(file_content: bytes, filename: str) -> str:
+def iter_text(source: Source, filename: str) -> Iterator[str]:
     """
-    ファイル形式に応じてテキストを抽出
-    
+    ファイル形式に応じてテキストをページ・段落単位で取り出す
+
+    取り出したテキストの合計が EXTRACTION_MAX_CHARS を超えた時点で中断する。
+
     Args:
-        file_content: ファイルのバイト列
+        source: ファイルのバイト列またはパス
         filename: ファイル名（拡張子から形式を判定）
-        
-    Returns:
-        抽出されたテキスト
+
+    Yields:
+        ページ・段落のテキスト
+
+    Raises:
+        ValueError: 未対応の形式、抽出失敗、または上限超過の場合
     """
     file_ext = filename.split(".")[-1].lower() if "." in filename else ""
-    
+
     if file_ext == "pdf":
-        return extract_text_from_pdf(file_content)
+        parts = iter_text_from_pdf(source)
     elif file_ext == "docx":
-        return extract_text_from_docx(file_content)
+        parts = iter_text_from_docx(source)
     elif file_ext == "txt":
-        return extract_text_from_txt(file_content)
+        parts = iter_text_from_txt(source)
     else:
         raise ValueError(f"サポートされていないファイル形式: {file_ext}")
 
+    max_chars = settings.extraction_max_chars
+    total = 0
+    try:
+        for part in parts:
+            total += len(part) + 1
+            if max_chars and total > max_chars:
+                raise ValueError(f"抽出されたテキストが上限（{max_chars}文字）を超えています")
+            yield part
+    finally:
+        # 中断時は残りのプロセスプールのタスクを取り消す
+        parts.close()
+
+
+def extract_text(source: Source, filename: str) -> str:
+    """
+    ファイル形式に応じてテキストを抽出
+    
+    Args:
+        source: ファイルのバイト列またはパス
+        filename: ファイル名（拡張子から形式を判定）
+        
+    Returns:
+        抽出されたテキスト
+    """
+    return "\n".join(iter_text(source, filename)).strip()
+
+
+# 文の区切り（日本語の句点・感嘆符・疑問符、空白が続く英語のピリオド）
+_SENTENCE_BODY = r"(?:[^\n。．！？!?.]|\.(?!\s))+"
+_SENTENCE_END = r"(?:[。．！？!?]+|\.)[」』）)\]\"']*"
+SEGMENT_PATTERN = re.compile(rf"{_SENTENCE_BODY}(?:{_SENTENCE_END})?\s*|{_SENTENCE_END}\s*|\s+")
+
+# 区切りの強さ（チャンクの切れ目として優先する順）
+BOUNDARY_LINE = 0
+BOUNDARY_SENTENCE = 1
+BOUNDARY_PARAGRAPH = 2
+
+
+@dataclass
+class _Segment:
+    """チャンクを構成する文（または行）"""
+    text: str
+    tokens: int
+    boundary: int
+
+
+def _boundary_of(segment: str) -> int:
+    body = segment.rstrip()
+    trailing = segment[len(body):]
+    if trailing.count("\n") >= 2:
+        return BOUNDARY_PARAGRAPH
+    if re.search(rf"{_SENTENCE_END}$", body):
+        return BOUNDARY_SENTENCE
+    return BOUNDARY_LINE
+
+
+def _iter_segments(parts: Iterable[str], max_tokens: int) -> Iterator[_Segment]:
+    """
+    ページ・段落の列を文単位に分ける
+
+    ページ・段落の終わりは段落の区切りとして扱う。
+    max_tokens を超える文は文字数で按分して分割する。
+    """
+    for part in parts:
+        previous: Optional[_Segment] = None
+        for match in SEGMENT_PATTERN.finditer(part):
+            text = match.group()
+            if not text.strip():
+                # 空白だけの場合は直前の文に付ける（空行なら段落の区切り）
+                if previous is not None:
+                    previous.text += text
+                    if text.count("\n") >= 2:
+                        previous.boundary = BOUNDARY_PARAGRAPH
+                continue
+            if previous is not None:
+                yield previous
+            previous = _Segment(text, count_tokens(text), _boundary_of(text))
+            if previous.tokens > max_tokens:
+                step = max(1, len(text) * max_tokens // previous.tokens)
+                pieces = [text[i:i + step] for i in range(0, len(text), step)]
+                for piece in pieces[:-1]:
+                    yield _Segment(piece, count_tokens(piece), BOUNDARY_LINE)
+                previous = _Segment(pieces[-1], count_tokens(pieces[-1]), previous.boundary)
+        if previous is not None:
+            if not previous.text.endswith("\n"):
+                previous.text += "\n"
+            previous.boundary = BOUNDARY_PARAGRAPH
+            yield previous
+
+
+def iter_chunks(
+    parts: Iterable[str],
+    max_tokens: Optional[int] = None,
+    overlap_tokens: Optional[int] = None
+) -> Iterator[str]:
+    """
+    ページ・段落の列からトークン数の上限に収まるチャンクを順に生成
+
+    文単位で詰め、上限を超える手前で切る。切れ目はチャンクの後半にある
+    最も強い区切り（段落 > 文 > 行）を選ぶ。段落の途中で切った場合のみ、
+    直前の文を overlap_tokens 以内で次のチャンクの先頭に重ねる。
+    途中で切った段落の終わりと、上限の半分以上埋まった時点での段落の終わりでも切る。
+    保持するのは作成中のチャンク1つ分だけなので、文書の大きさによらず
+    メモリ使用量は一定。
+
+    Args:
+        parts: テキストの列（iter_text の出力など）
+        max_tokens: チャンクの最大トークン数（未指定時は CHUNK_MAX_TOKENS）
+        overlap_tokens: 重ねる最大トークン数（未指定時は CHUNK_OVERLAP_TOKENS）
+
+    Yields:
+        チャンク
+    """
+    max_tokens = max_tokens or settings.chunk_max_tokens
+    overlap_tokens = settings.chunk_overlap_tokens if overlap_tokens is None else overlap_tokens
+    overlap_tokens = min(overlap_tokens, max_tokens // 2)
+
+    pending: List[_Segment] = []
+    total = 0
+    fresh = 0  # 前のチャンクと重ねた文を除いた、未出力の文の数
+    continued = False  # 作成中のチャンクが段落の途中から始まっているか
+
+    def cut() -> str:
+        nonlocal pending, total, fresh, continued
+        # 後半にある最も強い区切りで切る（同じ強さなら後ろを優先）
+        cumulative, best = 0, len(pending) - 1
+        best_key = (-1, -1)
+        for i, segment in enumerate(pending):
+            cumulative += segment.tokens
+            if cumulative >= max_tokens // 2 and (segment.boundary, i) >= best_key:
+                best, best_key = i, (segment.boundary, i)
+        emitted, rest = pending[:best + 1], pending[best + 1:]
+        continued = emitted[-1].boundary < BOUNDARY_PARAGRAPH
+
+        overlap: List[_Segment] = []
+        if emitted[-1].boundary < BOUNDARY_PARAGRAPH and overlap_tokens > 0:
+            size = 0
+            for segment in reversed(emitted[1:]):
+                if size + segment.tokens > overlap_tokens:
+                    break
+                overlap.insert(0, segment)
+                size += segment.tokens
+
+        pending = overlap + rest
+        total = sum(segment.tokens for segment in pending)
+        fresh = len(rest)
+        return "".join(segment.text for segment in emitted).strip()
+
+    for segment in _iter_segments(parts, max_tokens):
+        while pending and total + segment.tokens > max_tokens:
+            if fresh == 0:
+                # 重ねた文だけでは上限に収まらない場合は重ねない
+                pending, total = [], 0
+                break
+            chunk = cut()
+            if chunk:
+                yield chunk
+        pending.append(segment)
+        total += segment.tokens
+        fresh += 1
+
+        # 途中で切った段落の終わり、または半分以上埋まった状態で段落が終わったらそこで切る。
+        # 切れ目が段落の先頭に揃うため、一部の段落を書き換えても
+        # 以降のチャンクは同じ内容になる（更新時の差分取り込みで再利用できる）
+        if segment.boundary == BOUNDARY_PARAGRAPH and (continued or total >= max_tokens // 2):
+            chunk = "".join(segment.text for segment in pending).strip()
+            pending, total, fresh, continued = [], 0, 0, False
+            if chunk:
+                yield chunk
+
+    if fresh:
+        chunk = "".join(segment.text for segment in pending).strip()
+        if chunk:
+            yield chunk
 
-def split_into_chunks(text: str, chunk_size: int = 500, overlap: int = 100) -> List[str]:
+
+def split_into_chunks(
+    text: str,
+    max_tokens: Optional[int] = None,
+    overlap_tokens: Optional[int] = None
+) -> List[str]:
     """
     テキストをチャンクに分割
     
     Args:
         text: 分割するテキスト
-        chunk_size: チャンクサイズ（文字数）
-        overlap: オーバーラップサイズ（文字数）
+        max_tokens: チャンクの最大トークン数
+        overlap_tokens: 重ねる最大トークン数
         
     Returns:
         チャンクのリスト
     """
     if not text:
         return []
-    
-    chunks = []
-    start = 0
-    
-    while start < len(text):
-        end = start + chunk_size
-        
-        # チャンクを取得
-        chunk = text[start:end]
-        
-        # チャンクが空でない場合のみ追加
-        if chunk.strip():
-            chunks.append(chunk.strip())
-        
-        # 次の開始位置を計算（オーバーラップを考慮）
-        start = end - overlap
-        
-        # 無限ループを防ぐ
-        if start >= len(text):
-            break
-    
-    return chunks
-
+    return list(iter_chunks([text], max_tokens, overlap_tokens))
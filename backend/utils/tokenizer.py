@@ -0,0 +1,58 @@
+"""
+トークン数計算ユーティリティ
+
+OpenAIのEmbeddingモデル（text-embedding-ada-002）と同じ cl100k_base で数える。
+tiktokenのエンコーディング定義を読み込めない環境（オフライン等）では
+多めに見積もる近似値を使う。
+"""
+from typing import Optional
+import threading
+
+
+ENCODING_NAME = "cl100k_base"
+
+_encoding = None
+_encoding_failed = False
+_lock = threading.Lock()
+
+
+def get_encoding():
+    """tiktokenのエンコーディングを取得（読み込めない場合はNone）"""
+    global _encoding, _encoding_failed
+    if _encoding is None and not _encoding_failed:
+        with _lock:
+            if _encoding is None and not _encoding_failed:
+                try:
+                    import tiktoken
+                    _encoding = tiktoken.get_encoding(ENCODING_NAME)
+                except Exception as e:
+                    _encoding_failed = True
+                    print(f"警告: tiktokenを読み込めないため、トークン数は近似値を使います: {str(e)}")
+    return _encoding
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    トークン数の近似値（多めに見積もる）
+
+    ASCIIは約3文字で1トークン、日本語などそれ以外は1文字あたり1.5トークンとして数える
+    """
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return int((len(text) - ascii_chars) * 1.5 + ascii_chars / 3) + 1
+
+
+def count_tokens(text: str, encoding: Optional[object] = None) -> int:
+    """
+    テキストのトークン数を取得
+
+    Args:
+        text: テキスト
+        encoding: 使用するエンコーディング（未指定時は cl100k_base）
+
+    Returns:
+        トークン数
+    """
+    encoding = encoding or get_encoding()
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
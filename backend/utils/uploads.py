@@ -0,0 +1,242 @@
+"""
+アップロードの一時保存（スプール）
+
+アップロードされたファイルを一定サイズずつ一時ファイルに書き出し、
+Storageへの送信とテキスト抽出はこのファイルから行う。
+ファイル全体をメモリに載せないため、大きなファイルが同時に届いても
+1件あたりのメモリ使用量は読み書きの単位程度に収まる。
+一時ファイルはプロセスごとのディレクトリに置き、終了したプロセスの分は起動時に削除する。
+"""
+from config import settings
+from fastapi import UploadFile
+from dataclasses import dataclass
+from typing import BinaryIO, Callable, Dict, Optional
+from utils.concurrency import run_blocking
+from utils.owner import is_alive, process_id
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+
+class UploadTooLargeError(ValueError):
+    """アップロードサイズの上限超過"""
+
+
+@dataclass
+class SpooledUpload:
+    """一時ファイルに保存したアップロード"""
+    path: str
+    size: int
+    content_type: str
+    # 内容のSHA-256（16進）
+    content_hash: str
+
+
+def _spool_root() -> str:
+    return settings.upload_spool_dir or os.path.join(settings.local_state_dir, "uploads")
+
+
+def get_spool_dir() -> str:
+    """このプロセスの一時ファイルの保存先（UPLOAD_SPOOL_DIR、未指定時は local_state_dir/uploads の下のプロセスIDのディレクトリ）"""
+    directory = os.path.join(_spool_root(), process_id())
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def remove_orphaned_spools() -> int:
+    """
+    終了したプロセスが残した一時ファイルを削除（起動時に呼ぶ）
+
+    Returns:
+        削除したディレクトリ・ファイルの数
+    """
+    try:
+        entries = list(os.scandir(_spool_root()))
+    except FileNotFoundError:
+        return 0
+    removed = 0
+    for entry in entries:
+        if entry.is_dir():
+            if is_alive(entry.name):
+                continue
+            shutil.rmtree(entry.path, ignore_errors=True)
+        else:
+            # プロセスごとのディレクトリに分ける前の一時ファイル
+            remove_spooled(entry.path)
+        removed += 1
+    return removed
+
+
+def too_large_message(max_bytes: int) -> str:
+    return f"ファイルサイズが上限（{max_bytes // (1024 * 1024)}MB）を超えています"
+
+
+def remove_spooled(path: str) -> None:
+    """一時ファイルを削除（既にない場合は何もしない）"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+async def spool_upload(
+    file: UploadFile,
+    max_bytes: Optional[int] = None,
+    chunk_size: Optional[int] = None
+) -> SpooledUpload:
+    """
+    アップロードファイルを一定サイズずつ一時ファイルに書き出す
+
+    書き出しながら内容のSHA-256も計算する
+
+    Args:
+        file: アップロードファイル
+        max_bytes: 最大サイズ（未指定時は MAX_UPLOAD_BYTES）
+        chunk_size: 読み書きの単位（未指定時は UPLOAD_CHUNK_BYTES）
+
+    Returns:
+        一時ファイルの情報（不要になったら remove_spooled で削除する）
+
+    Raises:
+        UploadTooLargeError: 上限を超えた場合
+    """
+    max_bytes = max_bytes or settings.max_upload_bytes
+    chunk_size = chunk_size or settings.upload_chunk_bytes
+
+    # multipartの解析時点でサイズが分かっていれば、読み込む前に拒否する
+    if file.size is not None and file.size > max_bytes:
+        raise UploadTooLargeError(too_large_message(max_bytes))
+
+    fd, path = tempfile.mkstemp(dir=get_spool_dir(), suffix=".upload")
+    size = 0
+    digest = hashlib.sha256()
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                data = await file.read(chunk_size)
+                if not data:
+                    break
+                size += len(data)
+                if size > max_bytes:
+                    raise UploadTooLargeError(too_large_message(max_bytes))
+                digest.update(data)
+                await run_blocking(out.write, data)
+    except BaseException:
+        remove_spooled(path)
+        raise
+
+    return SpooledUpload(
+        path=path,
+        size=size,
+        content_type=file.content_type or "application/octet-stream",
+        content_hash=digest.hexdigest()
+    )
+
+
+def spool_stream(
+    stream: BinaryIO,
+    content_type: str,
+    max_bytes: Optional[int] = None,
+    chunk_size: Optional[int] = None
+) -> SpooledUpload:
+    """
+    ファイルオブジェクト（ZIP内のファイルなど）を一定サイズずつ一時ファイルに書き出す
+
+    spool_upload の同期版。スレッドプールで実行する。
+
+    Args:
+        stream: 読み込み元
+        content_type: Content-Type
+        max_bytes: 最大サイズ（未指定時は MAX_UPLOAD_BYTES）
+        chunk_size: 読み書きの単位（未指定時は UPLOAD_CHUNK_BYTES）
+
+    Returns:
+        一時ファイルの情報
+
+    Raises:
+        UploadTooLargeError: 上限を超えた場合
+    """
+    max_bytes = max_bytes or settings.max_upload_bytes
+    chunk_size = chunk_size or settings.upload_chunk_bytes
+
+    fd, path = tempfile.mkstemp(dir=get_spool_dir(), suffix=".upload")
+    size = 0
+    digest = hashlib.sha256()
+    try:
+        with os.fdopen(fd, "wb") as out:
+            for data in iter(lambda: stream.read(chunk_size), b""):
+                size += len(data)
+                if size > max_bytes:
+                    raise UploadTooLargeError(too_large_message(max_bytes))
+                digest.update(data)
+                out.write(data)
+    except BaseException:
+        remove_spooled(path)
+        raise
+
+    return SpooledUpload(path=path, size=size, content_type=content_type, content_hash=digest.hexdigest())
+
+
+def send_spooled(send: Callable, storage_path: str, upload: SpooledUpload):
+    """
+    一時ファイルをStorageへ送信（ファイルオブジェクトを渡し、少しずつ読ませる）
+
+    Args:
+        send: バケットの upload または update
+        storage_path: Storage上のパス
+        upload: 一時ファイルの情報
+
+    Returns:
+        send の戻り値
+    """
+    with open(upload.path, "rb") as f:
+        return send(storage_path, f, file_options={"content-type": upload.content_type})
+
+
+class UploadSizeLimitMiddleware:
+    """
+    Content-Length が上限を超えるアップロードを本文を読む前に 413 で拒否する
+
+    上限はパスの前方一致で決める（最も長く一致したものを使う）。
+    Content-Length のない（chunked）リクエストは spool_upload で書き出し中に判定する
+    """
+
+    # multipartの境界・ヘッダー分の余裕
+    MULTIPART_OVERHEAD = 64 * 1024
+
+    def __init__(self, app, limits: Dict[str, int]):
+        self.app = app
+        self.limits = sorted(limits.items(), key=lambda item: len(item[0]), reverse=True)
+
+    def _limit_for(self, path: str) -> Optional[int]:
+        for prefix, max_bytes in self.limits:
+            if path.startswith(prefix):
+                return max_bytes
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] in ("POST", "PUT"):
+            max_bytes = self._limit_for(scope["path"])
+            if max_bytes:
+                for name, value in scope["headers"]:
+                    if name == b"content-length":
+                        if value.isdigit() and int(value) > max_bytes + self.MULTIPART_OVERHEAD:
+                            await self._reject(send, max_bytes)
+                            return
+                        break
+        await self.app(scope, receive, send)
+
+    async def _reject(self, send, max_bytes: int) -> None:
+        body = json.dumps({"detail": too_large_message(max_bytes)}, ensure_ascii=False).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"connection", b"close"),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
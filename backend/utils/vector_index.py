@@ -0,0 +1,800 @@
+"""
+インメモリベクトルインデックス
+
+正規化済みEmbeddingを1つの連続した行列として保持し、
+行列ベクトル積1回とargpartitionで上位k件を求める。
+複数の質問（/chat/batch）は search_batch で質問を並べた行列との行列行列積にまとめる。
+インデックスはコレクションごとに別の行列を持ち、検索はそのコレクションの行だけを走査する。
+
+語彙検索（utils.lexical_index）を有効にすると同じチャンクの転置インデックスも一緒に更新し、
+search_hybrid で語彙検索とベクトル検索の順位を融合（RRF）する。
+
+VECTOR_QUANTIZATION を float16 / int8 にすると、検索用の行列を量子化して2〜4分の1に縮め、
+1段目でその行列から候補を選び、2段目で候補だけをfloat32で再スコアリングする。
+float32の行はメモリマップした一時ファイルに置き、候補の数十行だけを読む。
+"""
+from config import settings
+from utils.collection import DEFAULT_COLLECTION, UnknownCollectionError
+from utils.corpus import current_version, bump_version
+from utils.lexical_index import LexicalIndex
+from utils.metrics import record_scan
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+import heapq
+import json
+import os
+import tempfile
+import threading
+import time
+import numpy as np
+
+
+# 量子化方式 → 検索用行列のdtype
+QUANTIZATION_DTYPES = {
+    "none": np.float32,
+    "float16": np.float16,
+    "int8": np.int8,
+}
+
+# 量子化した行列をfloat32に変換しながら走査する際の1回あたりの行数
+# （変換先がCPUキャッシュに収まる大きさにする。大きすぎると変換のたびにメモリを往復する）
+SCAN_BLOCK_ROWS = 128
+
+# search_batch で1回の行列積にまとめる質問の数
+# （スコア行列は 行数 × 質問数 のfloat32になるため、質問数で大きさを抑える）
+QUERY_BLOCK_SIZE = 64
+
+
+@dataclass
+class SearchHit:
+    """検索結果1件"""
+    chunk_id: str
+    file_id: str
+    filename: str
+    content: str
+    # コサイン類似度（語彙検索だけで見つけた場合はNone）
+    similarity: Optional[float]
+    # BM25スコア（語彙検索で見つかった場合）
+    lexical_score: Optional[float] = None
+
+
+def parse_embedding(value) -> Optional[np.ndarray]:
+    """
+    Supabaseから返されたEmbeddingをfloat32配列に変換
+
+    pgvectorの列はPostgREST経由だと "[0.1,0.2,...]" 形式の文字列で返る
+
+    Args:
+        value: 文字列またはリスト
+
+    Returns:
+        float32配列（パースできない場合はNone）
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        try:
+            vector = np.fromstring(value.strip().strip("[]"), sep=",", dtype=np.float32)
+        except ValueError:
+            try:
+                vector = np.asarray(json.loads(value), dtype=np.float32)
+            except (ValueError, TypeError):
+                return None
+    else:
+        vector = np.asarray(value, dtype=np.float32)
+    return vector if vector.ndim == 1 and vector.size > 0 else None
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """行ごとにL2正規化（ゼロベクトルはそのまま）"""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def int8_scales(embeddings: np.ndarray) -> np.ndarray:
+    """
+    int8量子化の次元ごとのスケール（正規化後の絶対値の最大が127になる値）
+
+    Args:
+        embeddings: Embedding行列（正規化前でよい）
+
+    Returns:
+        float32のスケール（次元数）
+    """
+    peak = np.zeros(embeddings.shape[1], dtype=np.float32)
+    for start in range(0, embeddings.shape[0], SCAN_BLOCK_ROWS):
+        block = normalize_rows(np.asarray(embeddings[start:start + SCAN_BLOCK_ROWS], dtype=np.float32))
+        np.maximum(peak, np.abs(block).max(axis=0), out=peak)
+    peak[peak == 0] = 1.0
+    return peak / 127.0
+
+
+def compact_rows(array: np.ndarray, keep: np.ndarray) -> None:
+    """
+    keep（昇順）の行を先頭に詰める
+
+    一度に全行をコピーしないよう、ブロックごとに前へ移す
+    （keep[j] >= j のため、まだ読んでいない行を上書きすることはない）
+    """
+    for start in range(0, keep.size, SCAN_BLOCK_ROWS):
+        rows = keep[start:start + SCAN_BLOCK_ROWS]
+        array[start:start + rows.size] = array[rows]
+
+
+class FullPrecisionRows:
+    """
+    再スコアリング用のfloat32行
+
+    local_state_dir 配下の一時ファイル（作成直後に削除され、プロセス終了時に消える）に
+    メモリマップし、プロセスのメモリではなくOSのページキャッシュに置く
+    """
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        directory = os.path.join(settings.local_state_dir, "vector_index")
+        os.makedirs(directory, exist_ok=True)
+        self._file = tempfile.TemporaryFile(dir=directory)
+        self.rows = np.empty((0, dim), dtype=np.float32)
+
+    def reserve(self, capacity: int) -> None:
+        """容量を capacity 行に変更（既存の行はファイル上にあるためコピーしない）"""
+        self._file.truncate(capacity * self.dim * 4)
+        if capacity == 0:
+            self.rows = np.empty((0, self.dim), dtype=np.float32)
+            return
+        self.rows = np.memmap(self._file, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+
+    @property
+    def nbytes(self) -> int:
+        return self.rows.nbytes
+
+
+class VectorIndex:
+    """
+    プロセス常駐のベクトルインデックス
+
+    行列の行 i と chunk_ids[i] / file_ids[i] / contents[i] が対応する。
+    追加時は容量を倍々で確保し、アップロードのたびに全体をコピーしない。
+    1つのインデックスは1つのコレクションのチャンクだけを持つ。
+    """
+
+    def __init__(
+        self,
+        dim: int,
+        quantization: str = "none",
+        rescore_candidates: int = 40,
+        lexical: Optional[LexicalIndex] = None,
+        collection: str = DEFAULT_COLLECTION
+    ):
+        if quantization not in QUANTIZATION_DTYPES:
+            raise ValueError(f"サポートされていない量子化方式: {quantization}")
+        self.dim = dim
+        self.collection = collection
+        self.quantization = quantization
+        self.rescore_candidates = rescore_candidates
+        self._dtype = QUANTIZATION_DTYPES[quantization]
+        # int8の次元ごとのスケール（全件読み込み時に決め、追加分は範囲外を丸める）
+        self._scales = np.full(dim, 1.0 / 127.0, dtype=np.float32)
+        # 量子化時のみ、再スコアリング用のfloat32行を別に持つ
+        self._full = FullPrecisionRows(dim) if self.quantized else None
+        # 語彙検索の転置インデックスと、チャンクID → 行番号（語彙検索の候補を行列の行に対応づける）
+        self._lexical = lexical
+        self._rows: Dict[str, int] = {}
+        self._lock = threading.RLock()
+        self._load_lock = threading.Lock()
+        self._matrix = np.empty((0, dim), dtype=self._dtype)
+        self._size = 0
+        self._chunk_ids = np.empty(0, dtype=object)
+        self._file_ids = np.empty(0, dtype=object)
+        self._contents = np.empty(0, dtype=object)
+        self._filenames: Dict[str, str] = {}
+        self._loaded = False
+        self._version = -1
+        self._loaded_at = 0.0
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    @property
+    def quantized(self) -> bool:
+        return self.quantization != "none"
+
+    @property
+    def has_lexical(self) -> bool:
+        return self._lexical is not None
+
+    def memory_stats(self) -> dict:
+        """検索用行列（プロセスのメモリ）と再スコアリング用の行（メモリマップ）のバイト数"""
+        with self._lock:
+            return {
+                "collection": self.collection,
+                "chunks": self._size,
+                "quantization": self.quantization,
+                "matrix_bytes": int(self._matrix.nbytes),
+                "bytes_per_chunk": int(self._matrix.itemsize * self.dim),
+                "full_precision_mapped_bytes": int(self._full.nbytes) if self._full is not None else 0,
+                "lexical_terms": self._lexical.term_count() if self._lexical is not None else None,
+            }
+
+    def _quantize(self, vectors: np.ndarray) -> np.ndarray:
+        """正規化済みの行を検索用行列のdtypeに変換"""
+        if self._dtype is np.int8:
+            return np.clip(np.rint(vectors / self._scales), -127, 127).astype(np.int8)
+        return vectors.astype(self._dtype, copy=False)
+
+    def _reserve(self, extra: int) -> None:
+        """行列と並列配列の容量を確保"""
+        needed = self._size + extra
+        capacity = self._matrix.shape[0]
+        if needed <= capacity:
+            return
+        new_capacity = max(needed, capacity * 2, 64)
+        matrix = np.empty((new_capacity, self.dim), dtype=self._dtype)
+        matrix[:self._size] = self._matrix[:self._size]
+        self._matrix = matrix
+        if self._full is not None:
+            self._full.reserve(new_capacity)
+        for name in ("_chunk_ids", "_file_ids", "_contents"):
+            old = getattr(self, name)
+            grown = np.empty(new_capacity, dtype=object)
+            grown[:self._size] = old[:self._size]
+            setattr(self, name, grown)
+
+    def _append(
+        self,
+        chunk_ids: Sequence[str],
+        file_ids: Union[str, Sequence[str]],
+        contents: Sequence[str],
+        vectors: np.ndarray
+    ) -> None:
+        n = len(chunk_ids)
+        if n == 0:
+            return
+        self._reserve(n)
+        start, end = self._size, self._size + n
+        normalized = normalize_rows(vectors.astype(np.float32, copy=False))
+        self._matrix[start:end] = self._quantize(normalized)
+        if self._full is not None:
+            self._full.rows[start:end] = normalized
+        self._chunk_ids[start:end] = list(chunk_ids)
+        self._file_ids[start:end] = file_ids if isinstance(file_ids, str) else list(file_ids)
+        self._contents[start:end] = list(contents)
+        if self._lexical is not None:
+            self._lexical.add(chunk_ids, contents)
+            self._rows.update(zip(chunk_ids, range(start, end)))
+        self._size = end
+
+    def _clear(self) -> None:
+        self._matrix = np.empty((0, self.dim), dtype=self._dtype)
+        if self._full is not None:
+            self._full.reserve(0)
+        self._size = 0
+        self._chunk_ids = np.empty(0, dtype=object)
+        self._file_ids = np.empty(0, dtype=object)
+        self._contents = np.empty(0, dtype=object)
+        self._filenames = {}
+        if self._lexical is not None:
+            self._lexical.clear()
+            self._rows = {}
+
+    def load(self, store) -> None:
+        """
+        保存先からコレクションの検索対象のチャンクをすべて読み込み、インデックスを再構築
+
+        取り込み中（files.status が ready 以外）のファイルのチャンクは含めない
+
+        Args:
+            store: 保存先（utils.store）
+        """
+        version = current_version(self.collection)
+        chunk_ids, file_ids, contents, matrix, filenames = store.load_chunks(self.dim, self.collection)
+        self.load_arrays(chunk_ids, file_ids, contents, matrix, filenames, version)
+
+    def load_arrays(
+        self,
+        chunk_ids: Sequence[str],
+        file_ids: Sequence[str],
+        contents: Sequence[str],
+        embeddings: np.ndarray,
+        filenames: Dict[str, str],
+        version: int
+    ) -> None:
+        """
+        配列からインデックスを再構築
+
+        Args:
+            chunk_ids: チャンクIDのリスト
+            file_ids: 各チャンクのファイルID
+            contents: 各チャンクの本文
+            embeddings: Embedding行列（行数はチャンク数と同じ）
+            filenames: ファイルID → ファイル名
+            version: 読み込み時点のコーパスバージョン
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        with self._lock:
+            self._clear()
+            if self._dtype is np.int8 and len(embeddings):
+                self._scales = int8_scales(embeddings)
+            self._reserve(len(chunk_ids))
+            self._append(chunk_ids, file_ids, contents, embeddings)
+            self._filenames = dict(filenames)
+            self._loaded = True
+            self._version = version
+            self._loaded_at = time.monotonic()
+
+    def ensure_fresh(self, store) -> None:
+        """
+        未ロード、他ワーカーによる更新、または一定時間経過の場合に再読み込み
+
+        Args:
+            store: 保存先（utils.store）
+        """
+        if not self._is_stale():
+            return
+        # 同時に複数のリクエストが再読み込みしないようにする
+        with self._load_lock:
+            if self._is_stale():
+                self.load(store)
+
+    def _is_stale(self) -> bool:
+        return (
+            not self._loaded
+            or self._version != current_version(self.collection)
+            or time.monotonic() - self._loaded_at > settings.vector_index_refresh_seconds
+        )
+
+    def _commit_version(self) -> None:
+        """コーパスバージョンを進め、自分の変更のみなら再読み込みを不要にする"""
+        previous, new = bump_version(self.collection)
+        if self._version == previous:
+            self._version = new
+
+    def add_file(
+        self,
+        file_id: str,
+        filename: str,
+        chunk_ids: Sequence[str],
+        contents: Sequence[str],
+        embeddings: Sequence[Sequence[float]]
+    ) -> None:
+        """
+        アップロードされたファイルのチャンクを追加
+
+        Args:
+            file_id: ファイルID
+            filename: ファイル名
+            chunk_ids: チャンクIDのリスト
+            contents: チャンク本文のリスト
+            embeddings: Embeddingのリスト
+        """
+        with self._lock:
+            if self._loaded:
+                self._filenames[file_id] = filename
+                self._append(chunk_ids, file_id, contents, np.asarray(embeddings, dtype=np.float32))
+            self._commit_version()
+
+    def remove_file(self, file_id: str) -> None:
+        """
+        ファイルに属するチャンクを削除
+
+        Args:
+            file_id: ファイルID
+        """
+        with self._lock:
+            if self._loaded:
+                self._compact(np.flatnonzero(self._file_ids[:self._size] != file_id))
+                self._filenames.pop(file_id, None)
+            self._commit_version()
+
+    def replace_chunks(
+        self,
+        file_id: str,
+        filename: str,
+        removed_ids: Sequence[str],
+        chunk_ids: Sequence[str],
+        contents: Sequence[str],
+        embeddings: Sequence[Sequence[float]]
+    ) -> None:
+        """
+        ファイルのチャンクを差し替える（更新時の差分反映）
+
+        削除と追加を同じロック内で行い、検索から途中の状態が見えないようにする
+
+        Args:
+            file_id: ファイルID
+            filename: ファイル名
+            removed_ids: 削除するチャンクID
+            chunk_ids: 追加するチャンクID
+            contents: 追加するチャンク本文
+            embeddings: 追加するEmbedding
+        """
+        with self._lock:
+            if self._loaded:
+                if len(removed_ids):
+                    removed = np.isin(self._chunk_ids[:self._size], np.asarray(removed_ids, dtype=object))
+                    self._compact(np.flatnonzero(~removed))
+                self._filenames[file_id] = filename
+                if len(chunk_ids):
+                    self._append(chunk_ids, file_id, contents, np.asarray(embeddings, dtype=np.float32))
+            self._commit_version()
+
+    def _compact(self, keep: np.ndarray) -> None:
+        """keep の行だけを先頭に詰める"""
+        if keep.size == self._size:
+            return
+        n = keep.size
+        if self._lexical is not None:
+            removed = np.setdiff1d(np.arange(self._size), keep, assume_unique=True)
+            self._lexical.remove(self._chunk_ids[removed], self._contents[removed])
+        compact_rows(self._matrix, keep)
+        if self._full is not None:
+            compact_rows(self._full.rows, keep)
+        self._chunk_ids[:n] = self._chunk_ids[keep]
+        self._file_ids[:n] = self._file_ids[keep]
+        self._contents[:n] = self._contents[keep]
+        self._chunk_ids[n:self._size] = None
+        self._file_ids[n:self._size] = None
+        self._contents[n:self._size] = None
+        self._size = n
+        if self._lexical is not None:
+            self._rows = {chunk_id: i for i, chunk_id in enumerate(self._chunk_ids[:n])}
+
+    def _scan(self, matrix: np.ndarray, query: np.ndarray, n: int) -> np.ndarray:
+        """
+        全行との内積（float32以外の行列は SCAN_BLOCK_ROWS 行ずつfloat32に変換して計算）
+
+        query が (dim,) なら (n,)、(dim, m) なら (n, m) のスコアを返す
+        """
+        if matrix.dtype == np.float32:
+            return np.asarray(matrix[:n] @ query)
+        scores = np.empty((n,) + query.shape[1:], dtype=np.float32)
+        buffer = np.empty((SCAN_BLOCK_ROWS, self.dim), dtype=np.float32)
+        for start in range(0, n, SCAN_BLOCK_ROWS):
+            end = min(start + SCAN_BLOCK_ROWS, n)
+            block = buffer[:end - start]
+            np.copyto(block, matrix[start:end], casting="unsafe")
+            np.matmul(block, query, out=scores[start:end])
+        return scores
+
+    def _top(self, query: np.ndarray, top_k: int, exact: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        上位k件の行番号と類似度（ロック内で呼ぶ）
+
+        量子化時は1段目で量子化行列から候補を選び、2段目で候補だけをfloat32で再スコアリングする。
+        exact=True の場合はfloat32の行を全件走査する（再現率の比較用）。
+        """
+        n = self._size
+        k = min(top_k, n)
+        if not self.quantized or exact:
+            matrix = self._full.rows if self.quantized else self._matrix
+            scores = self._scan(matrix, query, n)
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return top, scores[top]
+
+        scan_query = query * self._scales if self._dtype is np.int8 else query
+        approximate = self._scan(self._matrix, scan_query, n)
+        candidates = min(max(self.rescore_candidates, k), n)
+        candidate_rows = np.sort(np.argpartition(-approximate, candidates - 1)[:candidates])
+        scores = self._full.rows[candidate_rows] @ query
+        order = np.argsort(-scores)[:k]
+        return candidate_rows[order], scores[order]
+
+    def _top_batch(self, queries: np.ndarray, top_k: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        複数の質問の上位k件の行番号と類似度（ロック内で呼ぶ）
+
+        queries は (dim, m) の正規化済み行列。全行との類似度を行列行列積1回で求め、
+        量子化時は質問ごとに候補だけをfloat32で再スコアリングする。
+        argpartition は質問ごとに連続した行で行うため、スコアを (m, n) に転置してから選ぶ。
+        """
+        n = self._size
+        k = min(top_k, n)
+        if not self.quantized:
+            scores = np.ascontiguousarray(self._scan(self._matrix, queries, n).T)
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            results = []
+            for j in range(queries.shape[1]):
+                row_scores = scores[j, top[j]]
+                order = np.argsort(-row_scores)
+                results.append((top[j, order], row_scores[order]))
+            return results
+
+        scan_queries = queries * self._scales[:, None] if self._dtype is np.int8 else queries
+        approximate = np.ascontiguousarray(self._scan(self._matrix, scan_queries, n).T)
+        candidates = min(max(self.rescore_candidates, k), n)
+        candidate_rows = np.sort(np.argpartition(-approximate, candidates - 1, axis=1)[:, :candidates], axis=1)
+        results = []
+        for j in range(queries.shape[1]):
+            rows = candidate_rows[j]
+            scores = self._full.rows[rows] @ queries[:, j]
+            order = np.argsort(-scores)[:k]
+            results.append((rows[order], scores[order]))
+        return results
+
+    def _exact_scores(self, rows: np.ndarray, query: np.ndarray) -> np.ndarray:
+        """指定した行だけのfloat32での類似度（ロック内で呼ぶ）"""
+        matrix = self._full.rows if self.quantized else self._matrix
+        return np.asarray(matrix[rows] @ query, dtype=np.float32)
+
+    def _hit(self, row: int, similarity: Optional[float], lexical_score: Optional[float] = None) -> SearchHit:
+        file_id = self._file_ids[row]
+        return SearchHit(
+            chunk_id=self._chunk_ids[row],
+            file_id=file_id,
+            filename=self._filenames.get(file_id, "不明"),
+            content=self._contents[row],
+            similarity=similarity,
+            lexical_score=lexical_score
+        )
+
+    @staticmethod
+    def _normalize_query(query_embedding: Sequence[float]) -> Optional[np.ndarray]:
+        query = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        return query / norm if norm > 0 else None
+
+    def search(
+        self,
+        query_embedding: Sequence[float],
+        top_k: int = 3,
+        min_similarity: Optional[float] = None
+    ) -> List[SearchHit]:
+        """
+        コサイン類似度の上位k件を取得
+
+        Args:
+            query_embedding: 質問文のEmbedding
+            top_k: 取得件数
+            min_similarity: 類似度の下限（指定時）
+
+        Returns:
+            類似度の降順に並んだ検索結果
+        """
+        query = self._normalize_query(query_embedding)
+        if query is None:
+            return []
+
+        with self._lock:
+            if self._size == 0:
+                return []
+            top, scores = self._top(query, top_k)
+            record_scan("full", self._size)
+
+            hits = []
+            for i, score in zip(top, scores):
+                similarity = float(score)
+                if min_similarity is not None and similarity < min_similarity:
+                    break
+                hits.append(self._hit(i, similarity))
+            return hits
+
+    def search_batch(
+        self,
+        query_embeddings: Sequence[Sequence[float]],
+        top_k: int = 3,
+        min_similarity: Optional[float] = None
+    ) -> List[List[SearchHit]]:
+        """
+        複数の質問のコサイン類似度の上位k件をまとめて取得
+
+        QUERY_BLOCK_SIZE 件ずつ質問を並べた行列と行列行列積を1回計算するため、
+        行列の読み出しが質問の数だけ繰り返されない
+
+        Args:
+            query_embeddings: 質問文のEmbeddingのリスト
+            top_k: 取得件数
+            min_similarity: 類似度の下限（指定時）
+
+        Returns:
+            質問ごとの、類似度の降順に並んだ検索結果（入力順。ノルムが0の質問は空）
+        """
+        results: List[List[SearchHit]] = [[] for _ in query_embeddings]
+        if not results:
+            return results
+        queries = np.asarray(query_embeddings, dtype=np.float32).reshape(len(results), -1)
+        norms = np.linalg.norm(queries, axis=1)
+        valid = np.flatnonzero(norms > 0)
+
+        with self._lock:
+            if self._size == 0:
+                return results
+            for start in range(0, valid.size, QUERY_BLOCK_SIZE):
+                block = valid[start:start + QUERY_BLOCK_SIZE]
+                normalized = (queries[block] / norms[block, None]).T
+                for i, (top, scores) in zip(block.tolist(), self._top_batch(np.ascontiguousarray(normalized), top_k)):
+                    hits = []
+                    for row, score in zip(top, scores):
+                        similarity = float(score)
+                        if min_similarity is not None and similarity < min_similarity:
+                            break
+                        hits.append(self._hit(row, similarity))
+                    results[i] = hits
+                record_scan("batch", self._size)
+            return results
+
+    def search_lexical(self, question: str, top_k: int = 3, require_all: bool = False) -> List[SearchHit]:
+        """
+        語彙検索（BM25）だけで上位k件を取得（Embeddingを使わない）
+
+        Args:
+            question: 質問文
+            top_k: 取得件数
+            require_all: Trueの場合、質問の語をすべて含むチャンクのみ返す
+
+        Returns:
+            BM25スコアの降順に並んだ検索結果（similarity はNone）
+
+        Raises:
+            ValueError: 語彙検索が無効な場合
+        """
+        if self._lexical is None:
+            raise ValueError("語彙検索が無効です。LEXICAL_INDEX_ENABLED=true を設定してください。")
+        with self._lock:
+            return [
+                self._hit(self._rows[chunk_id], None, score)
+                for chunk_id, score in self._lexical.search(question, top_k, require_all=require_all)
+            ]
+
+    def search_hybrid(
+        self,
+        question: str,
+        query_embedding: Sequence[float],
+        top_k: int = 3,
+        min_similarity: Optional[float] = None,
+        prefilter: Optional[bool] = None
+    ) -> List[SearchHit]:
+        """
+        語彙検索とベクトル検索の順位を Reciprocal Rank Fusion で融合して上位k件を取得
+
+        語彙検索の候補が HYBRID_PREFILTER_MIN_CANDIDATES 件以上あり prefilter が有効な場合は、
+        ベクトルの類似度をその候補の行だけで計算する（全件走査しない）。
+
+        Args:
+            question: 質問文
+            query_embedding: 質問文のEmbedding
+            top_k: 取得件数
+            min_similarity: コサイン類似度の下限（指定時）
+            prefilter: 語彙検索の候補に絞るか（未指定時は HYBRID_PREFILTER）
+
+        Returns:
+            融合スコアの降順に並んだ検索結果
+
+        Raises:
+            ValueError: 語彙検索が無効な場合
+        """
+        if self._lexical is None:
+            raise ValueError("語彙検索が無効です。LEXICAL_INDEX_ENABLED=true を設定してください。")
+        query = self._normalize_query(query_embedding)
+        if query is None:
+            return []
+        prefilter = settings.hybrid_prefilter if prefilter is None else prefilter
+        depth = max(settings.hybrid_candidates, top_k)
+        rrf_k = settings.hybrid_rrf_k
+
+        with self._lock:
+            if self._size == 0:
+                return []
+            lexical = self._lexical.search(question, depth)
+            lexical_rows = np.array([self._rows[chunk_id] for chunk_id, _ in lexical], dtype=np.int64)
+
+            if prefilter and lexical_rows.size >= settings.hybrid_prefilter_min_candidates:
+                scores = self._exact_scores(lexical_rows, query)
+                order = np.argsort(-scores)
+                vector_rows, vector_scores = lexical_rows[order], scores[order]
+                record_scan("prefilter", int(lexical_rows.size))
+            else:
+                vector_rows, vector_scores = self._top(query, depth)
+                record_scan("full", self._size)
+
+            fused: Dict[int, float] = {}
+            for rank, row in enumerate(vector_rows.tolist()):
+                fused[row] = fused.get(row, 0.0) + 1.0 / (rrf_k + rank + 1)
+            for rank, row in enumerate(lexical_rows.tolist()):
+                fused[row] = fused.get(row, 0.0) + 1.0 / (rrf_k + rank + 1)
+            similarities = dict(zip(vector_rows.tolist(), vector_scores.tolist()))
+            lexical_scores = {row: score for row, (_, score) in zip(lexical_rows.tolist(), lexical)}
+
+            hits = []
+            for row, _ in heapq.nlargest(len(fused), fused.items(), key=lambda item: item[1]):
+                similarity = similarities.get(row)
+                if similarity is None:
+                    similarity = float(self._exact_scores(np.array([row]), query)[0])
+                if min_similarity is not None and similarity < min_similarity:
+                    continue
+                hits.append(self._hit(row, similarity, lexical_scores.get(row)))
+                if len(hits) == top_k:
+                    break
+            return hits
+
+    def measure_recall(
+        self,
+        queries: Optional[np.ndarray] = None,
+        sample: int = 100,
+        top_k: int = 3,
+        seed: int = 0
+    ) -> dict:
+        """
+        量子化した検索の再現率（float32の全件走査の上位k件のうち、同じく返せた割合）
+
+        Args:
+            queries: 質問文のEmbedding行列（未指定時は登録済みの行に雑音を加えて作る）
+            sample: queries 未指定時の件数
+            top_k: 比較する件数
+            seed: 乱数シード
+
+        Returns:
+            件数・量子化方式・再現率など
+        """
+        with self._lock:
+            n = self._size
+            result = {"quantization": self.quantization, "top_k": top_k, "queries": 0, "recall": 1.0}
+            if n == 0:
+                return result
+            if queries is None:
+                rng = np.random.default_rng(seed)
+                base = self._full.rows if self.quantized else self._matrix
+                rows = rng.choice(n, size=min(sample, n), replace=False)
+                queries = base[np.sort(rows)].astype(np.float32)
+                queries = queries + rng.normal(scale=1.0 / np.sqrt(self.dim), size=queries.shape).astype(np.float32)
+            queries = normalize_rows(np.asarray(queries, dtype=np.float32))
+
+            found = 0
+            for query in queries:
+                exact, _ = self._top(query, top_k, exact=True)
+                approximate, _ = self._top(query, top_k)
+                found += np.intersect1d(exact, approximate).size
+            result.update({
+                "queries": int(len(queries)),
+                "candidates": self.rescore_candidates if self.quantized else None,
+                "recall": round(found / (len(queries) * min(top_k, n)), 4),
+            })
+            return result
+
+
+_indexes: Dict[str, VectorIndex] = {}
+_index_lock = threading.Lock()
+
+
+def get_vector_index(collection: str = DEFAULT_COLLECTION, store=None) -> VectorIndex:
+    """
+    コレクションのベクトルインデックスを取得（プロセス共通。初回の検索時に読み込む）
+
+    store を渡した場合、まだインデックスのないコレクションは保存先の list_collections にあるものだけ作る
+    （存在しない名前の検索でインデックスが増え続けないようにする。default は常に作る）
+
+    Args:
+        collection: コレクション
+        store: 保存先（取り込み・削除などファイルの存在を確認済みの場合は不要）
+
+    Returns:
+        そのコレクションのチャンクだけを持つインデックス
+
+    Raises:
+        UnknownCollectionError: store を渡し、コレクションにファイルがない場合
+    """
+    index = _indexes.get(collection)
+    if index is None:
+        if store is not None and collection != DEFAULT_COLLECTION:
+            if collection not in {row["collection"] for row in store.list_collections()}:
+                raise UnknownCollectionError(collection)
+        with _index_lock:
+            index = _indexes.get(collection)
+            if index is None:
+                lexical = None
+                if settings.lexical_index_enabled or settings.retrieval_mode == "hybrid":
+                    lexical = LexicalIndex(settings.lexical_ngram, settings.bm25_k1, settings.bm25_b)
+                index = VectorIndex(
+                    settings.embedding_dimensions,
+                    quantization=settings.vector_quantization,
+                    rescore_candidates=settings.vector_rescore_candidates,
+                    lexical=lexical,
+                    collection=collection
+                )
+                _indexes[collection] = index
+    return index
@@ -8,6 +8,63 @@ CREATE TABLE IF NOT EXISTS files (
     created_at TIMESTAMP NOT NULL DEFAULT NOW()
 );
 
+-- 取り込み状態（processing: 取り込み中, ready: 検索対象, updating: 差分取り込み中。差し替えまでは旧版が検索対象,
+--              failed: サーバーの停止で取り込みが中断された）
+-- 既存のデータベースにも適用できるよう ADD COLUMN IF NOT EXISTS で追加
+ALTER TABLE files ADD COLUMN IF NOT EXISTS status VARCHAR(20) NOT NULL DEFAULT 'ready';
+
+-- ファイル内容のSHA-256（同じ内容のファイルの重複アップロード検出用）
+ALTER TABLE files ADD COLUMN IF NOT EXISTS content_hash VARCHAR(64);
+CREATE INDEX IF NOT EXISTS files_content_hash_idx ON files(content_hash);
+
+-- Storage上のパス（更新・削除時に使用。未設定の行は files/{filename} とみなす）
+ALTER TABLE files ADD COLUMN IF NOT EXISTS storage_path TEXT;
+
+-- ファイルごとの統計（取り込み時に更新し、一覧の表示時には集計しない）
+ALTER TABLE files ADD COLUMN IF NOT EXISTS chunk_count INT;
+ALTER TABLE files ADD COLUMN IF NOT EXISTS byte_size BIGINT;
+
+-- ファイル一覧のページング（created_at, id の降順でカーソルを進める）
+CREATE INDEX IF NOT EXISTS files_created_at_id_idx ON files(created_at DESC, id DESC);
+
+-- コレクション（互いに独立したナレッジベース。既存のファイルは default に属する）
+-- 名前は英小文字・数字・アンダースコアで40文字まで（部分インデックスの名前に使う）
+ALTER TABLE files ADD COLUMN IF NOT EXISTS collection VARCHAR(40) NOT NULL DEFAULT 'default';
+-- コレクションごとのファイル一覧のページングと重複チェック
+CREATE INDEX IF NOT EXISTS files_collection_created_at_id_idx ON files(collection, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS files_collection_filename_idx ON files(collection, filename);
+
+-- コレクション一覧（/admin/collections）
+CREATE OR REPLACE VIEW file_collections AS
+SELECT
+    collection,
+    COUNT(*) AS file_count,
+    COALESCE(SUM(chunk_count), 0) AS chunk_count
+FROM files
+GROUP BY collection;
+
+-- ファイル一覧のバージョン（filesの追加・更新・削除のたびに進む。一覧のETagに使用）
+CREATE TABLE IF NOT EXISTS catalog_state (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    version BIGINT NOT NULL DEFAULT 0
+);
+INSERT INTO catalog_state (id, version) VALUES (TRUE, 0) ON CONFLICT (id) DO NOTHING;
+
+CREATE OR REPLACE FUNCTION bump_catalog_version()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    UPDATE catalog_state SET version = version + 1 WHERE id;
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS files_catalog_version ON files;
+CREATE TRIGGER files_catalog_version
+AFTER INSERT OR UPDATE OR DELETE ON files
+FOR EACH STATEMENT EXECUTE FUNCTION bump_catalog_version();
+
 -- chunksテーブル作成
 CREATE TABLE IF NOT EXISTS chunks (
     id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
@@ -26,7 +83,250 @@ WITH (lists = 100);
 -- file_idインデックス（削除時のパフォーマンス向上）
 CREATE INDEX IF NOT EXISTS chunks_file_id_idx ON chunks(file_id);
 
+-- チャンク本文のSHA-256（同じ本文のチャンクはEmbeddingを再利用する）
+ALTER TABLE chunks ADD COLUMN IF NOT EXISTS content_hash VARCHAR(64);
+CREATE INDEX IF NOT EXISTS chunks_content_hash_idx ON chunks(content_hash);
+
+-- ハッシュごとに保存済みチャンクのEmbeddingを1件だけ返す（同じ本文のチャンクが多数あっても転送量が増えない）
+CREATE OR REPLACE FUNCTION find_chunk_embeddings(hashes VARCHAR[])
+RETURNS TABLE (
+    content_hash VARCHAR,
+    embedding vector(1536)
+)
+LANGUAGE sql STABLE
+AS $$
+    SELECT DISTINCT ON (c.content_hash) c.content_hash, c.embedding
+    FROM chunks c
+    WHERE c.content_hash = ANY(hashes)
+      AND c.embedding IS NOT NULL
+    ORDER BY c.content_hash;
+$$;
+
+-- チャンクのコレクション（ファイルのものを複製し、コレクションごとの部分インデックスに使う）
+ALTER TABLE chunks ADD COLUMN IF NOT EXISTS collection VARCHAR(40) NOT NULL DEFAULT 'default';
+CREATE INDEX IF NOT EXISTS chunks_collection_idx ON chunks(collection);
+
+-- 挿入時にファイルのコレクションを設定（REST・COPY・replace_file_chunks のいずれの経路でも）
+CREATE OR REPLACE FUNCTION set_chunk_collection()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    SELECT f.collection INTO NEW.collection FROM files f WHERE f.id = NEW.file_id;
+    RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS chunks_collection ON chunks;
+CREATE TRIGGER chunks_collection
+BEFORE INSERT ON chunks
+FOR EACH ROW EXECUTE FUNCTION set_chunk_collection();
+
+-- コレクションごとのベクトル検索用インデックス（WHERE collection = ... の部分インデックス）
+-- 検索はそのコレクションのインデックスだけを使い、他のコレクションの行は走査しない
+-- コレクションにデータを追加してから作成する（例: SELECT create_collection_index('product_a');）
+-- with_halfvec: match_chunks_halfvec 用のhalfvecのインデックスも作る（pgvector 0.7以上）
+CREATE OR REPLACE FUNCTION create_collection_index(
+    collection_name TEXT,
+    lists INT DEFAULT 100,
+    with_halfvec BOOLEAN DEFAULT FALSE
+)
+RETURNS VOID
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF collection_name !~ '^[a-z0-9][a-z0-9_]{0,39}$' THEN
+        RAISE EXCEPTION 'コレクション名が不正です: %', collection_name;
+    END IF;
+
+    EXECUTE format(
+        'CREATE INDEX IF NOT EXISTS %I ON chunks USING ivfflat (embedding vector_cosine_ops) WITH (lists = %s) WHERE collection = %L',
+        'chunks_embedding_' || collection_name || '_idx',
+        lists,
+        collection_name
+    );
+
+    IF with_halfvec THEN
+        EXECUTE format(
+            'CREATE INDEX IF NOT EXISTS %I ON chunks USING hnsw ((embedding::halfvec(1536)) halfvec_cosine_ops) WHERE collection = %L',
+            'chunks_halfvec_' || collection_name || '_idx',
+            collection_name
+        );
+    END IF;
+END;
+$$;
+
+-- 既存のファイルのチャンク数を一度だけ集計（以降は取り込み時に更新）
+UPDATE files f
+SET chunk_count = (SELECT COUNT(*) FROM chunks c WHERE c.file_id = f.id)
+WHERE f.chunk_count IS NULL;
+
+-- 類似度検索関数（上位k件のみを返す）
+-- コレクションの部分インデックス（create_collection_index）を使って近似検索し、ファイル名もJOIN済みで返す
+-- 部分インデックスの条件に一致させるため、コレクション名は定数としてSQLに埋め込んで実行する
+-- （部分インデックスのないコレクションは chunks_embedding_idx の候補を絞り込むため、件数がmatch_count未満になることがある）
+-- probesを指定するとトランザクション内でのみivfflat.probesを変更する
+-- （大きいほど再現率が上がり、遅くなる。未指定時はサーバー設定値）
+-- file_idsで絞り込む場合、ivfflatは候補取得後に絞り込むため件数がmatch_count未満になることがある
+DROP FUNCTION IF EXISTS match_chunks(vector, INT, FLOAT, UUID[], INT);
+CREATE OR REPLACE FUNCTION match_chunks(
+    query_embedding vector(1536),
+    match_count INT DEFAULT 3,
+    min_similarity FLOAT DEFAULT NULL,
+    file_ids UUID[] DEFAULT NULL,
+    probes INT DEFAULT NULL,
+    collection_name TEXT DEFAULT 'default'
+)
+RETURNS TABLE (
+    id UUID,
+    file_id UUID,
+    filename VARCHAR,
+    content TEXT,
+    similarity FLOAT
+)
+LANGUAGE plpgsql
+AS $$
+#variable_conflict use_column
+BEGIN
+    IF probes IS NOT NULL THEN
+        PERFORM set_config('ivfflat.probes', probes::TEXT, true);
+    END IF;
+
+    RETURN QUERY EXECUTE format($query$
+        SELECT m.id, m.file_id, m.filename, m.content, m.similarity
+        FROM (
+            SELECT
+                c.id,
+                c.file_id,
+                f.filename,
+                c.content,
+                (1 - (c.embedding <=> $1))::FLOAT AS similarity
+            FROM chunks c
+            JOIN files f ON f.id = c.file_id
+            WHERE c.collection = %L
+              AND f.status IN ('ready', 'updating')
+              AND ($3::UUID[] IS NULL OR c.file_id = ANY($3))
+            -- ORDER BY は距離演算子そのものにしないとインデックスが使われない
+            ORDER BY c.embedding <=> $1
+            LIMIT $2
+        ) m
+        WHERE $4::FLOAT IS NULL OR m.similarity >= $4
+    $query$, collection_name)
+    USING query_embedding, match_count, file_ids, min_similarity;
+END;
+$$;
+
+-- （任意）halfvec（float16）で候補を選び、元のvectorで再スコアリングする類似度検索関数
+-- VECTOR_QUANTIZATION=float16 で rpc を使う場合に呼ばれる（pgvector 0.7以上）
+-- 式インデックスはhalfvecで保持するため、chunks_embedding_idx の約半分のサイズで済む
+--
+-- halfvecのインデックスは既定では作らない（hnswの構築は全チャンクを読むため時間がかかり、使わない場合は容量の無駄になる）
+-- VECTOR_QUANTIZATION=float16 で rpc を使う場合だけ、このSQLとは別の移行手順として次のいずれかを実行する
+--   コレクションごと: SELECT create_collection_index('名前', with_halfvec => TRUE);
+--   全チャンク:       CREATE INDEX CONCURRENTLY IF NOT EXISTS chunks_embedding_halfvec_idx ON chunks
+--                     USING hnsw ((embedding::halfvec(1536)) halfvec_cosine_ops);
+-- （CONCURRENTLY はトランザクション外で実行する。構築中も chunks への書き込みを止めない）
+
+DROP FUNCTION IF EXISTS match_chunks_halfvec(vector, INT, FLOAT, UUID[], INT);
+CREATE OR REPLACE FUNCTION match_chunks_halfvec(
+    query_embedding vector(1536),
+    match_count INT DEFAULT 3,
+    min_similarity FLOAT DEFAULT NULL,
+    file_ids UUID[] DEFAULT NULL,
+    candidate_count INT DEFAULT 40,
+    collection_name TEXT DEFAULT 'default'
+)
+RETURNS TABLE (
+    id UUID,
+    file_id UUID,
+    filename VARCHAR,
+    content TEXT,
+    similarity FLOAT
+)
+LANGUAGE plpgsql
+AS $$
+#variable_conflict use_column
+BEGIN
+    -- hnswが返す候補数の上限（ef_search）を候補数以上にする
+    PERFORM set_config('hnsw.ef_search', GREATEST(candidate_count, match_count, 40)::TEXT, true);
+
+    RETURN QUERY EXECUTE format($query$
+        SELECT m.id, m.file_id, m.filename, m.content, m.similarity
+        FROM (
+            SELECT
+                c.id,
+                c.file_id,
+                f.filename,
+                c.content,
+                (1 - (c.embedding <=> $1))::FLOAT AS similarity
+            FROM (
+                -- 1段目: コレクションのhalfvecのインデックスで候補を選ぶ
+                -- 検索対象外（取り込み中など）・file_ids 以外のチャンクが候補の枠を使わないよう、ここで絞り込む
+                SELECT h.id
+                FROM chunks h
+                JOIN files hf ON hf.id = h.file_id
+                WHERE h.collection = %L
+                  AND hf.status IN ('ready', 'updating')
+                  AND ($3::UUID[] IS NULL OR h.file_id = ANY($3))
+                ORDER BY h.embedding::halfvec(1536) <=> $1::halfvec(1536)
+                LIMIT GREATEST($5, $2)
+            ) candidate
+            JOIN chunks c ON c.id = candidate.id
+            JOIN files f ON f.id = c.file_id
+            -- 2段目: 候補だけを元のvectorで並べ直す
+            ORDER BY c.embedding <=> $1
+            LIMIT $2
+        ) m
+        WHERE $4::FLOAT IS NULL OR m.similarity >= $4
+    $query$, collection_name)
+    USING query_embedding, match_count, file_ids, min_similarity, candidate_count;
+END;
+$$;
+
 -- 確認用クエリ
 -- SELECT * FROM files;
 -- SELECT * FROM chunks LIMIT 10;
 
+-- ファイル更新時のチャンク差し替え
+-- 削除・追加・ファイル情報の更新を1トランザクションで行うため、検索から途中の状態は見えない
+-- added は [{"content": "...", "content_hash": "...", "embedding": [...]}, ...]
+DROP FUNCTION IF EXISTS replace_file_chunks(UUID, UUID[], JSONB, VARCHAR, TEXT);
+CREATE OR REPLACE FUNCTION replace_file_chunks(
+    target_file_id UUID,
+    removed_ids UUID[],
+    added JSONB,
+    new_content_hash VARCHAR DEFAULT NULL,
+    new_storage_path TEXT DEFAULT NULL,
+    new_byte_size BIGINT DEFAULT NULL
+)
+RETURNS TABLE (
+    id UUID,
+    content_hash VARCHAR
+)
+LANGUAGE plpgsql
+AS $$
+#variable_conflict use_column
+BEGIN
+    DELETE FROM chunks c
+    WHERE c.file_id = target_file_id
+      AND c.id = ANY(removed_ids);
+
+    RETURN QUERY
+    INSERT INTO chunks (file_id, content, content_hash, embedding)
+    SELECT
+        target_file_id,
+        a.value->>'content',
+        a.value->>'content_hash',
+        (a.value->>'embedding')::vector
+    FROM jsonb_array_elements(added) WITH ORDINALITY AS a(value, ord)
+    ORDER BY a.ord
+    RETURNING chunks.id, chunks.content_hash;
+
+    UPDATE files f
+    SET content_hash = COALESCE(new_content_hash, f.content_hash),
+        storage_path = COALESCE(new_storage_path, f.storage_path),
+        byte_size = COALESCE(new_byte_size, f.byte_size),
+        chunk_count = (SELECT COUNT(*) FROM chunks c WHERE c.file_id = target_file_id)
+    WHERE f.id = target_file_id;
+END;
+$$;